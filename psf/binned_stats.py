@@ -0,0 +1,70 @@
+# Compute statistics of several quantities in bins of some other quantity.
+# Everything is done with np.bincount, so each column takes a couple of passes through the
+# data, regardless of the number of bins.
+
+from __future__ import print_function
+import numpy as np
+
+
+def bin_index(x, bins):
+    """Find which bin each value of x falls in.
+
+    This is np.digitize shifted so that the first bin is 0.  Values below bins[0] get -1,
+    and values above bins[-1] get len(bins)-1, so neither of those counts as a valid bin.
+    """
+    return np.digitize(x, bins) - 1
+
+
+def binned_stats(index, nbins, cols, w=None):
+    """Compute the weighted mean, variance and standard error of each column in each bin.
+
+    Objects with index < 0 or index >= nbins are ignored.  Empty bins get 0 for everything,
+    which is what the plotting scripts have always done with them.
+
+    With w=None, the mean and (population) variance match what you would get from
+    x[index==i].mean() and x[index==i].var(), and err = sqrt(var/n).  With weights, n is
+    replaced by the effective number (sum w)^2 / sum w^2.
+
+    Parameters:
+        index:  The bin number of each object (e.g. from bin_index).
+        nbins:  The number of bins.
+        cols:   A list of arrays to bin, each the same length as index.
+        w:      Optional weights for each object. [default: None]
+
+    Returns:
+        count, mean, var, err
+    where count has shape (nbins,) and the others have shape (len(cols), nbins).
+    """
+    index = np.asarray(index)
+    use = (index >= 0) & (index < nbins)
+    if not np.all(use):
+        index = index[use]
+        cols = [ np.asarray(c)[use] for c in cols ]
+        if w is not None:
+            w = np.asarray(w)[use]
+
+    count = np.bincount(index, minlength=nbins)
+    if w is None:
+        sumw = count.astype(float)
+        neff = sumw
+    else:
+        sumw = np.bincount(index, weights=w, minlength=nbins)
+        sumw2 = np.bincount(index, weights=w**2, minlength=nbins)
+        neff = np.zeros(nbins)
+        neff[sumw2 > 0] = sumw[sumw2 > 0]**2 / sumw2[sumw2 > 0]
+    good = sumw > 0
+
+    mean = np.zeros((len(cols), nbins))
+    var = np.zeros((len(cols), nbins))
+    err = np.zeros((len(cols), nbins))
+    for k, x in enumerate(cols):
+        x = np.asarray(x, dtype=float)
+        wx = x if w is None else w * x
+        mean[k,good] = np.bincount(index, weights=wx, minlength=nbins)[good] / sumw[good]
+        # Subtract the mean before squaring to avoid round off problems.
+        dx = x - mean[k,index]
+        wdx2 = dx**2 if w is None else w * dx**2
+        var[k,good] = np.bincount(index, weights=wdx2, minlength=nbins)[good] / sumw[good]
+        err[k,good] = np.sqrt(var[k,good] / neff[good])
+
+    return count, mean, var, err
@@ -0,0 +1,135 @@
+# Save figures in several formats, optionally handing the actual rendering off to a pool
+# of worker processes so the script can get on with computing the next figure.
+#
+# Typical usage:
+#
+#     start_figure_workers(nproc)
+#     ...
+#     if not figure_is_current('de_x_riz', data):
+#         fig = plt.figure()
+#         ...
+#         save_figure(fig, 'de_x_riz', data=data)
+#     ...
+#     finish_figures()
+#
+# If data is given, a hash of it is saved next to the figure, so later runs can skip
+# redrawing figures whose underlying (binned) data have not changed.
+
+from __future__ import print_function
+import os
+import hashlib
+import pickle
+import numpy as np
+
+DEFAULT_FORMATS = ('png', 'pdf', 'eps')
+
+# Collections with more elements than this get rasterized.  The axes, labels, etc. stay vector.
+MAX_VECTOR = 5000
+
+_pool = None
+_pending = []
+
+
+def start_figure_workers(nproc):
+    """Render figures in nproc worker processes.  With nproc <= 1, figures are saved
+    immediately in the calling process.
+    """
+    global _pool
+    import multiprocessing
+    finish_figures()
+    if nproc > 1:
+        _pool = multiprocessing.Pool(nproc)
+
+
+def finish_figures():
+    """Wait for any figures that are still being rendered.
+    """
+    global _pool, _pending
+    for result in _pending:
+        result.get()
+    _pending = []
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def _split_name(file_name, formats):
+    base, ext = os.path.splitext(file_name)
+    if formats is None:
+        formats = [ext[1:]] if ext != '' else DEFAULT_FORMATS
+    return base, formats
+
+
+def _data_hash(data, formats, kwargs):
+    h = hashlib.sha1()
+    for d in data:
+        h.update(np.ascontiguousarray(np.asarray(d, dtype=float)).tobytes())
+    h.update(repr((list(formats), sorted(kwargs.items()))).encode())
+    return h.hexdigest()
+
+
+def figure_is_current(file_name, data, formats=None, **kwargs):
+    """Check whether all the output files exist and were made from the same data.
+
+    kwargs should be the same as would be passed to save_figure.
+    """
+    base, formats = _split_name(file_name, formats)
+    hash_file = base + '.hash'
+    outputs = [ base + '.' + fmt for fmt in formats ] + [ hash_file ]
+    if not all(os.path.exists(f) for f in outputs):
+        return False
+    with open(hash_file) as fin:
+        old_hash = fin.read().strip()
+    if old_hash == _data_hash(data, formats, kwargs):
+        print('%s is up to date.  Not remaking it.'%base)
+        return True
+    return False
+
+
+def rasterize_dense(fig, max_vector=MAX_VECTOR):
+    """Rasterize any scatter, hexbin, quiver or line layer with more than max_vector elements.
+    """
+    for ax in fig.axes:
+        for c in ax.collections:
+            n = max(len(c.get_offsets()), len(c.get_paths()))
+            if n > max_vector:
+                c.set_rasterized(True)
+        for line in ax.lines:
+            if len(line.get_xdata()) > max_vector:
+                line.set_rasterized(True)
+
+
+def _render(fig, base, formats, kwargs, data_hash):
+    if not hasattr(fig, 'savefig'):
+        fig = pickle.loads(fig)
+    for fmt in formats:
+        fig.savefig(base + '.' + fmt, **kwargs)
+        print('wrote',base + '.' + fmt)
+    if data_hash is not None:
+        with open(base + '.hash', 'w') as fout:
+            fout.write(data_hash + '\n')
+
+
+def save_figure(fig, file_name, formats=None, data=None, max_vector=MAX_VECTOR, **kwargs):
+    """Save a finished figure.
+
+    If file_name has an extension and formats is None, just that format is written.
+    Otherwise, the figure is written in each of formats (default png, pdf, eps).
+
+    If data is given (a list of arrays), a hash of it is saved as well for use by
+    figure_is_current.  Other kwargs are passed to savefig.
+
+    If start_figure_workers has been called, the figure is pickled and rendered by one of the
+    workers, and the figure is closed here.
+    """
+    import matplotlib.pyplot as plt
+    base, formats = _split_name(file_name, formats)
+    rasterize_dense(fig, max_vector)
+    data_hash = _data_hash(data, formats, kwargs) if data is not None else None
+    if _pool is None:
+        _render(fig, base, list(formats), kwargs, data_hash)
+    else:
+        s = pickle.dumps(fig, protocol=-1)
+        plt.close(fig)
+        _pending.append(_pool.apply_async(_render, (s, base, list(formats), kwargs, data_hash)))
@@ -3,7 +3,9 @@ from __future__ import print_function
 import numpy as np
 import os
 from read_psf_cats import read_data
-from toFocal import toFocal, toFocalArcmin
+from toFocal import toFocalArcmin
+from focal_map import fov_map, fov_map_spec, get_fov_map, whisker_data
+from figure_output import save_figure, figure_is_current, start_figure_workers, finish_figures
 
 def parse_args():
     import argparse
@@ -31,76 +33,21 @@ def parse_args():
                         help='Use PSFEx rather than Piff model')
     parser.add_argument('--frac', default=1., type=float,
                         help='Choose a random fraction of the input stars')
+    parser.add_argument('--max_mag', default=0, type=float,
+                        help='Maximum star magnitude to use (0 means no cut)')
+    parser.add_argument('--nproc', default=1, type=int,
+                        help='Number of processes to use for rendering the figures')
+    parser.add_argument('--remake_maps', default=False, action='store_const', const=True,
+                        help='Remake the binned fov maps even if they already exist')
 
     args = parser.parse_args()
     return args
 
 
 def bin_by_fov(ccd, x, y, e1, e2, s, w=None, nwhisk=5):
-
-    all_x = np.array([])
-    all_y = np.array([])
-    all_e1 = np.array([])
-    all_e2 = np.array([])
-    all_s = np.array([])
-
-    if w is None:
-        w = np.ones(len(x))
-
-    x_bins = np.linspace(0,2048,nwhisk+1)
-    y_bins = np.linspace(0,4096,2*nwhisk+1)
-    print('x_bins = ',x_bins)
-    print('y_bins = ',y_bins)
-
-    ccdnums = np.unique(ccd)
-    print('ccdnums = ',ccdnums)
-    for ccdnum in ccdnums:
-        mask = np.where(ccd == ccdnum)[0]
-        print('ccdnum = ',ccdnum,', nstar = ',len(mask))
-        if mask.sum() < 100: continue
-        if ccdnum in [31, 61]: continue
-
-        x_index = np.digitize(x[mask], x_bins)
-        y_index = np.digitize(y[mask], y_bins)
-
-        nbins = (len(x_bins)-1) * (len(y_bins)-1)
-        bin_e1 = np.empty(nbins)
-        bin_e2 = np.empty(nbins)
-        bin_s = np.empty(nbins)
-        bin_x = np.empty(nbins)
-        bin_y = np.empty(nbins)
-        bin_nz = np.empty(nbins, dtype=bool)
-        sumesq = 0.
-
-        for i in range(1, len(x_bins)):
-            for j in range(1, len(y_bins)):
-                k = (i-1)*(len(y_bins)-1) + (j-1)
-                mask2 = np.where( (x_index == i) & (y_index == j) )[0]
-                ww = w[mask][mask2]
-                ws = ww.sum()
-                bin_e1[k] = (ww * e1[mask][mask2]).sum() / ws
-                bin_e2[k] = (ww * e2[mask][mask2]).sum() / ws
-                bin_s[k] = (ww * s[mask][mask2]).sum() / ws
-                bin_x[k] = (ww * x[mask][mask2]).sum() / ws
-                bin_y[k] = (ww * y[mask][mask2]).sum() / ws
-                bin_nz[k] = len(mask2) > 0
-                print(i,j,k,len(mask2), bin_e1[k], bin_e2[k])
-                sumesq += bin_e1[k]**2 + bin_e2[k]**2
-
-        print('rms e = ',np.sqrt(sumesq / nbins))
-        print('ccdnum = ',ccdnum)
-        print('bin_x,y = ',bin_x,bin_y)
-        focal_x, focal_y = toFocal(int(ccdnum), bin_x, bin_y)
-        print('x,y = ',focal_x, focal_y)
-
-        print('num with count > 0 = ',bin_nz.sum())
-        all_x = np.append(all_x, focal_x[bin_nz])
-        all_y = np.append(all_y, focal_y[bin_nz])
-        all_e1 = np.append(all_e1, bin_e1[bin_nz])
-        all_e2 = np.append(all_e2, bin_e2[bin_nz])
-        all_s = np.append(all_s, bin_s[bin_nz])
-
-    return all_x, all_y, all_e1, all_e2, all_s
+    fov = fov_map(ccd, x, y, [e1, e2, s], ['e1', 'e2', 's'], w=w, nwhisk=nwhisk)
+    print('rms e = ',np.sqrt(np.mean(fov['e1']**2 + fov['e2']**2)))
+    return fov['focal_x'], fov['focal_y'], fov['e1'], fov['e2'], fov['s']
 
 
 def make_whiskers(x, y, e1, e2, s, filename, scale=1, auto_size=False, title=None, ref=0.01,
@@ -110,6 +57,10 @@ def make_whiskers(x, y, e1, e2, s, filename, scale=1, auto_size=False, title=Non
     matplotlib.use('Agg') # needs to be done before import pyplot
     import matplotlib.pyplot as plt
 
+    bin_data = [x, y, e1, e2, s, scale, ref, alt_ref]
+    if figure_is_current(filename, bin_data, bbox_inches='tight'):
+        return
+
     plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/supermongo.mplstyle')
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -163,72 +114,65 @@ def make_whiskers(x, y, e1, e2, s, filename, scale=1, auto_size=False, title=Non
 
     #fig.set_size_inches(7.5,4.0)
     #fig.tight_layout()
-    plt.savefig(filename, bbox_inches='tight')
-    print('wrote',filename)
+    save_figure(fig, filename, data=bin_data, bbox_inches='tight')
 
     np.savetxt(os.path.splitext(filename)[0] + '.dat',
                   np.array(zip(x, y, u, v, e1, e2, s)), fmt='%r',
                   header='x  y  u (=e cos(theta/2))  v (=e sin(theta/2))  e1  e2  size')
 
-def psf_whiskers(ccd, x, y, e1, e2, T, de1, de2, dT):
-    psf_binned_data = bin_by_fov(ccd, x, y, e1, e2, T, nwhisk=4)
+def psf_whiskers(psf_map, resid_map):
+    psf_binned_data = whisker_data(psf_map)
     make_whiskers(*psf_binned_data, filename='psf_whiskers.pdf', scale=3, title='PSF',
                   ref=0.01, alt_ref=0.03)
-    resid_binned_data = bin_by_fov(ccd, x, y, de1, de2, dT, nwhisk=4)
+    resid_binned_data = whisker_data(resid_map)
     make_whiskers(*resid_binned_data, filename='resid_whiskers.pdf', scale=0.3, title='PSF residual',
                   ref=0.01, alt_ref=0.03, ref_name=r'$\delta e$')
-    resid_binned_data = bin_by_fov(ccd, x, y, de1, de2, dT, nwhisk=4)
     make_whiskers(*resid_binned_data, filename='sm_resid_whiskers.pdf', scale=3, title='PSF residual',
                   ref=0.01, alt_ref=0.03, ref_name=r'$\delta e$')
 
-def psf_hex(ccd, x, y, e1, e2, T, de1, de2, dT):
+def draw_fov_bins(ax, fov, values, nwhisk, vmin, vmax, cmap='inferno'):
+    """Draw each bin of a fov map as a filled rectangle in focal plane (u,v) coordinates.
+    """
+    from matplotlib.collections import PolyCollection
+    nx = nwhisk
+    ny = 2*nwhisk
+    u0, v0 = toFocalArcmin(fov['ccd'], fov['ix'] * 2048. / nx, fov['iy'] * 4096. / ny)
+    u1, v1 = toFocalArcmin(fov['ccd'], (fov['ix']+1) * 2048. / nx, (fov['iy']+1) * 4096. / ny)
+    verts = np.array([[u0, v0], [u1, v0], [u1, v1], [u0, v1]]).transpose(2, 0, 1)
+    pc = PolyCollection(verts, array=np.asarray(values), cmap=cmap, edgecolors='none')
+    pc.set_clim(vmin, vmax)
+    ax.add_collection(pc)
+    return pc
+
+def psf_hex(fov, nwhisk):
+    """Make maps of the residuals from a fov_map with columns de1, de2, dT, made with the
+    given nwhisk.  Each bin is drawn at its place on its ccd, so there are no gaps between
+    the bins.
+    """
     import matplotlib
     matplotlib.use('Agg') # needs to be done before import pyplot
     import matplotlib.pyplot as plt
 
-    plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/supermongo.mplstyle')
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
+    filename = 'psf_resid_hex.pdf'
+    bin_data = [fov['ccd'], fov['ix'], fov['iy'], fov['de1'], fov['de2'], fov['dT'], nwhisk]
+    if figure_is_current(filename, bin_data, bbox_inches='tight'):
+        return
 
-    u = np.zeros_like(x)
-    v = np.zeros_like(y)
-    for ccdnum in np.unique(ccd):
-        uu, vv = toFocalArcmin(int(ccdnum), x[ccd==ccdnum], y[ccd==ccdnum])
-        u[ccd==ccdnum] = uu
-        v[ccd==ccdnum] = vv
+    plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/supermongo.mplstyle')
 
-    ngrid = 300
     vmax = 0.01
     fig, axs = plt.subplots(ncols=3, sharey=True, figsize=(15, 4))
     fig.subplots_adjust(hspace=0.5, left=0.07, right=0.93)
-    ax = axs[0]
-    hb = ax.hexbin(u, v, de1, gridsize=ngrid, cmap='inferno', vmin=-vmax, vmax=vmax)
-    ax.set_title(r'$\delta e_1$')
-    ax.set_aspect('equal')
-    ax.set_xlim(-75, 75)
-    ax.set_ylim(-75, 75)
-    #cb = fig.colorbar(hb, ax=ax)
-    #cb.set_label('counts')
-
-    ax = axs[1]
-    hb = ax.hexbin(u, v, de2, gridsize=ngrid, cmap='inferno', vmin=-vmax, vmax=vmax)
-    ax.set_title(r'$\delta e_2$')
-    ax.set_aspect('equal')
-    ax.set_xlim(-75, 75)
-    ax.set_ylim(-75, 75)
-    #cb = fig.colorbar(hb, ax=ax)
-
-    ax = axs[2]
-    hb = ax.hexbin(u, v, dT, gridsize=ngrid, cmap='inferno', vmin=-vmax, vmax=vmax)
-    ax.set_title(r'$\delta T/T$')
-    ax.set_aspect('equal')
-    ax.set_xlim(-75, 75)
-    ax.set_ylim(-75, 75)
-    cb = fig.colorbar(hb, ax=ax)
+    for ax, name, title in zip(axs, ['de1', 'de2', 'dT'],
+                               [r'$\delta e_1$', r'$\delta e_2$', r'$\delta T/T$']):
+        pc = draw_fov_bins(ax, fov, fov[name], nwhisk, -vmax, vmax)
+        ax.set_title(title)
+        ax.set_aspect('equal')
+        ax.set_xlim(-75, 75)
+        ax.set_ylim(-75, 75)
+    cb = fig.colorbar(pc, ax=axs[2])
 
-    filename = 'psf_resid_hex.pdf'
-    plt.savefig(filename, bbox_inches='tight')
-    print('wrote',filename)
+    save_figure(fig, filename, data=bin_data, bbox_inches='tight')
 
 
 def main():
@@ -239,6 +183,7 @@ def main():
     # Make the work directory if it does not exist yet.
     work = os.path.expanduser(args.work)
     print('work dir = ',work)
+    start_figure_workers(args.nproc)
     try:
         if not os.path.isdir(work):
             os.makedirs(work)
@@ -265,21 +210,33 @@ def main():
 
     keys = ['ra', 'dec', 'x', 'y', 'mag', 'obs_e1', 'obs_e2', 'obs_T',
             prefix+'_e1', prefix+'_e2', prefix+'_T']
-    data, bands, tilings = read_data(exps, work, keys, limit_bands=args.bands, prefix=prefix,
-                                        use_reserved=args.use_reserved, frac=args.frac)
-    e1 = data['obs_e1']
-    e2 = data['obs_e2']
-    T = data['obs_T']
-    p_e1 = data[prefix+'_e1']
-    p_e2 = data[prefix+'_e2']
-    p_T = data[prefix+'_T']
-
-    de1 = e1-p_e1
-    de2 = e2-p_e2
-    dT = (T-p_T)/T
-
-    psf_whiskers(data['ccd'], data['x'], data['y'], e1, e2, T, de1, de2, dT)
-    psf_hex(data['ccd'], data['x'], data['y'], e1, e2, T, de1, de2, dT)
+
+    # Only read the catalog if one of the maps isn't already made.
+    all_data = []
+    def get_data():
+        if len(all_data) == 0:
+            data, bands, tilings = read_data(exps, work, keys, limit_bands=args.bands,
+                                             prefix=prefix, use_reserved=args.use_reserved,
+                                             frac=args.frac)
+            all_data.append(data)
+        return all_data[0]
+
+    spec_kwargs = dict(bands=args.bands, prefix=prefix, use_reserved=args.use_reserved,
+                       max_mag=args.max_mag, frac=args.frac, exps=exps)
+    psf_map = get_fov_map(work, fov_map_spec('psf', nwhisk=4, **spec_kwargs), get_data,
+                          remake=args.remake_maps)
+    resid_map = get_fov_map(work, fov_map_spec('resid', nwhisk=4, **spec_kwargs), get_data,
+                            remake=args.remake_maps)
+    psf_whiskers(psf_map, resid_map)
+
+    # Use fine bins for the residual maps.
+    hex_nwhisk = 16
+    hex_map = get_fov_map(work, fov_map_spec('resid', nwhisk=hex_nwhisk, min_count=0, skip_ccds=(),
+                                             **spec_kwargs),
+                          get_data, remake=args.remake_maps)
+    psf_hex(hex_map, hex_nwhisk)
+
+    finish_figures()
 
 if __name__ == "__main__":
     main()
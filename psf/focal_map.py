@@ -0,0 +1,210 @@
+# Bin quantities over the DES focal plane.
+# Each star is assigned a single bin id from its (ccd, ix, iy), and then all the requested
+# quantities are reduced at once with binned_stats, rather than looping over ccds and bins.
+
+from __future__ import print_function
+import os
+import hashlib
+import numpy as np
+from binned_stats import bin_index, binned_stats
+from toFocal import toFocal, toFocalArcmin
+
+MAX_CCD = 62
+
+
+def fov_map(ccd, x, y, cols, names, w=None, nwhisk=5, min_count=100, skip_ccds=(31,61)):
+    """Compute the (weighted) mean of some quantities in bins over the focal plane.
+
+    Each ccd is divided into nwhisk bins in x and 2*nwhisk bins in y.
+
+    Parameters:
+        ccd, x, y:  The ccdnum and chip position (in pixels) of each star.
+        cols:       A list of arrays to bin.
+        names:      The names to use for these columns in the output.
+        w:          Optional weights for each star. [default: None]
+        nwhisk:     The number of bins across the short side of each ccd. [default: 5]
+        min_count:  Skip any ccd with fewer than this many stars. [default: 100]
+        skip_ccds:  Skip these ccds entirely. [default: (31,61)]
+
+    Returns:
+        A recarray with one row per non-empty bin, ordered by ccd, then ix, then iy, with
+        columns ccd, ix, iy, count, x, y (mean chip position), focal_x, focal_y (in mm),
+        u, v (in arcmin), and then each of names along with name_err.
+    """
+    ccd = np.asarray(ccd).astype(int)
+    nx = nwhisk
+    ny = 2*nwhisk
+    x_bins = np.linspace(0,2048,nx+1)
+    y_bins = np.linspace(0,4096,ny+1)
+
+    ix = bin_index(x, x_bins)
+    iy = bin_index(y, y_bins)
+    # Anything off the chip gets an invalid index, so binned_stats will ignore it.
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    index = np.where(inside, (ccd * nx + ix) * ny + iy, -1)
+    nbins = (MAX_CCD+1) * nx * ny
+
+    count, mean, var, err = binned_stats(index, nbins, [x, y] + list(cols), w=w)
+
+    # Apply the per-ccd cuts.
+    ccd_count = np.bincount(ccd, minlength=MAX_CCD+1)
+    bin_ccd = np.arange(nbins) // (nx * ny)
+    use = count > 0
+    use &= ccd_count[bin_ccd] >= min_count
+    use &= ~np.in1d(bin_ccd, skip_ccds)
+    if w is not None:
+        sumw = np.bincount(index[inside], weights=np.asarray(w)[inside], minlength=nbins)
+        use &= sumw > 0
+    k = np.where(use)[0]
+    print('fov_map: %d non-empty bins from %d stars'%(len(k), np.sum(inside)))
+
+    out_names = ['ccd', 'ix', 'iy', 'count', 'x', 'y', 'focal_x', 'focal_y', 'u', 'v']
+    out_names += list(names) + [ name + '_err' for name in names ]
+    formats = ['i2', 'i2', 'i2', 'i4'] + ['f8'] * (len(out_names)-4)
+    fov = np.recarray(shape=(len(k),), formats=formats, names=out_names)
+    fov['ccd'] = bin_ccd[k]
+    fov['ix'] = (k // ny) % nx
+    fov['iy'] = k % ny
+    fov['count'] = count[k]
+    fov['x'] = mean[0,k]
+    fov['y'] = mean[1,k]
+    fov['focal_x'], fov['focal_y'] = toFocal(fov['ccd'], fov['x'], fov['y'])
+    fov['u'], fov['v'] = toFocalArcmin(fov['ccd'], fov['x'], fov['y'])
+    for i, name in enumerate(names):
+        fov[name] = mean[i+2,k]
+        fov[name + '_err'] = err[i+2,k]
+    return fov
+
+
+# The columns that go into each kind of map.
+QUANTITIES = {
+    'psf' : ['e1', 'e2', 'T'],
+    'resid' : ['de1', 'de2', 'dT'],
+}
+
+# How each item in the binning spec is stored in the fits header.
+SPEC_KEYS = [
+    ('quantity', 'QUANTITY'),
+    ('bands', 'BANDS'),
+    ('prefix', 'PREFIX'),
+    ('use_reserved', 'RESERVED'),
+    ('max_mag', 'MAXMAG'),
+    ('nwhisk', 'NWHISK'),
+    ('min_count', 'MINCOUNT'),
+    ('skip_ccds', 'SKIPCCDS'),
+    ('frac', 'FRAC'),
+    ('exps', 'EXPSHASH'),
+]
+
+
+def exps_hash(exps):
+    """A short hash of a list of exposures, which doesn't depend on their order.
+    """
+    return hashlib.sha1('\n'.join(sorted(str(e) for e in exps)).encode()).hexdigest()[:12]
+
+
+def fov_map_spec(quantity, bands, prefix='piff', use_reserved=False, max_mag=0, nwhisk=5,
+                 min_count=100, skip_ccds=(31,61), frac=1., exps=()):
+    """Make a dict with everything that determines the contents of a fov map.
+
+    quantity is either 'psf' (e1, e2, T of the observed stars) or 'resid' (de1, de2, dT/T
+    relative to the model).  max_mag <= 0 means no magnitude cut.  frac is the random
+    fraction of the stars that was used and exps the list of exposures, which is stored as
+    a hash.
+    """
+    if quantity not in QUANTITIES:
+        raise ValueError('Invalid quantity %s. Must be one of %s'%(quantity, list(QUANTITIES)))
+    return dict(quantity=quantity, bands=bands, prefix=prefix, use_reserved=bool(use_reserved),
+                max_mag=float(max_mag),
+                nwhisk=int(nwhisk), min_count=int(min_count),
+                skip_ccds=','.join(str(c) for c in skip_ccds),
+                frac=float(frac), exps=exps_hash(exps))
+
+
+def fov_map_file(work, spec):
+    """The file name to use for the map with the given spec.
+    """
+    name = 'fov_%s_%s_%s_n%d'%(spec['prefix'], spec['quantity'], spec['bands'], spec['nwhisk'])
+    name += '_c%d'%spec['min_count']
+    name += '_skip%s'%(spec['skip_ccds'].replace(',','-') or 'none')
+    if spec['use_reserved']:
+        name += '_reserved'
+    if spec['max_mag'] > 0:
+        name += '_m%s'%spec['max_mag']
+    if spec['frac'] < 1:
+        name += '_f%s'%spec['frac']
+    name += '_' + spec['exps']
+    return os.path.join(work, name + '.fits')
+
+
+def make_fov_map(data, spec):
+    """Build the fov map for the given spec from a star catalog as returned by read_data.
+    """
+    prefix = spec['prefix']
+    mask = np.in1d(data['band'].astype(str), list(spec['bands']))
+    if spec['max_mag'] > 0:
+        mask &= data['mag'] < spec['max_mag']
+    data = data[mask]
+
+    e1 = data['obs_e1']
+    e2 = data['obs_e2']
+    T = data['obs_T']
+    if spec['quantity'] == 'psf':
+        cols = [e1, e2, T]
+    else:
+        cols = [e1 - data[prefix+'_e1'], e2 - data[prefix+'_e2'], (T - data[prefix+'_T'])/T]
+
+    skip_ccds = [ int(c) for c in spec['skip_ccds'].split(',') if c != '' ]
+    return fov_map(data['ccd'], data['x'], data['y'], cols, QUANTITIES[spec['quantity']],
+                   nwhisk=spec['nwhisk'], min_count=spec['min_count'], skip_ccds=skip_ccds)
+
+
+def write_fov_map(file_name, fov, spec):
+    """Write a fov map to a fits file, with the binning spec in the header.
+    """
+    import fitsio
+    header = [ dict(name=hkey, value=spec[key]) for key, hkey in SPEC_KEYS ]
+    fitsio.write(file_name, fov, header=header, extname='fov', clobber=True)
+    print('wrote',file_name)
+
+
+def read_fov_map(file_name, spec=None):
+    """Read a fov map from a fits file.
+
+    If spec is given, the spec in the file has to match it.  If it doesn't, or if the file
+    doesn't exist, this returns None.
+    """
+    import fitsio
+    if not os.path.exists(file_name):
+        return None
+    fov, header = fitsio.read(file_name, ext='fov', header=True)
+    if spec is not None:
+        for key, hkey in SPEC_KEYS:
+            if header.get(hkey) != spec[key]:
+                print('%s has %s = %s, not %s.'%(file_name, key, header.get(hkey), spec[key]))
+                return None
+    print('read',file_name)
+    return fov.view(np.recarray)
+
+
+def get_fov_map(work, spec, get_data, remake=False):
+    """Read the fov map for this spec if it has already been made.  Otherwise make it and
+    write it out for next time.
+
+    get_data is a function that returns the star catalog.  It is only called if the map
+    actually needs to be made.
+    """
+    file_name = fov_map_file(work, spec)
+    fov = None if remake else read_fov_map(file_name, spec)
+    if fov is None:
+        fov = make_fov_map(get_data(), spec)
+        write_fov_map(file_name, fov, spec)
+    return fov
+
+
+def whisker_data(fov):
+    """Get the focal plane position and the three binned quantities from a fov map,
+    in the order that make_whiskers wants them.
+    """
+    names = fov.dtype.names[10:13]
+    return (fov['focal_x'], fov['focal_y']) + tuple(fov[name] for name in names)
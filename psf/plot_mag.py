@@ -10,6 +10,9 @@ import galsim
 import json
 import numpy as np
 from read_psf_cats import read_data, band_combinations
+from binned_stats import bin_index, binned_stats
+from focal_map import fov_map_spec, get_fov_map, whisker_data
+from figure_output import save_figure, figure_is_current, start_figure_workers, finish_figures
 
 plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/supermongo.mplstyle')
 
@@ -41,6 +44,10 @@ def parse_args():
                         help='Limit to the given bands')
     parser.add_argument('--frac', default=1., type=float,
                         help='Choose a random fraction of the input stars')
+    parser.add_argument('--nproc', default=1, type=int,
+                        help='Number of processes to use for rendering the figures')
+    parser.add_argument('--remake_maps', default=False, action='store_const', const=True,
+                        help='Remake the binned fov maps even if they already exist')
 
     args = parser.parse_args()
     return args
@@ -90,35 +97,16 @@ def bin_by_mag(m, dT, de1, de2, min_mused):
     mag_bins = np.linspace(min_mag,max_mag,71)
     print('mag_bins = ',mag_bins)
 
-    index = np.digitize(m, mag_bins)
+    index = bin_index(m, mag_bins)
     print('len(index) = ',len(index))
-    bin_de1 = [de1[index == i].mean() for i in range(1, len(mag_bins))]
-    print('bin_de1 = ',bin_de1)
-    bin_de2 = [de2[index == i].mean() for i in range(1, len(mag_bins))]
-    print('bin_de2 = ',bin_de2)
-    bin_dT = [dT[index == i].mean() for i in range(1, len(mag_bins))]
-    print('bin_dT = ',bin_dT)
-    bin_de1_err = [ np.sqrt(de1[index == i].var() / len(de1[index == i]))
-                    for i in range(1, len(mag_bins)) ]
+    count, mean, var, err = binned_stats(index, len(mag_bins)-1, [de1, de2, dT])
+    bin_de1, bin_de2, bin_dT = mean
+    bin_de1_err, bin_de2_err, bin_dT_err = err
+    print('count = ',count)
     print('bin_de1_err = ',bin_de1_err)
-    bin_de2_err = [ np.sqrt(de2[index == i].var() / len(de2[index == i]))
-                    for i in range(1, len(mag_bins)) ]
     print('bin_de2_err = ',bin_de2_err)
-    bin_dT_err = [ np.sqrt(dT[index == i].var() / len(dT[index == i]))
-                    for i in range(1, len(mag_bins)) ]
     print('bin_dT_err = ',bin_dT_err)
 
-    # Fix up nans
-    for i in range(1,len(mag_bins)):
-        if i not in index:
-            bin_de1[i-1] = 0.
-            bin_de2[i-1] = 0.
-            bin_dT[i-1] = 0.
-            bin_de1_err[i-1] = 0.
-            bin_de2_err[i-1] = 0.
-            bin_dT_err[i-1] = 0.
-    print('fixed nans')
-
     print('index = ',index)
     print('bin_de1 = ',bin_de1)
     print('bin_de2 = ',bin_de2)
@@ -140,6 +128,8 @@ def read_bins(infile):
     return data
 
 def plot_bins(data, outfile, min_mused=None):
+    if figure_is_current(outfile, list(data) + [min_mused]):
+        return
     mag_bins, bin_dT, bin_dT_err, bin_de1, bin_de1_err, bin_de2, bin_de2_err = data
 
     fig, axes = plt.subplots(2,1, sharex=True)
@@ -174,7 +164,7 @@ def plot_bins(data, outfile, min_mused=None):
 
     fig.set_size_inches(7.0,10.0)
     plt.tight_layout()
-    plt.savefig(outfile)
+    save_figure(fig, outfile, data=list(data) + [min_mused])
 
 
 def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
@@ -190,40 +180,26 @@ def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
 
     x_bins = np.linspace(0,xmax,129)
     print('x_bins = ',x_bins)
-    index = np.digitize(x, x_bins)
+    index = bin_index(x, x_bins)
     print('len(index) = ',len(index))
-    bin_de1 = [de1[index == i].mean() for i in range(1, len(x_bins))]
-    print('bin_de1 = ',bin_de1)
-    bin_de2 = [de2[index == i].mean() for i in range(1, len(x_bins))]
-    print('bin_de2 = ',bin_de2)
-    bin_dT = [dT[index == i].mean() for i in range(1, len(x_bins))]
-    print('bin_dT = ',bin_dT)
-    bin_de1_err = [ np.sqrt(de1[index == i].var() / len(de1[index == i]))
-                    for i in range(1, len(x_bins)) ]
+    count, mean, var, err = binned_stats(index, len(x_bins)-1, [de1, de2, dT])
+    bin_de1, bin_de2, bin_dT = mean
+    bin_de1_err, bin_de2_err, bin_dT_err = err
+    print('count = ',count)
     print('bin_de1_err = ',bin_de1_err)
-    bin_de2_err = [ np.sqrt(de2[index == i].var() / len(de2[index == i]))
-                    for i in range(1, len(x_bins)) ]
     print('bin_de2_err = ',bin_de2_err)
-    bin_dT_err = [ np.sqrt(dT[index == i].var() / len(dT[index == i]))
-                    for i in range(1, len(x_bins)) ]
     print('bin_dT_err = ',bin_dT_err)
 
-    # Fix up nans
-    for i in range(1,len(x_bins)):
-        if i not in index:
-            bin_de1[i-1] = 0.
-            bin_de2[i-1] = 0.
-            bin_dT[i-1] = 0.
-            bin_de1_err[i-1] = 0.
-            bin_de2_err[i-1] = 0.
-            bin_dT_err[i-1] = 0.
-    print('fixed nans')
-
     print('index = ',index)
     print('bin_de1 = ',bin_de1)
     print('bin_de2 = ',bin_de2)
     print('bin_dT = ',bin_dT)
 
+    bin_data = [x_bins, bin_dT, bin_dT_err, bin_de1, bin_de1_err, bin_de2, bin_de2_err]
+    names = [ pre + xy + post + '_' + bands for pre in ['dsize_', 'de_'] for post in ['', '2'] ]
+    if all(figure_is_current(name, bin_data) for name in names):
+        return
+
     plt.clf()
     plt.title('PSF Size residuals')
     plt.xlim(0,xmax)
@@ -232,9 +208,7 @@ def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
     plt.errorbar(x_bins[2:-3], bin_dT[2:-2], yerr=bin_dT_err[2:-2], color='blue', fmt='o')
     plt.xlabel('Chip '+xy+' position')
     plt.ylabel('$size_{psf} - size_{model}$')
-    plt.savefig('dsize_'+xy+'_' + bands + '.png')
-    plt.savefig('dsize_'+xy+'_' + bands + '.pdf')
-    plt.savefig('dsize_'+xy+'_' + bands + '.eps')
+    save_figure(plt.gcf(), 'dsize_'+xy+'_' + bands, data=bin_data)
 
     plt.clf()
     plt.title('PSF Ellipticity residuals')
@@ -246,9 +220,7 @@ def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
     plt.legend([e1_line, e2_line], [r'$e_1$', r'$e_2$'])
     plt.xlabel('Chip '+xy+' position')
     plt.ylabel('$e_{psf} - e_{model}$')
-    plt.savefig('de_'+xy+'_' + bands + '.png')
-    plt.savefig('de_'+xy+'_' + bands + '.pdf')
-    plt.savefig('de_'+xy+'_' + bands + '.eps')
+    save_figure(plt.gcf(), 'de_'+xy+'_' + bands, data=bin_data)
 
     # Make broken x-axis.
     plt.clf()
@@ -270,9 +242,7 @@ def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
     ax.xaxis.set_label_coords(1.08,-0.05)
     ax.set_ylabel('$size_{psf} - size_{model}$')
 
-    plt.savefig('dsize_'+xy+'2_' + bands + '.png')
-    plt.savefig('dsize_'+xy+'2_' + bands + '.pdf')
-    plt.savefig('dsize_'+xy+'2_' + bands + '.eps')
+    save_figure(plt.gcf(), 'dsize_'+xy+'2_' + bands, data=bin_data)
 
     plt.clf()
     f, (ax,ax2) = plt.subplots(1,2,sharey=True)
@@ -296,65 +266,20 @@ def bin_by_chip_pos(x, dT, de1, de2, bands, xy):
     ax.xaxis.set_label_coords(1.08,-0.05)
     ax.set_ylabel('$e_{psf} - e_{model}$')
 
-    plt.savefig('de_'+xy+'2_' + bands + '.png')
-    plt.savefig('de_'+xy+'2_' + bands + '.pdf')
-    plt.savefig('de_'+xy+'2_' + bands + '.eps')
+    save_figure(plt.gcf(), 'de_'+xy+'2_' + bands, data=bin_data)
 
 
-def bin_by_fov(ccd, x, y, dT, de1, de2, bands):
+def bin_by_fov(fov, bands):
+    """Make a whisker plot from a fov map (cf. focal_map.py).
+    """
 
     import numpy as np
     import matplotlib.pyplot as plt
-    from toFocal import toFocal
-
-    all_x = np.array([])
-    all_y = np.array([])
-    all_e1 = np.array([])
-    all_e2 = np.array([])
-    all_T = np.array([])
-
-    nwhisk = 5
-    x_bins = np.linspace(0,2048,nwhisk+1)
-    y_bins = np.linspace(0,4096,2*nwhisk+1)
-
-    ccdnums = np.unique(ccd)
-    for ccdnum in ccdnums:
-        mask = np.where(ccd == ccdnum)[0]
-        print('ccdnum = ',ccdnum,', nstar = ',mask.sum())
-        if mask.sum() < 100: continue
-
-        x_index = np.digitize(x[mask], x_bins)
-        y_index = np.digitize(y[mask], y_bins)
-
-        bin_de1 = np.array([ de1[mask][(x_index == i) & (y_index == j)].mean()
-                    for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_de1 = ',bin_de1)
-        bin_de2 = np.array([ de2[mask][(x_index == i) & (y_index == j)].mean()
-                    for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_de2 = ',bin_de2)
-        bin_dT = np.array([ dT[mask][(x_index == i) & (y_index == j)].mean()
-                    for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_dT = ',bin_dT)
-        bin_x = np.array([ x[mask][(x_index == i) & (y_index == j)].mean()
-                  for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_x = ',bin_x)
-        bin_y = np.array([ y[mask][(x_index == i) & (y_index == j)].mean()
-                  for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_y = ',bin_y)
-        bin_count = np.array([ ((x_index == i) & (y_index == j)).sum()
-                      for i in range(1, len(x_bins)) for j in range(1, len(y_bins)) ])
-        print('bin_count = ',bin_count)
-
-        focal_x, focal_y = toFocal(ccdnum, bin_x, bin_y)
-
-        mask2 = np.where(bin_count > 0)[0]
-        print('num with count > 0 = ',mask2.sum())
-        all_x = np.append(all_x, focal_x[mask2])
-        all_y = np.append(all_y, focal_y[mask2])
-        all_e1 = np.append(all_e1, bin_de1[mask2])
-        all_e2 = np.append(all_e2, bin_de2[mask2])
-        all_T = np.append(all_T, bin_dT[mask2])
 
+    all_x, all_y, all_e1, all_e2, all_T = whisker_data(fov)
+    bin_data = [all_x, all_y, all_e1, all_e2]
+    if figure_is_current('de_fov_' + bands, bin_data):
+        return
 
     plt.clf()
     #plt.title('PSF Ellipticity residuals in DES focal plane')
@@ -378,9 +303,7 @@ def bin_by_fov(ccd, x, y, dT, de1, de2, bands):
                   coordinates='axes', color='darkred', labelcolor='darkred',
                   labelpos='E', fontproperties={'size':'x-small'})
     plt.axis('off')
-    plt.savefig('de_fov_' + bands + '.png')
-    plt.savefig('de_fov_' + bands + '.pdf')
-    plt.savefig('de_fov_' + bands + '.eps')
+    save_figure(plt.gcf(), 'de_fov_' + bands, data=bin_data)
 
 def make_hist(dT, T, de1, de2, bands):
 
@@ -412,6 +335,7 @@ def main():
 
     work = os.path.expanduser(args.work)
     print('work dir = ',work)
+    start_figure_workers(args.nproc)
 
     if args.file != '':
         print('Read file ',args.file)
@@ -554,8 +478,16 @@ def main():
         #bin_by_chip_pos(x[used], dT[used], de1[used], de2[used], bands, 'x')
         #bin_by_chip_pos(y[used], dT[used], de1[used], de2[used], bands, 'y')
 
-        #bin_by_fov(ccd[used], x[used], y[used], dT[used], de1[used], de2[used], bands)
-        #bin_by_fov(ccd[used], x[used], y[used], T[used], e1[used], e2[used], bands + 'raw')
+        #spec_kwargs = dict(prefix=prefix, use_reserved=args.use_reserved, nwhisk=5, min_count=100,
+        #                   skip_ccds=())
+        #resid_map = get_fov_map(work, fov_map_spec('resid', bands, **spec_kwargs),
+        #                        lambda: this_data, remake=args.remake_maps)
+        #bin_by_fov(resid_map, bands)
+        #psf_map = get_fov_map(work, fov_map_spec('psf', bands, **spec_kwargs),
+        #                      lambda: this_data, remake=args.remake_maps)
+        #bin_by_fov(psf_map, bands + 'raw')
+
+    finish_figures()
 
 
 if __name__ == "__main__":
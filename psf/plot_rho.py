@@ -9,6 +9,10 @@ matplotlib.use('Agg') # Don't use X-server.  Must be before importing matplotlib
 import matplotlib.pyplot as plt
 import os
 import sys
+from figure_output import save_figure, figure_is_current, start_figure_workers, finish_figures
+from rho_store import make_exp_record, make_ccd_record, append_records, read_store, read_header
+from rho_store import latest_records, has_rho, RHO_NAMES
+from rho_store import stream_mean_var, stream_sum
 
 #plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/supermongo.mplstyle')
 plt.style.use('/astro/u/mjarvis/.config/matplotlib/stylelib/SVA1StyleSheet.mplstyle')
@@ -33,6 +37,8 @@ def parse_args():
                         help='list of exposures to run')
     parser.add_argument('--runs', default='', nargs='+',
                         help='list of runs')
+    parser.add_argument('--nproc', default=1, type=int,
+                        help='Number of processes to use for rendering the figures')
 
     args = parser.parse_args()
     return args
@@ -286,6 +292,77 @@ def plot_corr_tt(meanr, corr, sig):
     plt.yscale('log', nonposy='clip')
     plt.tight_layout()
 
+def add_missing_exposures(work, runs, exps, exp_store):
+    """Add any exposures that aren't in the rho stores yet from their json and psf_cats files.
+
+    Exposures measured by the current run_rho.py are already in the stores, so this is only
+    needed for older runs.  Each one only needs to be read once.  Exposures with a psf_cats
+    file but no json file are added with NaN for the rho statistics, so their stars are
+    still counted in the histograms.
+    """
+    cat_dir = os.path.join(work,'psf_cats')
+    exp_file = os.path.join(work, 'rho_exp.dat')
+    ccd_file = os.path.join(work, 'rho_ccd.dat')
+    done = set() if exp_store is None else set(numpy.asarray(exp_store['expnum']))
+    nexp = len(exps)
+
+    no_json = []
+    iexp = 0
+    for run,exp in zip(runs,exps):
+        iexp += 1
+        expnum = int(exp[6:])
+        if expnum in done:
+            continue
+        print 'Add run, exp = ',run,exp,'  ',iexp,'/',nexp
+
+        cat_file = os.path.join(cat_dir, exp + "_psf.fits")
+        try:
+            with pyfits.open(cat_file) as pyf:
+                data = pyf[1].data
+        except IOError as e:
+            print 'Caught exception: ',e
+            print 'skipping this exposure'
+            continue
+
+        stat_file = os.path.join(work, exp, exp + ".json")
+        if not os.path.exists(stat_file):
+            print stat_file,' not found'
+            print 'No JSON file for this exposure.  Only using it for the histograms.'
+            no_json.append((expnum, data))
+            continue
+        print('Read %s'%stat_file)
+        with open(stat_file,'r') as f:
+            stats = json.load(f)
+
+        mask = data['flag'] == 0
+        de1 = data['obs_e1'][mask] - data['piff_e1'][mask]
+        de2 = data['obs_e2'][mask] - data['piff_e2'][mask]
+        ( expnum, meanlogr, rho1p, rho1p_im, rho1m, rho1m_im, var1, var1m,
+          rho2p, rho2p_im, rho2m, rho2m_im, var2, var2m, rho3p, var3, var3m ) = stats[-1][:17]
+        rho = dict(meanlogr=meanlogr, rho1p=rho1p, rho1m=rho1m, rho2p=rho2p, rho2m=rho2m,
+                   rho3p=rho3p, var1=var1, var2=var2, var3=var3)
+        append_records(exp_file, make_exp_record(expnum, de1, de2, data['ccdnum'][mask], rho))
+
+        ccd_recs = []
+        for s in stats[:-1]:
+            ccdnum, meanlogr, rho1p, rho1m, rho2p, rho2m, rho3p = s[:7]
+            rho = dict(meanlogr=meanlogr, rho1p=rho1p, rho1m=rho1m, rho2p=rho2p, rho2m=rho2m,
+                       rho3p=rho3p)
+            ccd_recs.append(make_ccd_record(expnum, ccdnum, rho))
+        if len(ccd_recs) > 0:
+            append_records(ccd_file, numpy.concatenate(ccd_recs))
+
+    # These need the number of bins in the store, so can only be added once there is one.
+    if len(no_json) > 0 and os.path.exists(exp_file):
+        kind, nbins = read_header(exp_file)
+        rho = dict( (name, numpy.nan * numpy.ones(nbins)) for name in RHO_NAMES )
+        for expnum, data in no_json:
+            mask = data['flag'] == 0
+            de1 = data['obs_e1'][mask] - data['piff_e1'][mask]
+            de2 = data['obs_e2'][mask] - data['piff_e2'][mask]
+            append_records(exp_file, make_exp_record(expnum, de1, de2, data['ccdnum'][mask], rho))
+
+
 def plot_single_rho(args,work):
     # Plot rho stats for one ccd at at time
 
@@ -298,181 +375,40 @@ def plot_single_rho(args,work):
         runs = args.runs
         exps = args.exps
 
-    nexp = len(exps)
-    cat_dir = os.path.join(work,'psf_cats')
+    exp_store = read_store(os.path.join(work, 'rho_exp.dat'))
+    add_missing_exposures(work, runs, exps, exp_store)
+    exp_store = read_store(os.path.join(work, 'rho_exp.dat'))
+    ccd_store = read_store(os.path.join(work, 'rho_ccd.dat'))
+    if exp_store is None:
+        print 'No rho statistics found in ',work
+        return
+
+    # Only use the requested exposures.  (The store may have others.)  If an exposure was
+    # run more than once, only use its latest records.
+    expnums = [ int(exp[6:]) for exp in exps ]
+    exp_store = latest_records(exp_store, expnums)
+    if ccd_store is not None:
+        ccd_store = latest_records(ccd_store, expnums)
 
     if True:
-        ccd_meanlogr = numpy.empty( (nexp*62,37) )
-        ccd_rho1p = numpy.empty( (nexp*62,37) )
-        ccd_rho1m = numpy.empty( (nexp*62,37) )
-        ccd_rho2p = numpy.empty( (nexp*62,37) )
-        ccd_rho2m = numpy.empty( (nexp*62,37) )
-        ccd_rho3 = numpy.empty( (nexp*62,37) )
-        exp_meanlogr = numpy.empty( (nexp,53) )
-        exp_rho1p = numpy.empty( (nexp,53) )
-        exp_rho1m = numpy.empty( (nexp,53) )
-        exp_rho2p = numpy.empty( (nexp,53) )
-        exp_rho2m = numpy.empty( (nexp,53) )
-        exp_rho3 = numpy.empty( (nexp,53) )
-        exp_var1 = numpy.empty( (nexp,53) )
-        exp_var2 = numpy.empty( (nexp,53) )
-        exp_var3 = numpy.empty( (nexp,53) )
-        exp_var4 = numpy.empty( (nexp,53) )
-        desdm_meanlogr = numpy.empty( (nexp,53) )
-        desdm_rho1p = numpy.empty( (nexp,53) )
-        desdm_rho1m = numpy.empty( (nexp,53) )
-        desdm_rho2p = numpy.empty( (nexp,53) )
-        desdm_rho2m = numpy.empty( (nexp,53) )
-        desdm_rho3 = numpy.empty( (nexp,53) )
-        desdm_var1 = numpy.empty( (nexp,53) )
-        desdm_var2 = numpy.empty( (nexp,53) )
-        desdm_var3 = numpy.empty( (nexp,53) )
-        desdm_var4 = numpy.empty( (nexp,53) )
-
-        meande1 = 0
-        meande2 = 0
-        varde1 = 0
-        varde2 = 0
-        nde = 0
-        histde1 = numpy.zeros(200)  # bin size = 1.e-3
-        histde2 = numpy.zeros(200)  # bin size = 1.e-3
-        histnstars = numpy.zeros(200)  # bin size = 10
-        listnstars = []
-        meannstars = 0
-        ngoodccd = 0
-
-        iexp = 0
-        iccd = 0
-        for run,exp in zip(runs,exps):
-
-            print 'Start work on run, exp = ',run,exp
-            expnum = int(exp[6:])
-            print 'expnum = ',expnum,'  ',iexp,'/',nexp,'  ',iccd
-
-            exp_dir = os.path.join(work,exp)
-
-            cat_file = os.path.join(cat_dir, exp + "_psf.fits")
-            try:
-                with pyfits.open(cat_file) as pyf:
-                    data = pyf[1].data
-            except IOError as e:
-                print 'Caught exception: ',e
-                print 'skipping this exposure'
-                continue
-            ccdnums = numpy.unique(data['ccdnum'])
-            for ccdnum in ccdnums:
-                nstars = ((data['ccdnum'] == ccdnum) & (data['flag'] == 0)).sum()
-                if nstars > 0 and nstars < 2000:
-                    histnstars[ int(numpy.floor(nstars/10)) ] += 1
-                if nstars > 0:
-                    meannstars += nstars
-                    ngoodccd += 1
-                    listnstars.append(nstars)
-            mask = data['flag'] == 0
-            de1 = data['obs_e1'][mask] - data['piff_e1'][mask]
-            de2 = data['obs_e2'][mask] - data['piff_e2'][mask]
-            meande1 += numpy.sum(de1)
-            meande2 += numpy.sum(de2)
-            varde1 += numpy.sum(de1*de1)
-            varde2 += numpy.sum(de2*de2)
-            nde += len(de1)
-            histde1 += numpy.histogram(de1, bins=200, range=(-1.e-1,1.e-1))[0]
-            histde2 += numpy.histogram(de2, bins=200, range=(-1.e-1,1.e-1))[0]
-
-            stat_file = os.path.join(exp_dir, exp + ".json")
-
-            # Read the json file 
-            if not os.path.exists(stat_file):
-                print stat_file,' not found'
-                print 'No JSON file for this exposure.  Skipping.'
-                continue
-            print('Read %s'%stat_file)
-            with open(stat_file,'r') as f:
-                stats = json.load(f)
-
-            print "len stats = ",len(stats)
-            ( expnum, 
-              rho1_meanlogr,
-              rho1_xip,
-              rho1_xip_im,
-              rho1_xim,
-              rho1_xim_im,
-              rho1_varxip,
-              rho1_varxim,
-              rho2_xip,
-              rho2_xip_im,
-              rho2_xim,
-              rho2_xim_im,
-              rho2_varxip,
-              rho2_varxim,
-              rho3_xi,
-              rho3_varxip,
-              rho3_varxim,
-              drho1_meanlogr,
-              drho1_xip,
-              drho1_xip_im,
-              drho1_xim,
-              drho1_xim_im,
-              drho1_varxip,
-              drho1_varxim,
-              drho2_xip,
-              drho2_xip_im,
-              drho2_xim,
-              drho2_xim_im,
-              drho2_varxip,
-              drho2_varxim,
-              drho3_xi,
-              drho3_varxip,
-              drho3_varxim,
-            ) = stats[-1]
-            exp_meanlogr[iexp,:] = rho1_meanlogr
-            exp_rho1p[iexp,:] = rho1_xip
-            exp_rho1m[iexp,:] = rho1_xim
-            exp_rho2p[iexp,:] = rho2_xip
-            exp_rho2m[iexp,:] = rho2_xim
-            exp_rho3[iexp,:] = rho3_xi
-            exp_var1[iexp,:] = rho1_varxip
-            exp_var2[iexp,:] = rho2_varxip
-            exp_var3[iexp,:] = rho3_varxip
-            desdm_meanlogr[iexp,:] = drho1_meanlogr
-            desdm_rho1p[iexp,:] = drho1_xip
-            desdm_rho1m[iexp,:] = drho1_xim
-            desdm_rho2p[iexp,:] = drho2_xip
-            desdm_rho2m[iexp,:] = drho2_xim
-            desdm_rho3[iexp,:] = drho3_xi
-            desdm_var1[iexp,:] = drho1_varxip
-            desdm_var2[iexp,:] = drho2_varxip
-            desdm_var3[iexp,:] = drho3_varxip
-            iexp += 1
- 
-            for s in stats[:-1]:
-
-                ( ccdnum, 
-                  rho1_meanlogr,
-                  rho1_xip,
-                  rho1_xim,
-                  rho2_xip,
-                  rho2_xim,
-                  rho3_xi,
-                ) = s
-
-                ccd_meanlogr[iccd,:] = rho1_meanlogr
-                ccd_rho1p[iccd,:] = rho1_xip
-                ccd_rho1m[iccd,:] = rho1_xim
-                ccd_rho2p[iccd,:] = rho2_xip
-                ccd_rho2m[iccd,:] = rho2_xim
-                ccd_rho3[iccd,:] = rho3_xi
-                iccd += 1
-
         print '\nFinished processing all exposures'
-        nexp = iexp
+        totals = stream_sum(exp_store, ['nde', 'sum_de1', 'sum_de2', 'sumsq_de1', 'sumsq_de2',
+                                        'hist_de1', 'hist_de2'])
+        nde = totals['nde']
+        histde1 = totals['hist_de1']
+        histde2 = totals['hist_de2']
+
+        nstars = numpy.asarray(exp_store['nstars']).flatten()
+        listnstars = nstars[nstars > 0]
+        histnstars = numpy.bincount(listnstars[listnstars < 2000] // 10, minlength=200)
+        meannstars = numpy.sum(listnstars)
+        ngoodccd = len(listnstars)
 
-        nccd = iccd
         # Compute some stats and plot histograms
-        meande1 /= nde
-        meande2 /= nde
-        varde1 -= nde * meande1**2
-        varde2 -= nde * meande2**2
+        meande1 = totals['sum_de1'] / nde
+        meande2 = totals['sum_de2'] / nde
+        varde1 = totals['sumsq_de1'] - nde * meande1**2
+        varde2 = totals['sumsq_de2'] - nde * meande2**2
         varde1 /= nde
         varde2 /= nde
         print 'nde = ',nde
@@ -524,20 +460,25 @@ def plot_single_rho(args,work):
         print 'mean nstars = ',sum(listnstars)/len(listnstars)
         print 'median nstars = ',listnstars[len(listnstars)//2]
 
+    # The rest only uses the exposures with rho statistics.
+    use = has_rho(exp_store)
+    if not numpy.all(use):
+        exp_store = exp_store[use]
 
     if False:
         # Plots for CCDs
-        print 'nccd = ',nccd
+        print 'nccd = ',len(ccd_store)
+        stats, nccd = stream_mean_var(ccd_store)
         sqrtn = numpy.sqrt(nccd)
-        meanr = numpy.exp(numpy.mean(ccd_meanlogr[:nccd,:], axis=0))
-        rho1p = numpy.mean(ccd_rho1p[:nccd,:], axis=0)
-        rho1m = numpy.mean(ccd_rho1m[:nccd,:], axis=0)
-        rho2p = numpy.mean(ccd_rho2p[:nccd,:], axis=0)
-        rho2m = numpy.mean(ccd_rho2m[:nccd,:], axis=0)
-        sig_rho1p = numpy.std(ccd_rho1p[:nccd,:], axis=0)
-        sig_rho1m = numpy.std(ccd_rho1m[:nccd,:], axis=0)
-        sig_rho2p = numpy.std(ccd_rho2p[:nccd,:], axis=0)
-        sig_rho2m = numpy.std(ccd_rho2m[:nccd,:], axis=0)
+        meanr = numpy.exp(stats['meanlogr'][0])
+        rho1p = stats['rho1p'][0]
+        rho1m = stats['rho1m'][0]
+        rho2p = stats['rho2p'][0]
+        rho2m = stats['rho2m'][0]
+        sig_rho1p = numpy.sqrt(stats['rho1p'][1])
+        sig_rho1m = numpy.sqrt(stats['rho1m'][1])
+        sig_rho2p = numpy.sqrt(stats['rho2p'][1])
+        sig_rho2m = numpy.sqrt(stats['rho2m'][1])
         print 'meanr = ',meanr
         print 'rho1p = ',rho1p
         print 'sig_rho1p = ',sig_rho1p
@@ -563,17 +504,18 @@ def plot_single_rho(args,work):
 
     if True:
         # Plots for exposures:
-        print 'nexp = ',nexp
+        print 'nexp = ',len(exp_store)
+        stats, nexp = stream_mean_var(exp_store)
         sqrtn = numpy.sqrt(nexp)
-        meanr = numpy.exp(numpy.mean(exp_meanlogr[:nexp,:], axis=0))
-        rho1p = numpy.mean(exp_rho1p[:nexp,:], axis=0)
-        rho1m = numpy.mean(exp_rho1m[:nexp,:], axis=0)
-        rho2p = numpy.mean(exp_rho2p[:nexp,:], axis=0)
-        rho2m = numpy.mean(exp_rho2m[:nexp,:], axis=0)
-        sig_rho1p = numpy.std(exp_rho1p[:nexp,:], axis=0)
-        sig_rho1m = numpy.std(exp_rho1m[:nexp,:], axis=0)
-        sig_rho2p = numpy.std(exp_rho2p[:nexp,:], axis=0)
-        sig_rho2m = numpy.std(exp_rho2m[:nexp,:], axis=0)
+        meanr = numpy.exp(stats['meanlogr'][0])
+        rho1p = stats['rho1p'][0]
+        rho1m = stats['rho1m'][0]
+        rho2p = stats['rho2p'][0]
+        rho2m = stats['rho2m'][0]
+        sig_rho1p = numpy.sqrt(stats['rho1p'][1])
+        sig_rho1m = numpy.sqrt(stats['rho1m'][1])
+        sig_rho2p = numpy.sqrt(stats['rho2p'][1])
+        sig_rho2m = numpy.sqrt(stats['rho2m'][1])
         print 'meanr = ',meanr
         print 'rho1p = ',rho1p
         print 'sig_rho1p = ',sig_rho1p
@@ -612,22 +554,22 @@ def plot_single_rho(args,work):
     if False:
         # Plots for worst rho1 exposure:
         # Find worst exposure based on rho2 at theta = 10 arcmin
-        i = numpy.argmax(numpy.abs(exp_rho1p[:nexp,k10arcmin]), axis=0)
+        i = numpy.argmax(numpy.abs(exp_store['rho1p'][:,k10arcmin]), axis=0)
         print 'k10arcmin = ',k10arcmin
-        print 'rho1[k] = ',exp_rho1p[:nexp,k10arcmin]
-        print 'rho2[k] = ',exp_rho2p[:nexp,k10arcmin]
+        print 'rho1[k] = ',exp_store['rho1p'][:,k10arcmin]
+        print 'rho2[k] = ',exp_store['rho2p'][:,k10arcmin]
         print 'i = ',i
-        print 'rho1[i] = ',exp_rho1p[i,:]
-        meanr = numpy.exp(exp_meanlogr[i,:])
-        rho1p = exp_rho1p[i,:]
-        rho1m = exp_rho1m[i,:]
-        rho2p = exp_rho2p[i,:]
+        print 'rho1[i] = ',exp_store['rho1p'][i]
+        meanr = numpy.exp(exp_store['meanlogr'][i])
+        rho1p = exp_store['rho1p'][i]
+        rho1m = exp_store['rho1m'][i]
+        rho2p = exp_store['rho2p'][i]
         print 'rho2p = ',rho2p
-        rho2m = exp_rho2m[i,:]
-        sig_rho1p = numpy.sqrt(exp_var1[i,:])
-        sig_rho1m = numpy.sqrt(exp_var1[i,:])
-        sig_rho2p = numpy.sqrt(exp_var2[i,:])
-        sig_rho2m = numpy.sqrt(exp_var2[i,:])
+        rho2m = exp_store['rho2m'][i]
+        sig_rho1p = numpy.sqrt(exp_store['var1'][i])
+        sig_rho1m = numpy.sqrt(exp_store['var1'][i])
+        sig_rho2p = numpy.sqrt(exp_store['var2'][i])
+        sig_rho2m = numpy.sqrt(exp_store['var2'][i])
 
         plt.clf()
         plt.title(r'$\rho_1$ for exposure with worst $\rho_1$ at 10 arcmin')
@@ -649,22 +591,22 @@ def plot_single_rho(args,work):
 
         # Plots for worst rho2 exposure:
         # Find worst exposure based on rho2 at theta = 10 arcmin
-        i = numpy.argmax(numpy.abs(exp_rho2p[:nexp,k10arcmin]), axis=0)
+        i = numpy.argmax(numpy.abs(exp_store['rho2p'][:,k10arcmin]), axis=0)
         print 'k10arcmin = ',k10arcmin
-        print 'rho1[k] = ',exp_rho1p[:nexp,k10arcmin]
-        print 'rho2[k] = ',exp_rho2p[:nexp,k10arcmin]
+        print 'rho1[k] = ',exp_store['rho1p'][:,k10arcmin]
+        print 'rho2[k] = ',exp_store['rho2p'][:,k10arcmin]
         print 'i = ',i
-        print 'rho2[i] = ',exp_rho2p[i,:]
-        meanr = numpy.exp(exp_meanlogr[i,:])
-        rho1p = exp_rho1p[i,:]
-        rho1m = exp_rho1m[i,:]
-        rho2p = exp_rho2p[i,:]
+        print 'rho2[i] = ',exp_store['rho2p'][i]
+        meanr = numpy.exp(exp_store['meanlogr'][i])
+        rho1p = exp_store['rho1p'][i]
+        rho1m = exp_store['rho1m'][i]
+        rho2p = exp_store['rho2p'][i]
         print 'rho2p = ',rho2p
-        rho2m = exp_rho2m[i,:]
-        sig_rho1p = numpy.sqrt(exp_var1[i,:])
-        sig_rho1m = numpy.sqrt(exp_var1[i,:])
-        sig_rho2p = numpy.sqrt(exp_var2[i,:])
-        sig_rho2m = numpy.sqrt(exp_var2[i,:])
+        rho2m = exp_store['rho2m'][i]
+        sig_rho1p = numpy.sqrt(exp_store['var1'][i])
+        sig_rho1m = numpy.sqrt(exp_store['var1'][i])
+        sig_rho2p = numpy.sqrt(exp_store['var2'][i])
+        sig_rho2m = numpy.sqrt(exp_store['var2'][i])
 
         plt.clf()
         plt.title(r'$\rho_1$ for exposure with worst $\rho_2$ at 10 arcmin')
@@ -686,17 +628,20 @@ def plot_single_rho(args,work):
 
     if False:
         # Plots for desdm:
-        print 'nexp = ',nexp
+        # This needs a store made from the DESDM PSFEx catalogs.
+        desdm_store = read_store(os.path.join(work, 'rho_exp_desdm.dat'))
+        print 'nexp = ',len(desdm_store)
+        stats, nexp = stream_mean_var(desdm_store)
         sqrtn = numpy.sqrt(nexp)
-        meanr = numpy.exp(numpy.mean(desdm_meanlogr[:nexp,:], axis=0))
-        rho1p = numpy.mean(desdm_rho1p[:nexp,:], axis=0)
-        rho1m = numpy.mean(desdm_rho1m[:nexp,:], axis=0)
-        rho2p = numpy.mean(desdm_rho2p[:nexp,:], axis=0)
-        rho2m = numpy.mean(desdm_rho2m[:nexp,:], axis=0)
-        sig_rho1p = numpy.std(desdm_rho1p[:nexp,:], axis=0)
-        sig_rho1m = numpy.std(desdm_rho1m[:nexp,:], axis=0)
-        sig_rho2p = numpy.std(desdm_rho2p[:nexp,:], axis=0)
-        sig_rho2m = numpy.std(desdm_rho2m[:nexp,:], axis=0)
+        meanr = numpy.exp(stats['meanlogr'][0])
+        rho1p = stats['rho1p'][0]
+        rho1m = stats['rho1m'][0]
+        rho2p = stats['rho2p'][0]
+        rho2m = stats['rho2m'][0]
+        sig_rho1p = numpy.sqrt(stats['rho1p'][1])
+        sig_rho1m = numpy.sqrt(stats['rho1m'][1])
+        sig_rho2p = numpy.sqrt(stats['rho2p'][1])
+        sig_rho2m = numpy.sqrt(stats['rho2m'][1])
         print 'meanr = ',meanr
         print 'rho1p = ',rho1p
         print 'sig_rho1p = ',sig_rho1p
@@ -732,14 +677,14 @@ def plot_single_rho(args,work):
 
     if False:
         # Do some counts of how many exposures have high rho2
-        count5 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 5.e-4).sum()
-        count4 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 4.e-4).sum()
-        count3 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 3.e-4).sum()
-        count2 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 2.e-4).sum()
-        count1 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 1.e-4).sum()
-        count05 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 5.e-5).sum()
-        count03 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 3.e-5).sum()
-        count02 = (numpy.abs(exp_rho2p[:nexp,k10arcmin]) > 2.e-5).sum()
+        count5 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 5.e-4).sum()
+        count4 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 4.e-4).sum()
+        count3 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 3.e-4).sum()
+        count2 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 2.e-4).sum()
+        count1 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 1.e-4).sum()
+        count05 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 5.e-5).sum()
+        count03 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 3.e-5).sum()
+        count02 = (numpy.abs(exp_store['rho2p'][:,k10arcmin]) > 2.e-5).sum()
 
         print 'Exposure outliers:'
         print 'N with |rho2| > 5e-4 = ',count5
@@ -751,19 +696,19 @@ def plot_single_rho(args,work):
         print 'N with |rho2| > 3e-5 = ',count03
         print 'N with |rho2| > 2e-5 = ',count02
 
-        count100 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 1.e-2).sum()
-        count50 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 5.e-3).sum()
-        count30 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 3.e-3).sum()
-        count20 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 2.e-3).sum()
-        count10 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 1.e-3).sum()
-        count5 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 5.e-4).sum()
-        count4 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 4.e-4).sum()
-        count3 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 3.e-4).sum()
-        count2 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 2.e-4).sum()
-        count1 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 1.e-4).sum()
-        count05 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 5.e-5).sum()
-        count03 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 3.e-5).sum()
-        count02 = (numpy.abs(ccd_rho2p[:nexp,k10arcmin]) > 2.e-5).sum()
+        count100 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 1.e-2).sum()
+        count50 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 5.e-3).sum()
+        count30 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 3.e-3).sum()
+        count20 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 2.e-3).sum()
+        count10 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 1.e-3).sum()
+        count5 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 5.e-4).sum()
+        count4 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 4.e-4).sum()
+        count3 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 3.e-4).sum()
+        count2 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 2.e-4).sum()
+        count1 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 1.e-4).sum()
+        count05 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 5.e-5).sum()
+        count03 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 3.e-5).sum()
+        count02 = (numpy.abs(ccd_store['rho2p'][:,k10arcmin]) > 2.e-5).sum()
 
         print 'CCD outliers:'
         print 'N with |rho2| > 1e-2 = ',count100
@@ -798,6 +743,7 @@ def plot_overall_rho(work):
     #keys += [ 'fov_' + k for k in base_keys ]
     #keys += [ 'alt_' + k for k in base_keys ]
     #keys += [ 'altoddeven_' + k for k in base_keys ]
+    #keys += [ 'preview_' + k for k in base_keys ]
 
     for key in keys:
         stat_file = os.path.join(work, "rho_" + key + ".json")
@@ -811,8 +757,19 @@ def plot_overall_rho(work):
             stats = json.load(f)
 
         #print' stats = ',stats
+        cov = None
+        info = {}
         if len(stats) == 1:  # I used to save a list of length 1 that in turn was a list
             stats = stats[0]
+        elif len(stats) == 2 and isinstance(stats[1], dict):  # Extra info about the run
+            info = stats[1]
+            stats = stats[0]
+            if 'cov' in info:
+                print('Using %s covariance'%info['var_method'])
+                cov = numpy.array(info['cov'])
+            if 'frac' in info:
+                print('Used a fraction %s of the stars. Noise inflated by ~%.1f'%(
+                        info['frac'], info['noise_inflation']))
 
         print('len(stats) = ',len(stats))
         ( meanlogr,
@@ -866,6 +823,14 @@ def plot_overall_rho(work):
         sig_rho5 = numpy.sqrt(var5p)
         sqrtn = 1
 
+        if cov is not None:
+            # The covariance has [xip, xim] for each rho in turn, so the xip variances are the
+            # first nbins diagonal elements of each block of 2*nbins.
+            nbins = len(meanlogr)
+            var = numpy.diagonal(cov)
+            sig = [ numpy.sqrt(var[2*k*nbins:(2*k+1)*nbins]) for k in range(6) ]
+            sig_rho1, sig_rho2, sig_rho3, sig_rho4, sig_rho5 = sig[:5]
+
         #print 'meanr = ',meanr
 
         cols = [meanr,
@@ -892,36 +857,50 @@ def plot_overall_rho(work):
             rho0p = numpy.array(rho0p)
             rho0m = numpy.array(rho0m)
             sig_rho0 = numpy.sqrt(var0p)
+            if cov is not None:
+                sig_rho0 = sig[5]
             cols += [rho0p, rho0m, sig_rho0]
             header += 'rho0  rho0_xim  sig_rho0  '
 
+        if 'frac' in info:
+            header = ('frac = %s  noise_inflation = %.2f\n'%(info['frac'], info['noise_inflation'])
+                      + header)
+
         outfile = 'rho_' + key + '.dat'
         numpy.savetxt(outfile, numpy.array(cols), fmt='%.6e', header=header)
         print 'wrote',outfile
  
-        plt.clf()
-        pretty_rho1(meanr, rho1p, sig_rho1, sqrtn, rho3p, sig_rho3, rho4p, sig_rho4,
-                    gband=(key.endswith('g')))
-        plt.savefig('rho1_' + key + '.pdf')
+        gband = key.endswith('g')
+        rho1_data = [meanr, rho1p, sig_rho1, sqrtn, rho3p, sig_rho3, rho4p, sig_rho4, gband]
+        if not figure_is_current('rho1_' + key + '.pdf', rho1_data):
+            plt.clf()
+            pretty_rho1(meanr, rho1p, sig_rho1, sqrtn, rho3p, sig_rho3, rho4p, sig_rho4,
+                        gband=gband)
+            save_figure(plt.gcf(), 'rho1_' + key + '.pdf', data=rho1_data)
 
-        plt.clf()
-        pretty_rho2(meanr, rho2p, sig_rho2, sqrtn, rho5p, sig_rho5,
-                    gband=(key.endswith('g')))
-        plt.savefig('rho2_' + key + '.pdf')
+        rho2_data = [meanr, rho2p, sig_rho2, sqrtn, rho5p, sig_rho5, gband]
+        if not figure_is_current('rho2_' + key + '.pdf', rho2_data):
+            plt.clf()
+            pretty_rho2(meanr, rho2p, sig_rho2, sqrtn, rho5p, sig_rho5, gband=gband)
+            save_figure(plt.gcf(), 'rho2_' + key + '.pdf', data=rho2_data)
 
         if len(stats) > 31:
-            plt.clf()
-            pretty_rho0(meanr, rho0p, sig_rho0, sqrtn)
-            plt.savefig('rho0_' + key + '.pdf')
+            rho0_data = [meanr, rho0p, sig_rho0, sqrtn]
+            if not figure_is_current('rho0_' + key + '.pdf', rho0_data):
+                plt.clf()
+                pretty_rho0(meanr, rho0p, sig_rho0, sqrtn)
+                save_figure(plt.gcf(), 'rho0_' + key + '.pdf', data=rho0_data)
 
         if len(stats) > 37:
             corr_tt, var_corr_tt = stats[37:39]
             corr_tt = numpy.array(corr_tt)
             sig_corr_tt = numpy.sqrt(var_corr_tt)
 
-            plt.clf()
-            plot_corr_tt(meanr, corr_tt, sig_corr_tt)
-            plt.savefig('corrtt_' + key + '.pdf')
+            corrtt_data = [meanr, corr_tt, sig_corr_tt]
+            if not figure_is_current('corrtt_' + key + '.pdf', corrtt_data):
+                plt.clf()
+                plot_corr_tt(meanr, corr_tt, sig_corr_tt)
+                save_figure(plt.gcf(), 'corrtt_' + key + '.pdf', data=corrtt_data)
 
 
 def main():
@@ -933,10 +912,13 @@ def main():
 
     work = os.path.expanduser(args.work)
     print 'work dir = ',work
+    start_figure_workers(args.nproc)
 
     #plot_single_rho(args,work)
 
     plot_overall_rho(work)
+
+    finish_figures()
  
 
 if __name__ == "__main__":
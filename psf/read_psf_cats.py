@@ -39,7 +39,56 @@ def old_read_ccd_data(expcat, work, expnum):
     return all_data, ccdnums
 
 
-def read_data(exps, work, keys, limit_bands=None, prefix='piff', use_reserved=False, frac=1.):
+def stratified_sample(mag, frac, mag_bin=0.5):
+    """Select a random fraction frac of the rows, keeping that fraction in each magnitude bin.
+
+    The number to keep in each bin is rounded up or down at random, so the expected number
+    is exactly frac times the number in the bin.
+
+    Returns the sorted indices of the selected rows.
+    """
+    index = np.floor(np.nan_to_num(mag) / mag_bin).astype(int)
+    # Sorting a random permutation by bin leaves the rows in random order within each bin.
+    order = np.random.permutation(len(index))
+    order = order[np.argsort(index[order], kind='mergesort')]
+    bins, start, counts = np.unique(index[order], return_index=True, return_counts=True)
+    nkeep = np.floor(frac * counts + np.random.random(len(counts))).astype(int)
+    group = np.repeat(np.arange(len(bins)), counts)
+    rank = np.arange(len(order)) - start[group]
+    return np.sort(order[rank < nkeep[group]])
+
+
+def read_preview(expname, keys, prefix, frac):
+    """Read a stratified random subset of the stars in an exposure catalog.
+
+    Only the mag column is read for all the stars.  Then the selected rows are read for just
+    the columns we need, so most of the file never gets decoded.
+    """
+    with fitsio.FITS(expname) as f:
+        hdu = f['stars']
+        names = hdu.get_colnames()
+        if prefix+'_flag' not in names:
+            return None
+        rows = stratified_sample(hdu.read_column('mag'), frac)
+        columns = set(keys) | set(['ccdnum', prefix+'_flag', 'x', 'y',
+                                   'obs_T', 'obs_e1', 'obs_e2',
+                                   prefix+'_T', prefix+'_e1', prefix+'_e2'])
+        columns = [ c for c in names if c in columns ]
+        if len(rows) == 0:
+            # Still want the right columns, just no rows.
+            return hdu.read(columns=columns, rows=[0] if hdu.get_nrows() > 0 else None)[:0]
+        return hdu.read(columns=columns, rows=rows)
+
+
+def read_data(exps, work, keys, limit_bands=None, prefix='piff', use_reserved=False, frac=1.,
+              preview=False):
+    """Read the star catalogs for the given exposures.
+
+    If preview is True (and frac < 1), a fraction frac of the stars in each exposure is
+    selected at read time, stratified by magnitude, before the full catalog is read.
+    Since each exposure is sampled separately, this is stratified by exposure and band too.
+    Otherwise, frac is applied as a simple random selection of the stars that pass the cuts.
+    """
 
     RESERVED = 64
     NOT_STAR = 128
@@ -138,6 +187,16 @@ def read_data(exps, work, keys, limit_bands=None, prefix='piff', use_reserved=Fa
             mask = ~np.in1d(expcat['ccdnum'], BAD_CCDS)
             mask &= expcat['flag'] == 0
             data, ccdnums = old_read_ccd_data(expcat[mask], work, expnum)
+            if preview:
+                rows = stratified_sample(data['mag'], frac)
+                data = data[rows]
+                ccdnums = ccdnums[rows]
+        elif preview:
+            data = read_preview(expname, keys, prefix, frac)
+            if data is None:
+                print('all ccds are bad.  skip this exposure')
+                continue
+            ccdnums = data['ccdnum'].astype(int)
         else:
             data = fitsio.read(expname, ext='stars')
             ccdnums = data['ccdnum'].astype(int)
@@ -238,7 +297,7 @@ def read_data(exps, work, keys, limit_bands=None, prefix='piff', use_reserved=Fa
         #print('mask = ',len(mask),np.sum(mask),mask)
         mask = np.where(mask)[0]
         #print('mask = ',len(mask),mask)
-        if frac != 1.:
+        if frac != 1. and not preview:
             mask = np.random.choice(mask, int(frac * len(mask)), replace=False)
         #print('mask = ',len(mask),mask)
 
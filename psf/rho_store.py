@@ -0,0 +1,207 @@
+# A compact binary store of the per-exposure (or per-ccd) rho statistics.
+#
+# run_rho.py appends one fixed-size record per exposure as it finishes measuring it, so
+# plot_rho.py can read everything back with a single memmap rather than re-opening every
+# exposure's json and psf_cats files.  The file is a short text header followed by the raw
+# records, so appending is just a write at the end of the file.
+
+from __future__ import print_function
+import os
+import numpy as np
+
+HEADER_SIZE = 64
+MAGIC = 'RHOSTORE'
+MAX_CCD = 62
+NHIST = 200
+
+# The rho columns in each kind of record.
+RHO_NAMES = ['meanlogr', 'rho1p', 'rho1m', 'rho2p', 'rho2m', 'rho3p', 'var1', 'var2', 'var3']
+
+
+def rho_dtype(kind, nbins):
+    """The record dtype for a store of the given kind ('exp' or 'ccd') with nbins radial bins.
+
+    exp records also have the sums needed for the de1, de2 residual histograms and the number
+    of good stars on each ccd.
+    """
+    if kind == 'exp':
+        fields = [ ('expnum', 'i4'), ('nde', 'i4'),
+                   ('sum_de1', 'f8'), ('sum_de2', 'f8'), ('sumsq_de1', 'f8'), ('sumsq_de2', 'f8'),
+                   ('hist_de1', 'i4', (NHIST,)), ('hist_de2', 'i4', (NHIST,)),
+                   ('nstars', 'i4', (MAX_CCD+1,)) ]
+    elif kind == 'ccd':
+        fields = [ ('expnum', 'i4'), ('ccdnum', 'i4') ]
+    else:
+        raise ValueError('Invalid kind %s.  Must be exp or ccd.'%kind)
+    fields += [ (name, 'f8', (nbins,)) for name in RHO_NAMES ]
+    return np.dtype(fields)
+
+
+def make_header(kind, nbins):
+    header = '%s %s %d'%(MAGIC, kind, nbins)
+    return (header + ' ' * (HEADER_SIZE - 1 - len(header)) + '\n').encode('ascii')
+
+
+def read_header(file_name):
+    """Return the kind and nbins of an existing store.
+    """
+    with open(file_name, 'rb') as fin:
+        header = fin.read(HEADER_SIZE).decode('ascii').split()
+    if len(header) != 3 or header[0] != MAGIC:
+        raise IOError('%s is not a rho store file'%file_name)
+    return header[1], int(header[2])
+
+
+def rho_columns(rho1, rho2, rho3):
+    """Get the values to store from the TreeCorr GGCorrelation objects for rho1, rho2, rho3.
+    """
+    return dict(meanlogr=rho1.meanlogr,
+                rho1p=rho1.xip, rho1m=rho1.xim,
+                rho2p=rho2.xip, rho2m=rho2.xim,
+                rho3p=rho3.xip,
+                var1=rho1.varxip, var2=rho2.varxip, var3=rho3.varxip)
+
+
+def make_exp_record(expnum, de1, de2, ccdnum, rho):
+    """Make a record for one exposure.
+
+    de1, de2 are the PSF ellipticity residuals of the (unflagged) stars, ccdnum their ccds,
+    and rho is a dict with the RHO_NAMES columns for the full exposure (cf. rho_columns).
+    """
+    rec = np.zeros(1, dtype=rho_dtype('exp', len(rho['meanlogr'])))
+    rec['expnum'] = expnum
+    rec['nde'] = len(de1)
+    rec['sum_de1'] = np.sum(de1)
+    rec['sum_de2'] = np.sum(de2)
+    rec['sumsq_de1'] = np.sum(de1*de1)
+    rec['sumsq_de2'] = np.sum(de2*de2)
+    rec['hist_de1'] = np.histogram(de1, bins=NHIST, range=(-1.e-1,1.e-1))[0]
+    rec['hist_de2'] = np.histogram(de2, bins=NHIST, range=(-1.e-1,1.e-1))[0]
+    rec['nstars'] = np.bincount(np.asarray(ccdnum).astype(int), minlength=MAX_CCD+1)[:MAX_CCD+1]
+    for name in RHO_NAMES:
+        if name in rho:
+            rec[name] = rho[name]
+    return rec
+
+
+def make_ccd_record(expnum, ccdnum, rho):
+    """Make a record for one ccd.
+    """
+    rec = np.zeros(1, dtype=rho_dtype('ccd', len(rho['meanlogr'])))
+    rec['expnum'] = expnum
+    rec['ccdnum'] = ccdnum
+    for name in RHO_NAMES:
+        if name in rho:
+            rec[name] = rho[name]
+    return rec
+
+
+def append_records(file_name, recs):
+    """Append some records to a store, making the file if it doesn't exist yet.
+
+    The records are written with a single write on a file opened for appending, so several
+    jobs can add their exposures to the same store.
+    """
+    kind = 'ccd' if 'ccdnum' in recs.dtype.names else 'exp'
+    nbins = recs.dtype['meanlogr'].shape[0]
+    try:
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        os.write(fd, make_header(kind, nbins))
+        os.close(fd)
+    except OSError:
+        # Already exists.  Make sure it is compatible.
+        old_kind, old_nbins = read_header(file_name)
+        if (old_kind, old_nbins) != (kind, nbins):
+            raise ValueError('%s has %s records with %d bins, not %s with %d'%(
+                             file_name, old_kind, old_nbins, kind, nbins))
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, recs.tobytes())
+    finally:
+        os.close(fd)
+    print('Added %d records to %s'%(len(recs), file_name))
+
+
+def read_store(file_name):
+    """Open a store as a read-only memmap.  Nothing is actually read until it is used.
+
+    Returns None if the file doesn't exist yet.
+    """
+    if not os.path.exists(file_name):
+        return None
+    kind, nbins = read_header(file_name)
+    dtype = rho_dtype(kind, nbins)
+    nrec = (os.path.getsize(file_name) - HEADER_SIZE) // dtype.itemsize
+    if nrec == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(nrec,))
+
+
+def latest_records(store, expnums=None):
+    """Select the records for the given exposures (or all of them if expnums is None), with
+    only the last record for each exposure, or for each (exposure, ccd) in a ccd store.
+
+    Rerunning an exposure appends new records after the old ones, so the last ones are the
+    current results.  The store is only read in full if some records need to be dropped.
+    """
+    key = np.asarray(store['expnum']).astype(np.int64)
+    if 'ccdnum' in store.dtype.names:
+        key = key * (MAX_CCD+1) + np.asarray(store['ccdnum'])
+    # np.unique returns the first occurrence of each key, so look in reverse.
+    u, index = np.unique(key[::-1], return_index=True)
+    keep = np.sort(len(key) - 1 - index)
+    if expnums is not None:
+        keep = keep[np.in1d(np.asarray(store['expnum'])[keep], expnums)]
+    if len(keep) == len(store):
+        return store
+    return store[keep]
+
+
+def has_rho(store):
+    """Which records have rho statistics.  An exposure with no json file from run_rho is
+    stored with NaN for all the rho columns, so that its stars still go in the histograms.
+    """
+    return np.isfinite(np.asarray(store['meanlogr'])[:,0])
+
+
+def stream_mean_var(store, names=RHO_NAMES, chunk_size=1000):
+    """Compute the mean and variance over records of some columns, reading chunk_size
+    records at a time.
+
+    The chunks are combined with the usual parallel update of the mean and sum of squared
+    deviations, so the results match np.mean and np.var of the full columns.
+
+    Returns a dict name -> (mean, var), along with the number of records.
+    """
+    n = 0
+    mean = {}
+    m2 = {}
+    for start in range(0, len(store), chunk_size):
+        chunk = store[start:start+chunk_size]
+        nc = len(chunk)
+        for name in names:
+            x = np.asarray(chunk[name], dtype=float)
+            mc = np.mean(x, axis=0)
+            m2c = np.sum((x-mc)**2, axis=0)
+            if n == 0:
+                mean[name] = mc
+                m2[name] = m2c
+            else:
+                delta = mc - mean[name]
+                mean[name] = mean[name] + delta * nc / (n+nc)
+                m2[name] = m2[name] + m2c + delta**2 * n * nc / (n+nc)
+        n += nc
+    if n == 0:
+        return {}, 0
+    return dict( (name, (mean[name], m2[name]/n)) for name in names ), n
+
+
+def stream_sum(store, names, chunk_size=1000):
+    """Sum some columns over all the records, reading chunk_size records at a time.
+    """
+    total = dict( (name, 0) for name in names )
+    for start in range(0, len(store), chunk_size):
+        chunk = store[start:start+chunk_size]
+        for name in names:
+            total[name] = total[name] + np.sum(chunk[name], axis=0)
+    return total
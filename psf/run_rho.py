@@ -10,6 +10,7 @@ import galsim
 import json
 import numpy
 import astropy.io.fits as pyfits
+from rho_store import rho_columns, make_exp_record, make_ccd_record, append_records
 
 def parse_args():
     import argparse
@@ -148,6 +149,7 @@ def main():
         print 'ccdnums = ',ccdnums
 
         stats = []
+        ccd_recs = []
 
         for ccdnum in ccdnums:
             print '\nProcessing ', ccdnum
@@ -193,6 +195,8 @@ def main():
                     rho5.xip.tolist(),
                     rho5.xim.tolist(),
                     ])
+                ccd_recs.append(make_ccd_record(expnum, ccdnum,
+                                                rho_columns(rho1, rho2, rho3)))
             print 'len stats = ',len(stats)
 
             if args.single_ccd:
@@ -262,6 +266,15 @@ def main():
         with open(stat_file,'w') as f:
             json.dump(stats, f)
 
+        # Also add this exposure to the binary stores that plot_rho reads.  If it was run
+        # before, plot_rho uses these records rather than the old ones.
+        ccdnum = data['ccdnum'][mask]
+        rec = make_exp_record(expnum, e1-psf_e1, e2-psf_e2, ccdnum,
+                              rho_columns(rho1, rho2, rho3))
+        append_records(os.path.join(work, 'rho_exp.dat'), rec)
+        if len(ccd_recs) > 0:
+            append_records(os.path.join(work, 'rho_ccd.dat'), numpy.concatenate(ccd_recs))
+
     print '\nFinished processing all exposures'
 
 
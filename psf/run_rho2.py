@@ -34,6 +34,8 @@ def parse_args():
                         help='Limit to the given bands')
     parser.add_argument('--frac', default=1., type=float,
                         help='Choose a random fraction of the input stars')
+    parser.add_argument('--preview', default=False, action='store_const', const=True,
+                        help='Sample frac of the stars at read time for a fast approximate run')
     parser.add_argument('--opt', default=None, type=str,
                         help='option to change binning [lucas, fine_bin]')
     parser.add_argument('--write_data', default=False, action='store_const', const=True,
@@ -44,14 +46,44 @@ def parse_args():
                         help='Calculate rho0 as well')
     parser.add_argument('--max_mag', default=20, 
                         help='Maximum star magnitude to use for rho stats')
+    parser.add_argument('--var_method', default='shot', type=str,
+                        help='How to estimate the covariance [shot, jackknife, bootstrap]')
+    parser.add_argument('--npatch', default=0, type=int,
+                        help='Number of k-means patches to use for the covariance')
+    parser.add_argument('--patch_key', default=None, type=str,
+                        help='Use this column (e.g. tiling) for the patches rather than k-means')
+    parser.add_argument('--nproc', default=1, type=int,
+                        help='Number of tiling pairs to run at once for the cross-tiling stats')
 
     args = parser.parse_args()
     return args
 
 
+def make_patches(data, npatch=0, patch_key=None):
+    """Figure out the patch arguments to use for the treecorr Catalogs.
+
+    If patch_key is given, each distinct value of that column (e.g. tiling or exp) becomes
+    one patch.  Otherwise, if npatch > 0, the first catalog will run k-means to find npatch
+    patches and the rest will use its patch_centers.
+
+    Returns the patch array (or None) and the number of patches.
+    """
+    if patch_key is not None:
+        vals, patch = np.unique(data[patch_key], return_inverse=True)
+        print('Using %d values of %s as patches'%(len(vals), patch_key))
+        return patch, len(vals)
+    else:
+        return None, npatch
+
+
 def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
-                alt_tt=False, opt=None, subtract_mean=False, do_rho0=False):
+                alt_tt=False, opt=None, subtract_mean=False, do_rho0=False,
+                var_method='shot', npatch=0, patch_key=None):
     """Compute the rho statistics
+
+    If var_method is jackknife or bootstrap, the catalogs are split into patches (either
+    npatch k-means patches or the distinct values of data[patch_key]), and the full
+    covariance matrix of all the rho statistics is returned as the last item in the list.
     """
     import treecorr
 
@@ -63,7 +95,15 @@ def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
     p_T = data[prefix+'_T']
     m = data['mag']
 
+    patch = None
+    if var_method != 'shot':
+        patch, npatch = make_patches(data, npatch, patch_key)
+        if patch is None and npatch == 0:
+            raise ValueError('var_method=%s requires either npatch or patch_key'%var_method)
+
     if max_mag > 0:
+        if patch is not None:
+            patch = patch[m<max_mag]
         e1 = e1[m<max_mag]
         e2 = e2[m<max_mag]
         T = T[m<max_mag]
@@ -103,10 +143,7 @@ def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
             y = y[m<max_mag]
         print('x = ',x)
         print('y = ',y)
-
-        ecat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=e1, g2=e2)
-        qcat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=q1, g2=q2)
-        wcat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=w1, g2=w2, k=dt)
+        pos = dict(x=x, y=y, x_units='arcsec', y_units='arcsec')
     else:
         ra = data['ra']
         dec = data['dec']
@@ -115,10 +152,19 @@ def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
             dec = dec[m<max_mag]
         print('ra = ',ra)
         print('dec = ',dec)
+        pos = dict(ra=ra, dec=dec, ra_units='deg', dec_units='deg')
 
-        ecat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=e1, g2=e2)
-        qcat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=q1, g2=q2)
-        wcat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=w1, g2=w2, k=dt)
+    if var_method == 'shot':
+        ecat = treecorr.Catalog(g1=e1, g2=e2, **pos)
+    elif patch is not None:
+        pos['patch'] = patch
+        ecat = treecorr.Catalog(g1=e1, g2=e2, **pos)
+    else:
+        # Run k-means once on the first catalog and use the same patches for the others.
+        ecat = treecorr.Catalog(g1=e1, g2=e2, npatch=npatch, **pos)
+        pos['patch_centers'] = ecat.patch_centers
+    qcat = treecorr.Catalog(g1=q1, g2=q2, **pos)
+    wcat = treecorr.Catalog(g1=w1, g2=w2, k=dt, **pos)
 
     ecat.name = 'ecat'
     qcat.name = 'qcat'
@@ -147,6 +193,11 @@ def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
         bin_config['max_sep'] = 2000.
         bin_config['bin_size'] = 0.01
 
+    if var_method != 'shot':
+        # The per-patch pair counts are accumulated in the same traversal, so the jackknife
+        # or bootstrap estimate doesn't need any extra runs.
+        bin_config['var_method'] = var_method
+
 
     pairs = [ (qcat, qcat),
               (ecat, qcat),
@@ -176,11 +227,21 @@ def measure_rho(data, max_sep, max_mag, tag=None, use_xy=False, prefix='piff',
         rho.process(dtcat)
         results.append(rho)
 
+    if var_method != 'shot':
+        # The full cross-covariance of all the rho stats.  The data vector is the
+        # concatenation of [xip, xim] for each rho (and xi for the KK correlation).
+        cov = treecorr.estimate_multi_cov(results, var_method)
+        print('sqrt(diag(cov)) = ',np.sqrt(np.diagonal(cov)))
+        results.append(cov)
+
     return results
 
 
-def measure_cross_rho(tile_data, max_sep, tags=None, prefix='piff', opt=None):
+def measure_cross_rho(tile_data, max_sep, tags=None, prefix='piff', opt=None, nproc=1,
+                      return_pairs=False):
     """Compute the rho statistics
+
+    If return_pairs is True, also return the per-pair correlations for each rho stat.
     """
     import treecorr
 
@@ -232,6 +293,7 @@ def measure_cross_rho(tile_data, max_sep, tags=None, prefix='piff', opt=None):
         bin_config['bin_size'] = 0.01
 
     results = []
+    pair_results = []
     for (catlist1, catlist2) in [ (qcats, qcats),
                                   (ecats, qcats),
                                   (dtcats, dtcats),
@@ -241,22 +303,104 @@ def measure_cross_rho(tile_data, max_sep, tags=None, prefix='piff', opt=None):
         catnames1 = [ cat.name for cat in catlist1 ]
         catnames2 = [ cat.name for cat in catlist2 ]
         print('Doing correlation of %s vs %s'%(catnames1, catnames2))
-        rho = treecorr.GGCorrelation(bin_config, verbose=2)
-        # Avoid all auto correlations:
-        for i in range(ntilings):
-            for j in range(ntilings):
-                if i == j: continue
-                if catlist1 is catlist2 and i > j: continue
-                print('names: ',catlist1[i].name,catlist2[j].name)
-                rho.process_cross(catlist1[i], catlist2[j])
-        varg1 = treecorr.calculateVarG(catlist1)
-        varg2 = treecorr.calculateVarG(catlist2)
-        rho.finalize(varg1, varg2)
+        rho, pairs = process_tiling_pairs(bin_config, catlist1, catlist2, nproc=nproc)
         results.append(rho)
+        pair_results.append(pairs)
 
-    return results
+    if return_pairs:
+        return results, pair_results
+    else:
+        return results
+
+def process_tiling_pairs(bin_config, catlist1, catlist2, nproc=1):
+    """Compute the GG correlation of catlist1 vs catlist2 using only the off-diagonal pairs.
 
-def write_stats(stat_file, rho1, rho2, rho3, rho4, rho5, rho0=None, corr_tt=None):
+    Each catalog keeps its tree for the whole loop, so each tiling's tree is only built once,
+    and each pair is done as a separate correlation so we also get the contribution from each
+    pair of tilings.  If nproc > 1, the pairs are run in parallel using a thread pool, with
+    the cores split between the pool and TreeCorr's OpenMP threads.
+
+    Returns the total correlation and a dict of the individual ones, keyed by (i,j).
+    """
+    import treecorr
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    if nproc > 1:
+        bin_config = dict(bin_config)
+        bin_config['num_threads'] = max(1, multiprocessing.cpu_count() // nproc)
+
+    ntilings = len(catlist1)
+    # Avoid all auto correlations:
+    ij = [ (i,j) for i in range(ntilings) for j in range(ntilings)
+           if i != j and not (catlist1 is catlist2 and i > j) ]
+
+    # Build the trees here, one catalog at a time, with the same sizes process_cross will ask
+    # for.  Otherwise the threads would each build the tree of a tiling they share.
+    rho = treecorr.GGCorrelation(bin_config)
+    cats = catlist1 + [ cat for cat in catlist2 if not any(cat is c for c in catlist1) ]
+    for cat in cats:
+        rho._set_metric(None, cat.coords)
+        min_size, max_size = rho._get_minmax_size()
+        cat.getGField(min_size=min_size, max_size=max_size, split_method=rho.split_method,
+                      brute=rho.brute is True or rho.brute == 1,
+                      min_top=rho.min_top, max_top=rho.max_top, coords=rho.coords)
+
+    def process_pair(pair):
+        i, j = pair
+        print('names: ',catlist1[i].name,catlist2[j].name)
+        rho = treecorr.GGCorrelation(bin_config, verbose=1)
+        rho.process_cross(catlist1[i], catlist2[j])
+        return rho
+
+    if nproc > 1:
+        pool = ThreadPool(nproc)
+        pair_rho = pool.map(process_pair, ij)
+        pool.close()
+    else:
+        pair_rho = [ process_pair(pair) for pair in ij ]
+
+    # Add up the raw sums before finalizing anything.
+    rho = treecorr.GGCorrelation(bin_config, verbose=2)
+    for r in pair_rho:
+        rho += r
+    varg1 = treecorr.calculateVarG(catlist1)
+    varg2 = treecorr.calculateVarG(catlist2)
+    rho.finalize(varg1, varg2)
+
+    varg1 = [ treecorr.calculateVarG(cat) for cat in catlist1 ]
+    varg2 = [ treecorr.calculateVarG(cat) for cat in catlist2 ]
+    pairs = {}
+    for (i,j), r in zip(ij, pair_rho):
+        r.finalize(varg1[i], varg2[j])
+        pairs[i,j] = r
+    return rho, pairs
+
+def write_pair_stats(stat_file, pair_results, tags=None):
+    """Write the contribution to each rho stat from each pair of tilings.
+    """
+    import json
+
+    stats = {}
+    for k, pairs in enumerate(pair_results):
+        for (i,j), rho in pairs.items():
+            if tags is not None:
+                key = '%s,%s'%(tags[i], tags[j])
+            else:
+                key = '%d,%d'%(i,j)
+            stats.setdefault(key, {})['rho%d'%(k+1)] = [
+                rho.xip.tolist(),
+                rho.xim.tolist(),
+                rho.varxip.tolist(),
+                rho.npairs.tolist(),
+            ]
+    print('pair stat_file = ',stat_file)
+    with open(stat_file,'w') as fp:
+        json.dump(stats, fp)
+    print('Done writing ',stat_file)
+
+def write_stats(stat_file, rho1, rho2, rho3, rho4, rho5, rho0=None, corr_tt=None, cov=None,
+                var_method='shot', frac=1.):
     import json
 
     stats = [
@@ -307,14 +451,28 @@ def write_stats(stat_file, rho1, rho2, rho3, rho4, rho5, rho0=None, corr_tt=None
             corr_tt.varxi.tolist()
         ])
     #print('stats = ',stats)
+    output = [stats]
+    info = {}
+    if cov is not None:
+        # Order of the rows/columns matches measure_rho: [xip, xim] for rho1..rho5, then rho0.
+        info['var_method'] = var_method
+        info['cov'] = cov.tolist()
+    if frac != 1.:
+        # Only a fraction of the stars was used.  The number of pairs goes as frac**2, so
+        # the shape-noise dominated errors are larger by about 1/frac.
+        info['frac'] = frac
+        info['noise_inflation'] = 1./frac
+    if info:
+        output.append(info)
     print('stat_file = ',stat_file)
     with open(stat_file,'w') as fp:
-        json.dump([stats], fp)
+        json.dump(output, fp)
     print('Done writing ',stat_file)
 
 
 def do_canonical_stats(data, bands, tilings, work, max_mag, prefix='piff', name='all',
-                       alt_tt=False, opt=None, subtract_mean=False, do_rho0=False):
+                       alt_tt=False, opt=None, subtract_mean=False, do_rho0=False,
+                       var_method='shot', npatch=0, patch_key=None, frac=1.):
     print('Start CANONICAL: ',prefix,name)
     # Measure the canonical rho stats using all pairs:
     use_bands = band_combinations(bands)
@@ -327,11 +485,13 @@ def do_canonical_stats(data, bands, tilings, work, max_mag, prefix='piff', name=
         tag = ''.join(band)
         stats = measure_rho(data[mask], max_sep=300, max_mag=max_mag, tag=tag, prefix=prefix,
                             alt_tt=alt_tt, opt=opt, subtract_mean=subtract_mean,
-                            do_rho0=do_rho0)
+                            do_rho0=do_rho0, var_method=var_method, npatch=npatch,
+                            patch_key=patch_key)
+        cov = stats.pop() if var_method != 'shot' else None
         stat_file = os.path.join(work, "rho_%s_%s.json"%(name,tag))
-        write_stats(stat_file,*stats)
+        write_stats(stat_file, *stats, cov=cov, var_method=var_method, frac=frac)
 
-def do_cross_tiling_stats(data, bands, tilings, work, prefix='piff', name='cross'):
+def do_cross_tiling_stats(data, bands, tilings, work, prefix='piff', name='cross', nproc=1):
     print('Start CROSS_TILING: ',prefix,name)
     # Measure the rho stats using only cross-correlations between tiles.
     use_bands = band_combinations(bands)
@@ -345,9 +505,12 @@ def do_cross_tiling_stats(data, bands, tilings, work, prefix='piff', name='cross
             tile_data.append(data[mask])
         tag = ''.join(band)
         tags = [ tag + ":" + str(til) for til in tilings ]
-        stats = measure_cross_rho(tile_data, max_sep=300, tags=tags, prefix=prefix)
+        stats, pairs = measure_cross_rho(tile_data, max_sep=300, tags=tags, prefix=prefix,
+                                         nproc=nproc, return_pairs=True)
         stat_file = os.path.join(work, "rho_%s_%s.json"%(name,tag))
         write_stats(stat_file,*stats)
+        pair_file = os.path.join(work, "rho_%s_pairs_%s.json"%(name,tag))
+        write_pair_stats(pair_file, pairs, tags=tags)
 
 
 def do_cross_band_stats(data, bands, tilings, work, prefix='piff', name='crossband'):
@@ -481,6 +644,12 @@ def main():
 
     out_file_name = os.path.join(work, "psf_%s_%s%s.fits"%(args.tag, args.bands, all_stars))
 
+    if args.preview:
+        out_file_name = out_file_name.replace('.fits', '_frac%s.fits'%args.frac)
+        name = 'preview'
+    else:
+        name = 'all'
+
     data = None
     if not args.write_data:
         try:
@@ -490,7 +659,8 @@ def main():
     if data is None:
         data, bands, tilings = read_data(exps, work, keys,
                                          limit_bands=args.bands, prefix=prefix,
-                                         use_reserved=args.use_reserved, frac=args.frac)
+                                         use_reserved=args.use_reserved, frac=args.frac,
+                                         preview=args.preview)
     if args.write_data:
         write_data_file(data, out_file_name)
 
@@ -518,11 +688,12 @@ def main():
 
     #bands = ['r', 'i']
 
-    do_canonical_stats(data, bands, tilings, work,
+    do_canonical_stats(data, bands, tilings, work, name=name, frac=args.frac,
                        max_mag=args.max_mag, prefix=prefix, opt=args.opt,
-                       subtract_mean=args.subtract_mean, do_rho0=args.do_rho0)
+                       subtract_mean=args.subtract_mean, do_rho0=args.do_rho0,
+                       var_method=args.var_method, npatch=args.npatch, patch_key=args.patch_key)
 
-    #do_cross_tiling_stats(data, bands, tilings, work, prefix=prefix)
+    #do_cross_tiling_stats(data, bands, tilings, work, prefix=prefix, nproc=args.nproc)
 
     #do_cross_band_stats(data, bands, tilings, work, prefix=prefix)
 
@@ -0,0 +1,253 @@
+# Noise bias calibration (NBC) fits for the GREAT-DES simulations.
+#
+# The model is that the error on each measured shape is
+#
+#     e - e_ref = sum_k a_k A_k g + sum_k b_k B_k e_psf
+#
+# where e_ref is either the true shape or the applied shear g, and the A_k and B_k are terms
+# built from the galaxy properties (S/N, size relative to the PSF, whether it is a disc, ...).
+# A Basis says which terms to use, by name, e.g.
+#
+#     Basis(m=['1', 'snr^-2'], c=['snr^-2', 'Tp/Tg snr^-2', '1', 'Tp/Tg'])
+#
+# where each term is a product of the FACTORS below, separated by spaces.
+#
+# The weighted least squares fit is done from the normal equations, which are accumulated
+# chunk_size objects at a time, so the memory needed doesn't depend on the number of objects.
+# cross_validate compares bases by k-fold cross validation, with the folds made of whole
+# simulations so that objects from the same simulation are never on both sides.
+
+import numpy
+from parallel import fork_map
+
+# Each factor is a function of a dict of columns.
+FACTORS = {
+    '1' : lambda d: 1.,
+    'snr^-1' : lambda d: 1. / d['snr'],
+    'snr^-2' : lambda d: 1. / d['snr']**2,
+    'snr^-3' : lambda d: 1. / d['snr']**3,
+    'snr^-4' : lambda d: 1. / d['snr']**4,
+    # Tg/Tp = 1 / ((Tobs-Tp)/Tp) = 1 / (rgp^2-1)
+    'Tp/Tg' : lambda d: 1. / (d['rgp']**2-1),
+    # Tobs / Tg = (Tobs/Tp) / ((Tobs-Tp)/Tp) = rgp^2 / (rgp^2-1)
+    'Tobs/Tg' : lambda d: d['rgp']**2 / (d['rgp']**2-1),
+    # Tp Tg / (Tp^2 + Tg^2) = Tg/Tp / (1 + Tg^2/Tp^2) = (rgp^2-1) / ( (rgp^2-1)^2 + 1)
+    'rgpz' : lambda d: (d['rgp']**2-1) / ((d['rgp']**2-1)**2 + 1),
+    'rgp' : lambda d: d['rgp'],
+    'rgp^2' : lambda d: d['rgp']**2,
+    'disc' : lambda d: d['disc'].astype(float),
+    'cov' : lambda d: d['cov'],
+    'cov^2' : lambda d: d['cov']**2,
+}
+
+
+class Basis(object):
+    """The terms to use for m (multiplying g) and for c (multiplying e_psf).
+    """
+    def __init__(self, m, c):
+        for term in list(m) + list(c):
+            for factor in term.split():
+                if factor not in FACTORS:
+                    raise ValueError("Unknown factor %s in term %s. Must be one of %s"%(
+                                     factor, term, sorted(FACTORS)))
+        self.m = list(m)
+        self.c = list(c)
+
+    def __repr__(self):
+        return 'Basis(m=%r, c=%r)'%(self.m, self.c)
+
+    def __len__(self):
+        return len(self.m) + len(self.c)
+
+    def terms(self, terms, data):
+        """The values of some terms for each object in data.
+        """
+        n = len(data.values()[0])
+        cache = {}
+        values = []
+        for term in terms:
+            v = numpy.ones(n)
+            for factor in term.split():
+                if factor not in cache:
+                    cache[factor] = FACTORS[factor](data)
+                v = v * cache[factor]
+            values.append(v)
+        return values
+
+    def design(self, data, g, e_psf):
+        """The design matrix for some objects: one row per object, one column per term.
+        """
+        cols = [ t * g for t in self.terms(self.m, data) ]
+        cols += [ t * e_psf for t in self.terms(self.c, data) ]
+        return numpy.array(cols).T
+
+    def m_corr(self, fit, data):
+        """The m correction for each object, given the fitted coefficients.
+        """
+        nm = len(self.m)
+        return sum( a * t for a, t in zip(fit[:nm], self.terms(self.m, data)) )
+
+    def c_corr(self, fit, data, e_psf):
+        """The c correction for each object, given the fitted coefficients.
+        """
+        nm = len(self.m)
+        return sum( b * t for b, t in zip(fit[nm:], self.terms(self.c, data)) ) * e_psf
+
+    def snr_lines(self, fit, data, snr):
+        """m and alpha (the coefficient of e_psf) as functions of snr, with the other
+        factors of each term averaged over the objects in data.
+
+        Returns m, alpha.
+        """
+        def line(coeffs, terms):
+            total = numpy.zeros(len(snr))
+            for a, term in zip(coeffs, terms):
+                v = a * numpy.ones(len(snr))
+                other = 1.
+                for factor in term.split():
+                    if factor.startswith('snr'):
+                        v = v * FACTORS[factor]({ 'snr' : snr })
+                    else:
+                        other = other * FACTORS[factor](data)
+                total = total + v * numpy.mean(other)
+            return total
+        nm = len(self.m)
+        return line(fit[:nm], self.m), line(fit[nm:], self.c)
+
+
+# The bases used for the im3shape NBC, and for the fit in terms of Tr(cov).
+NBC_BASIS = Basis(m=['1', 'snr^-2'], c=['snr^-2', 'Tp/Tg snr^-2', '1', 'Tp/Tg'])
+COV_BASIS = Basis(m=['1', 'cov', 'cov^2'], c=['1', 'cov', 'cov^2'])
+
+
+class NormalEquations(object):
+    """The sums needed for a weighted least squares fit of some objects, which can be added
+    together for different sets of objects:
+
+        MtM = M^H W M,  Mtb = M^H W b,  btb = b^H W b,  sw = sum(w),  n = number of objects
+    """
+    def __init__(self, nterm):
+        self.MtM = numpy.zeros((nterm, nterm), dtype=complex)
+        self.Mtb = numpy.zeros(nterm, dtype=complex)
+        self.btb = 0.
+        self.sw = 0.
+        self.n = 0
+
+    def add(self, M, b, w):
+        Mw = M.conjugate().T * w
+        self.MtM += Mw.dot(M)
+        self.Mtb += Mw.dot(b)
+        self.btb += numpy.sum(w * numpy.abs(b)**2)
+        self.sw += numpy.sum(w)
+        self.n += len(b)
+
+    def __iadd__(self, other):
+        self.MtM += other.MtM
+        self.Mtb += other.Mtb
+        self.btb += other.btb
+        self.sw += other.sw
+        self.n += other.n
+        return self
+
+    def __sub__(self, other):
+        diff = NormalEquations(len(self.Mtb))
+        diff.MtM = self.MtM - other.MtM
+        diff.Mtb = self.Mtb - other.Mtb
+        diff.btb = self.btb - other.btb
+        diff.sw = self.sw - other.sw
+        diff.n = self.n - other.n
+        return diff
+
+    def solve(self):
+        """The (complex) coefficients that minimize sum w |b - M a|^2.
+        """
+        return numpy.linalg.lstsq(self.MtM, self.Mtb)[0]
+
+    def chisq(self, a):
+        """sum w |b - M a|^2 for the objects in these sums, for some coefficients a.
+        """
+        a = numpy.asarray(a, dtype=complex)
+        return (self.btb - 2. * numpy.real(a.conjugate().dot(self.Mtb))
+                + numpy.real(a.conjugate().dot(self.MtM).dot(a)))
+
+
+def accumulate(basis, data, g, e_psf, resid, w, rows, chunk_size=1000000):
+    """Add up the normal equations for the given rows, chunk_size at a time.
+
+    data is a dict of the columns used by the basis (snr, rgp, disc, cov, ...).
+    resid is the quantity being fit, e.g. e - e_true.
+    """
+    ne = NormalEquations(len(basis))
+    for start in range(0, len(rows), chunk_size):
+        r = rows[start:start+chunk_size]
+        chunk = dict( (key, numpy.asarray(col)[r]) for key, col in data.items() )
+        ne.add(basis.design(chunk, g[r], e_psf[r]), resid[r], w[r])
+    return ne
+
+
+def fit_nbc(basis, data, g, e_psf, resid, w, mask, chunk_size=1000000):
+    """Fit the basis to the objects in mask.
+
+    Returns the (real) coefficients, m terms first and then c terms.
+    """
+    rows = numpy.where(mask)[0]
+    print 'Start fit_nbc. n = ',len(rows)
+    print 'basis = ',basis
+    fit = accumulate(basis, data, g, e_psf, resid, w, rows, chunk_size).solve()
+    print 'fit = ',fit
+    fit = fit.real
+    print 'fit => ',fit
+    return fit
+
+
+def calibrate(basis, data, g, e_psf, resid, w, mask, chunk_size=1000000):
+    """Fit the basis and get the corrections for all the objects.
+
+    Returns m_corr, c_corr, fit.
+    """
+    fit = fit_nbc(basis, data, g, e_psf, resid, w, mask, chunk_size)
+    return basis.m_corr(fit, data), basis.c_corr(fit, data, e_psf), fit
+
+
+def _fold_equations(cv_data, f):
+    bases, data, g, e_psf, resid, w, folds, chunk_size = cv_data
+    return [ accumulate(basis, data, g, e_psf, resid, w, folds[f], chunk_size)
+             for basis in bases ]
+
+
+def cross_validate(bases, data, g, e_psf, resid, w, mask, sim_id, k=5, nproc=1,
+                   chunk_size=1000000, seed=1234):
+    """Compare some bases with k-fold cross validation.
+
+    The simulations (sim_id of each object) are split at random into k folds.  Each fold in
+    turn is left out, the basis fit to the others, and the chi^2 per unit weight,
+    sum w |resid - fit|^2 / sum w, found for the left out fold.  Since the normal equations
+    for each fold can be added and subtracted, each fold is only read once, and the folds
+    are read by nproc processes in parallel.
+
+    Returns an array of the mean chi^2 per unit weight of the left out folds for each basis,
+    and an array of the values for each fold, with shape (len(bases), k).
+    """
+    rows = numpy.where(mask)[0]
+    sims = numpy.unique(sim_id[rows])
+    rng = numpy.random.RandomState(seed)
+    sim_fold = rng.permutation(len(sims)) % k
+    fold = sim_fold[numpy.searchsorted(sims, sim_id[rows])]
+    folds = [ rows[fold == f] for f in range(k) ]
+    print 'Cross validation with %d folds of %s objects'%(k, [len(f) for f in folds])
+
+    cv_data = (bases, data, g, e_psf, resid, w, folds, chunk_size)
+    equations = fork_map(_fold_equations, cv_data, range(k), nproc)
+
+    scores = numpy.zeros((len(bases), k))
+    for i, basis in enumerate(bases):
+        total = NormalEquations(len(basis))
+        for f in range(k):
+            total += equations[f][i]
+        for f in range(k):
+            test = equations[f][i]
+            fit = (total - test).solve().real
+            scores[i,f] = test.chisq(fit) / test.sw
+        print '%s: chisq/sum(w) = %s +- %s'%(
+            basis, numpy.mean(scores[i]), numpy.std(scores[i]) / numpy.sqrt(k))
+    return numpy.mean(scores, axis=1), scores
@@ -0,0 +1,32 @@
+# Running a function over some tasks in worker processes that get the (large) data they
+# share by forking, rather than by pickling it for each task.
+
+# The function and shared data of the fork_map that is running, for the workers.
+_running = None
+
+def _call(task):
+    func, shared = _running
+    return func(shared, task)
+
+def fork_map(func, shared, tasks, nproc=1):
+    """[ func(shared, task) for task in tasks ], done by up to nproc processes.
+
+    The workers are forked once the shared data is in place, so only the tasks and the
+    results are pickled.  func may be any function, including a lambda.
+    """
+    global _running
+    tasks = list(tasks)
+    _running = (func, shared)
+    try:
+        if nproc > 1 and len(tasks) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(nproc, len(tasks)))
+            try:
+                return pool.map(_call, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            return [ _call(task) for task in tasks ]
+    finally:
+        _running = None
@@ -4,12 +4,124 @@
 # Command from Troxel to look into later:
 # plt.hist2d(svi3.rsnr,svi3.radius,bins=500,range=((0,100),(1,4)),norm=LogNorm())
 
+# The catalogs below are only read from their FITS shards the first time they are used.  The
+# columns are then saved in STORE_DIR, one .npy file per column (with the ellipticities kept
+# as complex numbers) sorted by object number, and later runs just memory map those.  The
+# store is remade if the list of shards, or their sizes or modification times, change.
+STORE_DIR = 'greatdes_store'
+
+def shard_manifest(files):
+    import os
+    return [ [f, os.path.getsize(f), int(os.path.getmtime(f))] for f in files ]
+
+def open_store(name, manifest):
+    """Open a store's columns as read-only memory maps.
+
+    Returns None if there is no such store, or if it was made from different files.
+    """
+    import os
+    import json
+    import numpy
+    dirname = os.path.join(STORE_DIR, name)
+    manifest_file = os.path.join(dirname, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        info = json.load(f)
+    if info['files'] != manifest:
+        print 'Store %s is out of date'%dirname
+        return None
+    return dict( (col, numpy.load(os.path.join(dirname, col + '.npy'), mmap_mode='r'))
+                 for col in info['columns'] )
+
+def write_store(name, manifest, columns, key='num'):
+    """Save a dict of columns as a store, sorted by the key column if there is one.
+    """
+    import os
+    import json
+    import shutil
+    import numpy
+    dirname = os.path.join(STORE_DIR, name)
+    tmp_dirname = dirname + '.tmp'
+    if os.path.exists(tmp_dirname):
+        shutil.rmtree(tmp_dirname)
+    os.makedirs(tmp_dirname)
+    order = numpy.argsort(columns[key], kind='mergesort') if key in columns else None
+    for col, data in columns.items():
+        data = numpy.asarray(data)
+        if order is not None:
+            data = data[order]
+        numpy.save(os.path.join(tmp_dirname, col + '.npy'), data)
+    with open(os.path.join(tmp_dirname, 'manifest.json'), 'w') as f:
+        json.dump(dict(files=manifest, columns=sorted(columns)), f)
+    # Swap in the new store all at once, so a half-written one is never used.
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp_dirname, dirname)
+    print 'Wrote %d rows to %s'%(len(data), dirname)
+
+def load_store(name, pattern, read_shards):
+    """Get the columns that read_shards(files) reads from the files matching pattern,
+    ingesting them into a store the first time.
+    """
+    import glob
+    manifest = shard_manifest(sorted(glob.glob(pattern)))
+    store = open_store(name, manifest)
+    if store is None:
+        write_store(name, manifest, read_shards([ f for f, size, mtime in manifest ]))
+        store = open_store(name, manifest)
+    return store
+
+def join_sorted(num1, num2):
+    """Find the objects in both of two sorted arrays of object numbers.
+
+    Returns the indices i1, i2 such that num1[i1] == num2[i2].
+    """
+    import numpy
+    num1 = numpy.asarray(num1)
+    num2 = numpy.asarray(num2)
+    if len(num2) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    k = numpy.searchsorted(num2, num1)
+    k[k == len(num2)] = 0
+    found = num2[k] == num1
+    return numpy.where(found)[0], k[found]
+
+def load_matched(kind):
+    """The measurements of one kind ('im3shape' or 'ngmix') of the objects that are in the
+    truth catalog, along with the truth for those objects, as a dict of memory mapped
+    columns sorted by object number.  The truth columns are called true_<name>.
+    """
+    import glob
+    pattern, read_shards = { 'im3shape' : (IM_FILES, read_im_shards),
+                             'ngmix' : (NG_FILES, read_ng_shards) }[kind]
+    name = kind + '_matched'
+    manifest = shard_manifest(sorted(glob.glob(pattern)))
+    manifest += shard_manifest(sorted(glob.glob(TRUTH_FILES)))
+    store = open_store(name, manifest)
+    if store is None:
+        meas = load_store(kind, pattern, read_shards)
+        truth = load_store('truth', TRUTH_FILES, read_truth_shards)
+        i_meas, i_true = join_sorted(meas['num'], truth['num'])
+        columns = dict( (col, meas[col][i_meas]) for col in meas )
+        columns.update( ('true_' + col, truth[col][i_true]) for col in truth if col != 'num' )
+        write_store(name, manifest, columns)
+        store = open_store(name, manifest)
+    return store
+
+IM_FILES = 'results/im3shape/results_bord_rsnr/nbc.meds.*.rsnr.fits'
+#IM_FILES = 'results/im3shape/results-disc/main_cats/nbc.meds.*.fits'
+IM_COLUMNS = ['num', 'rad', 'rgp', 'flux', 'snr', 'flag', 'e', 'round_snr', 'is_disc', 'niter',
+              'chisq', 'min_res', 'max_res', 'info', 'psf_e', 'psf_fwhm', 'trcov', 'detcov',
+              'var_r', 'var_e']
+
 def load_im_data():
+    store = load_store('im3shape', IM_FILES, read_im_shards)
+    return tuple(store.get(name, []) for name in IM_COLUMNS)
+
+def read_im_shards(files):
     import pyfits
-    import glob
     import numpy
-    #files = sorted(glob.glob('results/im3shape/results-disc/main_cats/nbc.meds.*.fits'))
-    files = sorted(glob.glob('results/im3shape/results_bord_rsnr/nbc.meds.*.rsnr.fits'))
     num = []
     rad = []
     rgp = []
@@ -101,16 +213,21 @@ def load_im_data():
     var_r = numpy.concatenate(var_r)
     var_e = numpy.concatenate(var_e)
 
-    return num, rad, rgp, flux, snr, flag, e, round_snr, is_disc, niter, chisq, min_res, max_res, info, psf_e, psf_fwhm, trcov, detcov, var_r, var_e
+    cols = [num, rad, rgp, flux, snr, flag, e, round_snr, is_disc, niter, chisq, min_res, max_res, info, psf_e, psf_fwhm, trcov, detcov, var_r, var_e]
+    return dict( (name, col) for name, col in zip(IM_COLUMNS, cols) if len(col) > 0 )
+
 
 
+IM_SV_FILES = '/astro/u/astrodat/data/DES/wlpipe/im3shape_v9/full_cats/*.fits'
+IM_SV_COLUMNS = ['rad', 'rgp', 'snr', 'flag', 'e', 'is_disc', 'info']
 
 def load_im_sv():
+    store = load_store('im3shape_sv', IM_SV_FILES, read_im_sv_shards)
+    return tuple(store[name] for name in IM_SV_COLUMNS)
+
+def read_im_sv_shards(files):
     import pyfits
-    import glob
     import numpy
-    #files = sorted(glob.glob('results/im3shape/results-disc/main_cats/nbc.meds.*.fits'))
-    files = sorted(glob.glob('/astro/u/astrodat/data/DES/wlpipe/im3shape_v9/full_cats/*.fits'))
 
     rad = []
     rgp = []
@@ -140,16 +257,21 @@ def load_im_sv():
     is_disc = numpy.concatenate(is_disc)
     info = numpy.concatenate(info)
 
-    return rad, rgp, snr, flag, e, is_disc, info
+    return dict(zip(IM_SV_COLUMNS, [rad, rgp, snr, flag, e, is_disc, info]))
 
 
+NG_FILES = '/gpfs01/astro/workarea/esheldon/lensing/great-des/sfit-e02/collated/sfit-e02-*.fits'
+NG_COLUMNS = ['num', 't', 'flux', 'snr', 'tsnr', 'flag', 't_r', 'snr_r', 'flag_r', 'e', 'e_psf',
+              't_psf', 'sens', 'chisq', 'trcov']
+
 def load_ng_data():
+    store = load_store('ngmix', NG_FILES, read_ng_shards)
+    return tuple(store[name] for name in NG_COLUMNS)
+
+def read_ng_shards(files):
     import pyfits
-    import glob
     import numpy
 
-    files = sorted(glob.glob('/gpfs01/astro/workarea/esheldon/lensing/great-des/sfit-e02/collated/sfit-e02-*.fits'))
-
     num = []
     t = []
     flux = []
@@ -212,15 +334,19 @@ def load_ng_data():
     chisq = numpy.concatenate(chisq)
     trcov = numpy.concatenate(trcov)
 
-    return num, t, flux, snr, tsnr, flag, t_r, snr_r, flag_r, e, e_psf, t_psf, sens, chisq, trcov
+    return dict(zip(NG_COLUMNS, [num, t, flux, snr, tsnr, flag, t_r, snr_r, flag_r, e, e_psf, t_psf, sens, chisq, trcov]))
+
+
+TRUTH_FILES = 'data/nbc.truth.*.fits'
+TRUTH_COLUMNS = ['num', 'rad', 'flux', 'e', 'rawe', 'g_app', 'id', 'srcn', 'z', 'use']
 
 def load_truth():
+    store = load_store('truth', TRUTH_FILES, read_truth_shards)
+    return tuple(store[name] for name in TRUTH_COLUMNS)
+
+def read_truth_shards(files):
     import pyfits
     import numpy
-    import os
-    import glob
-
-    files = sorted(glob.glob('data/nbc.truth.*.fits'))
 
     num = []
     rad = []
@@ -276,7 +402,7 @@ def load_truth():
     z = numpy.concatenate(z)
     use = numpy.concatenate(use)
 
-    return num, rad, flux, e, rawe, g_app, id, srcn, z, use
+    return dict(zip(TRUTH_COLUMNS, [num, rad, flux, e, rawe, g_app, id, srcn, z, use]))
 
 
 def load_great3(id):
@@ -382,63 +508,87 @@ def check_snr(snr_meas, snr_round, f_meas, r_meas, mask, filename=None):
     else:
         plt.savefig(filename)
 
-def compute_empir_cov(e_meas, e_true, g_app, id, mask):
-    import numpy 
+def group_by_id(id, mask):
+    """Sort the rows selected by mask by id, once, so that per-id statistics can be done
+    with segment reductions (group_sum) rather than a scan of the whole catalog per id.
 
-    id_use = []
-    trcov_emp = []
-    mean_e = []
-    for i in range(numpy.max(id)):
-        select = numpy.where((id == i) & mask)
-        if numpy.sum(select) < 100:
-            continue
-        et = e_true[select]
-        em = e_meas[select]
-        g = g_app[select]
-        er = (et-g)/(1.-g.conjugate()*et)
-        if numpy.mean(er) == 0.0:
-            continue
-
-        id_use.append(i)
-
-        # Undo the applied shear
-        em = (em-g)/(1.-g.conjugate()*em)
-        # Align shear such that the true shear is a pure positive e1 value.
-        em *= er.conjugate()
+    Returns the distinct ids, the selected rows in order of id (keeping the original order
+    within each id), and the position in rows where each id starts.
+    """
+    import numpy
+    rows = numpy.where(mask)[0]
+    rows = rows[numpy.argsort(id[rows], kind='mergesort')]
+    ids, starts = numpy.unique(id[rows], return_index=True)
+    return ids, rows, starts
+
+def group_sum(x, starts):
+    """Sum x, which is in the order of the rows from group_by_id, over each id.
+    """
+    import numpy
+    if len(starts) == 0:
+        return numpy.zeros(0, dtype=x.dtype)
+    return numpy.add.reduceat(x, starts)
 
-        c11 = numpy.var(em.real)
-        c22 = numpy.var(em.imag)
-        print i, numpy.mean(em), c11, c22
+def compute_empir_cov(e_meas, e_true, g_app, id, mask):
+    import numpy 
 
-        trcov_emp.append(c11+c22)
-        mean_e.append(numpy.abs(numpy.mean(em.real)))
-
-    trcov_emp = numpy.array(trcov_emp)
-    mean_e = numpy.array(mean_e)
-    id_use = numpy.array(id_use)
+    ids, rows, starts = group_by_id(id, mask & (id >= 0) & (id < numpy.max(id)))
+    count = numpy.diff(numpy.append(starts, len(rows)))
+    group = numpy.repeat(numpy.arange(len(ids)), count)
+
+    et = e_true[rows]
+    em = e_meas[rows]
+    g = g_app[rows]
+    er = (et-g)/(1.-g.conjugate()*et)
+    # This used to be numpy.sum(numpy.where(...)), which adds up the row numbers of each id
+    # rather than counting them.  Keep doing that so the results don't change.
+    use = (group_sum(rows, starts) >= 100) & (group_sum(er, starts) / count != 0.0)
+
+    # Undo the applied shear
+    em = (em-g)/(1.-g.conjugate()*em)
+    # Align shear such that the true shear is a pure positive e1 value.
+    em *= er.conjugate()
+
+    mean = group_sum(em, starts) / count
+    d = em - mean[group]
+    c11 = group_sum(d.real**2, starts) / count
+    c22 = group_sum(d.imag**2, starts) / count
+    print 'Empirical covariance for %d ids'%numpy.sum(use)
+
+    trcov_emp = (c11+c22)[use]
+    mean_e = numpy.abs(mean.real)[use]
+    id_use = ids[use].astype(int)
 
     return trcov_emp, mean_e, id_use
 
 def compute_trcov_meas(id_use, trcov, e, var_r, snr_meas, snr_round, id, mask):
     import numpy
-    ncov = 8
-    trcov_meas = [ [] for i in range(ncov) ]
-    for i in id_use:
-        print i
-        select = numpy.where((id == i) & mask)
-
-        factor = numpy.sqrt(1.-numpy.abs(e[select])**2)
-        trcov_meas[0].append(numpy.mean(trcov[select]))
-        trcov_meas[1].append(numpy.mean(trcov[select]/factor))
-        trcov_meas[2].append(numpy.mean(trcov[select]*factor))
-        trcov_meas[3].append(numpy.mean(trcov[select]/factor**2))
-        trcov_meas[4].append(numpy.mean(trcov[select]/factor**4))
-        trcov_meas[5].append(numpy.mean(var_r[select]))
-        trcov_meas[6].append(numpy.mean(1./snr_meas[select]**2))
-        trcov_meas[7].append(numpy.mean(1./snr_round[select]**2))
-
-    for i in range(ncov):
-        trcov_meas[i] = numpy.array(trcov_meas[i])
+    ids, rows, starts = group_by_id(id, mask)
+    count = numpy.diff(numpy.append(starts, len(rows)))
+
+    # Where each of id_use is in ids.  Any that have no rows get nan.
+    k = numpy.searchsorted(ids, id_use)
+    k[k == len(ids)] = 0
+    found = numpy.zeros(len(id_use), dtype=bool) if len(ids) == 0 else ids[k] == id_use
+
+    tc = trcov[rows]
+    factor = numpy.sqrt(1.-numpy.abs(e[rows])**2)
+    quantities = [
+        tc,
+        tc/factor,
+        tc*factor,
+        tc/factor**2,
+        tc/factor**4,
+        var_r[rows],
+        1./snr_meas[rows]**2,
+        1./snr_round[rows]**2,
+    ]
+    trcov_meas = []
+    for q in quantities:
+        m = numpy.empty(len(id_use))
+        m[:] = numpy.nan
+        m[found] = (group_sum(q, starts) / count)[k[found]]
+        trcov_meas.append(m)
 
     return trcov_meas
 
@@ -565,6 +715,75 @@ def check_cov(e_meas, e_true, g_app, trcov, id, mask, filename=None, labels=['Tr
         plt.savefig(filename)
 
 
+# Above this many points, the diagnostic plots below show the density of points (as an image)
+# rather than every point, along with the outliers in the sparsest bins.  Vector output with
+# millions of points takes minutes to render and makes files of hundreds of MB.
+MAX_SCATTER = 100000
+
+def density_plot(ax, x, y, c=None, bins=200, range=None, max_points=None, min_count=3,
+                 cmap=None, **kwargs):
+    """Plot y vs x on ax: a scatter plot for up to max_points (default MAX_SCATTER) points,
+    and a 2D histogram above that, with the points in bins with fewer than min_count points
+    drawn individually.  With c, the image shows the mean c in each bin.  Use max_points=0
+    for plots that should always show the density.
+
+    Only the points within range ((xmin,xmax),(ymin,ymax)), if given, are plotted.
+    kwargs are passed on to scatter.
+    """
+    import numpy
+    import matplotlib.colors
+    if max_points is None:
+        max_points = MAX_SCATTER
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    if c is not None:
+        kwargs['cmap'] = cmap
+        c = numpy.asarray(c)
+    if range is not None:
+        (xmin, xmax), (ymin, ymax) = range
+        keep = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        x = x[keep]
+        y = y[keep]
+        if c is not None:
+            c = c[keep]
+    if len(x) <= max_points:
+        return ax.scatter(x, y, c=c, rasterized=True, **kwargs)
+
+    if range is None:
+        good = numpy.isfinite(x) & numpy.isfinite(y)
+        range = ((numpy.min(x[good]), numpy.max(x[good])), (numpy.min(y[good]), numpy.max(y[good])))
+    (xmin, xmax), (ymin, ymax) = range
+    count, xedges, yedges = numpy.histogram2d(x, y, bins=bins, range=range)
+    if c is None:
+        image = numpy.ma.masked_equal(count, 0)
+        norm = matplotlib.colors.LogNorm()
+    else:
+        csum = numpy.histogram2d(x, y, bins=bins, range=range, weights=c)[0]
+        image = numpy.ma.masked_equal(count, 0)
+        image = csum / image
+        norm = None
+    im = ax.imshow(image.T, origin='lower', extent=(xmin, xmax, ymin, ymax), aspect='auto',
+                   interpolation='nearest', cmap=cmap, norm=norm)
+
+    # The points in sparse bins are drawn as points.
+    ix = numpy.digitize(x, xedges) - 1
+    iy = numpy.digitize(y, yedges) - 1
+    # The last edge is included in the last bin
+    ix[x == xmax] = len(xedges) - 2
+    iy[y == ymax] = len(yedges) - 2
+    inside = (ix >= 0) & (ix < len(xedges)-1) & (iy >= 0) & (iy < len(yedges)-1)
+    sparse = numpy.zeros(len(x), dtype=bool)
+    sparse[inside] = count[ix[inside], iy[inside]] < min_count
+    kwargs.setdefault('s', 1)
+    if c is not None:
+        kwargs['c'] = c[sparse]
+        kwargs['norm'] = im.norm
+    elif 'color' not in kwargs:
+        kwargs['color'] = 'k'
+    print 'density_plot: %d points, %d drawn individually'%(len(x), numpy.sum(sparse))
+    ax.scatter(x[sparse], y[sparse], rasterized=True, **kwargs)
+    return im
+
 def dist_z(x, y, z, mask, xlabel, ylabel, filename=None, x_corr=None, y_corr=None):
     import matplotlib.pyplot as plt
     import numpy
@@ -590,7 +809,7 @@ def dist_z(x, y, z, mask, xlabel, ylabel, filename=None, x_corr=None, y_corr=Non
             yy = y[mask2]
             if y_corr is not None:
                 yy /= numpy.mean(y_corr[mask2])
-            ax.hist2d(xx, yy, bins=500)
+            density_plot(ax, xx, yy, bins=500, max_points=0)
         ax.set_title('$%f < z < %f$'%(zmin,zmax))
         #ax.plot( (-1,1),(-1,1), color='w')
 
@@ -618,27 +837,27 @@ def misc_dist(r, rgp, snr_m, snr_r, e, g, mask, filename=None):
 
     zbins = [ 0.3, 0.644, 0.901, 1.3 ]
 
-    ax[0,0].scatter(rgp[mask], snr_r[mask], s=0.1)
+    density_plot(ax[0,0], rgp[mask], snr_r[mask], s=0.1)
     ax[0,0].set_xlabel('rgpp_rp')
     ax[0,0].set_ylabel('snr_r')
 
-    ax[0,1].scatter(rgp[mask], snr_m[mask], s=0.1)
+    density_plot(ax[0,1], rgp[mask], snr_m[mask], s=0.1)
     ax[0,1].set_xlabel('rgpp_rp')
     ax[0,1].set_ylabel('snr_m')
 
-    ax[1,0].scatter(e[mask].real, e[mask].imag, s=0.1)
+    density_plot(ax[1,0], e[mask].real, e[mask].imag, s=0.1)
     ax[1,0].set_xlabel('e1')
     ax[1,0].set_ylabel('e2')
 
-    ax[1,1].scatter(rgp[mask], r[mask], s=0.1)
+    density_plot(ax[1,1], rgp[mask], r[mask], s=0.1)
     ax[1,1].set_xlabel('rgp')
     ax[1,1].set_ylabel('radius')
 
-    ax[2,0].scatter(r[mask], snr_r[mask], s=0.1)
+    density_plot(ax[2,0], r[mask], snr_r[mask], s=0.1)
     ax[2,0].set_xlabel('radius')
     ax[2,0].set_ylabel('snr_r')
 
-    ax[2,1].scatter(r[mask], snr_m[mask], s=0.1)
+    density_plot(ax[2,1], r[mask], snr_m[mask], s=0.1)
     ax[2,1].set_xlabel('radius')
     ax[2,1].set_ylabel('snr_m')
 
@@ -657,7 +876,7 @@ def misc_dist(r, rgp, snr_m, snr_r, e, g, mask, filename=None):
 def scatter_r(r_true, r_meas, mask, filename=None):
     import matplotlib.pyplot as plt
     plt.clf()
-    plt.scatter(r_meas[mask], r_true[mask])
+    density_plot(plt.gca(), r_meas[mask], r_true[mask])
     plt.ylim(0,3)
     plt.xlim(0,2)
     plt.xlabel('Measured radius')
@@ -674,9 +893,9 @@ def scatter_e_r(r, e, mask, c=None, title='size vs shape', filename=None):
     fig, ax = plt.subplots(1, 1)
     abse = numpy.abs(e[mask])
     if c is None:
-        ax.scatter(abse, r[mask], color='b', s=0.01)
+        density_plot(ax, abse, r[mask], color='b', s=0.01)
     else:
-        ax.scatter(abse, r[mask], c=c[mask], marker='+', s=0.01)
+        density_plot(ax, abse, r[mask], c=c[mask], marker='+', s=0.01)
     ax.set_ylabel('measured radius')
     ax.set_xlabel(r'$|e_{true}|$')
     ax.set_ylim(0.,2.)
@@ -684,8 +903,9 @@ def scatter_e_r(r, e, mask, c=None, title='size vs shape', filename=None):
     s = numpy.argsort(abse)
     nn = 300
     nbins = len(s) / nn
-    meanr = numpy.array([ numpy.mean(r[mask][s][nn*i:nn*(i+1)]) for i in range(nbins) ])
-    meane = numpy.array([ numpy.mean(abse[s][nn*i:nn*(i+1)]) for i in range(nbins) ])
+    # Means of each nn consecutive values, after sorting by |e|
+    meanr = r[mask][s][:nn*nbins].reshape(nbins, nn).mean(axis=1)
+    meane = abse[s][:nn*nbins].reshape(nbins, nn).mean(axis=1)
     ax.plot(meane,meanr, color='k')
     #print 'meanr = ',meanr
     #print 'meane = ',meane
@@ -702,9 +922,9 @@ def scatter_e(e, mask, c=None, title='e1,e2', filename=None):
     plt.style.use('supermongo')
     plt.clf()
     if c is None:
-        plt.hexbin(e[mask].real, e[mask].imag)
+        density_plot(plt.gca(), e[mask].real, e[mask].imag, max_points=0)
     else:
-        plt.scatter(e[mask].real, e[mask].imag, c=c[mask], s=0.1, marker='+')
+        density_plot(plt.gca(), e[mask].real, e[mask].imag, c=c[mask], s=0.1, marker='+')
     plt.xlabel('e1')
     plt.ylabel('e2')
     if c is not None:
@@ -728,8 +948,10 @@ def hist2d_psf(e_meas, e_psf, rgp, cov, mask, filename=None):
     fig, ax = plt.subplots(1,2)
 
     tmp = (0.121837929+1.45669783*cov[mask]-25.8743626*cov[mask]**2)*e_psf[mask] / (rgp[mask]**2 - 1)
-    ax[0].hist2d(e_meas[mask].real,tmp.real,bins=500,range=((-0.75,0.75),(-0.05,0.05)))
-    ax[1].hist2d(e_meas[mask].imag,tmp.imag,bins=500,range=((-0.75,0.75),(-0.05,0.05)))
+    density_plot(ax[0], e_meas[mask].real, tmp.real, bins=500, range=((-0.75,0.75),(-0.05,0.05)),
+                 max_points=0)
+    density_plot(ax[1], e_meas[mask].imag, tmp.imag, bins=500, range=((-0.75,0.75),(-0.05,0.05)),
+                 max_points=0)
     ax[0].set_xlabel('e1')
     ax[1].set_xlabel('e2')
     ax[0].set_ylim(-0.01,0.01)
@@ -741,7 +963,7 @@ def hist2d_psf(e_meas, e_psf, rgp, cov, mask, filename=None):
     else:
         plt.savefig(filename)
 
-def calc_m(e, g, w=None):
+def calc_m(e, g, w=None, id=None, nboot=1000, nproc=1):
     import numpy
     e1 = e.real
     e2 = e.imag
@@ -769,10 +991,24 @@ def calc_m(e, g, w=None):
         sw = numpy.sqrt(w)
         m2 = (numpy.mean(w*e2*g2) - numpy.mean(sw*g2) * numpy.mean(sw*e2)) / (numpy.mean(w*g2**2)-numpy.mean(sw*g2)**2) - 1.
         sigm2 = numpy.sqrt(numpy.mean(w*e2**2) / ( n * (numpy.mean(w*g2**2) - numpy.mean(sw*g2)**2)))
+    if id is not None:
+        # Replace the errors with ones from a bootstrap over the ids.
+        sums, x0, y0 = bootstrap_sums([e1, e2], [g1, g2], w, id, nboot, nproc)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mb = fits_from_sums(sums, x0, y0)[0]
+        # <e>/<g> for the case where all g are equal
+        ratio = ((sums[...,2] + sums[...,0]*y0) / (sums[...,1] + sums[...,0]*x0)).real
+        sigm1, sigm2 = [ numpy.std(ratio[:,k] if (g.max() - g.min()) < 0.001 else mb[:,k])
+                         for k, g in enumerate([g1, g2]) ]
 
     return m1, m2, sigm1, sigm2
 
-def linear_fit(y, x, w=None, mask=None):
+def linear_fit(y, x, w=None, mask=None, id=None, nboot=1000, nproc=1):
+    """Fit y = m x + c.  Returns m, c, sigm, sigc.
+
+    The errors assume the objects are independent, unless id is given, in which case they
+    are from a bootstrap over the ids (see bootstrap_fits).
+    """
     import numpy
     # Follow along at http://mathworld.wolfram.com/LeastSquaresFitting.html
     n = len(x)
@@ -782,6 +1018,8 @@ def linear_fit(y, x, w=None, mask=None):
         x = x[mask]
         y = y[mask]
         w = w[mask]
+        if id is not None:
+            id = id[mask]
         n = len(x)
     xm = numpy.sum(w * x) / numpy.sum(w)
     ym = numpy.sum(w * y) / numpy.sum(w)
@@ -793,71 +1031,228 @@ def linear_fit(y, x, w=None, mask=None):
     s = numpy.sqrt( (ssyy - numpy.abs(m*ssxy)) / (n-2) )
     sigm = s / numpy.sqrt(ssxx)
     sigc = s * numpy.sqrt( 1./n + numpy.abs(xm)**2/ssxx )
+    if id is not None:
+        mb, cb = bootstrap_fits([y], [x], w, id, nboot=nboot, nproc=nproc)
+        sigm = numpy.std(mb[:,0])
+        sigc = numpy.std(cb[:,0])
 
     return m, c, sigm, sigc
 
-def calc_mc(e, g, w=None, mask=None):
+def calc_mc(e, g, w=None, mask=None, id=None, nboot=1000, nproc=1):
+    import numpy
     # Fit e1,e2 separately:
     m1, c1, sigm1, sigc1 = linear_fit(e.real-g.real, g.real, w, mask)
     m2, c2, sigm2, sigc2 = linear_fit(e.imag-g.imag, g.imag, w, mask)
+    if id is not None:
+        # Bootstrap both together, so they use the same resamplings.
+        if w is None:
+            w = numpy.ones(len(e))
+        if mask is not None:
+            e = e[mask]
+            g = g[mask]
+            w = w[mask]
+            id = id[mask]
+        mb, cb = bootstrap_fits([e.real-g.real, e.imag-g.imag], [g.real, g.imag], w, id,
+                                nboot=nboot, nproc=nproc)
+        sigm1, sigm2 = numpy.std(mb, axis=0)
+        sigc1, sigc2 = numpy.std(cb, axis=0)
 
     return m1, m2, c1, c2, sigm1, sigm2, sigc1, sigc2
 
-def calc_nbc(e, g, e_psf, rgp, snr, disc, w, mask, e_true=None):
+def sim_id(num):
+    """Which simulation each object is from.  Each simulation file has its own block of 10000
+    object numbers (cf. read_truth_shards), and the rotated pairs are always in the same file.
+    """
+    return num // 10000
+
+def fit_sums(ys, xs, w, id):
+    """The sums linear_fit needs, for each id: w, w x, w y, w |x|^2, w |y|^2, w x* y for
+    each (y, x).  x and y are measured from their overall means, which are also returned.
+
+    Returns sums with shape (number of ids, len(ys), 6), x0, y0.
+    """
     import numpy
-    n = len(e[mask])
-    print 'Start calc_nbc. n = ',n
-    sw = numpy.sqrt(w)
-    # Tp Tg / (Tp^2 + Tg^2) = Tg/Tp / (1 + Tg^2/Tp^2) = (rgp^2-1) / ( (rgp^2-1)^2 + 1)
-    Tp_Tg = 1./(rgp**2-1)
-    rgpz = Tp_Tg / (Tp_Tg**2 + 1)
-    A = numpy.vstack([ 
-                       numpy.ones(n),
-                       1. / snr[mask]**2,
-                       #rgpz[mask] / snr[mask]**2,
-                       #rgpz[mask],
-                       #disc[mask],
-                       #1. / snr[mask]**2 * disc[mask],
-                       #rgp[mask]**2/(rgp[mask]**2-1) / snr[mask]**2 * disc[mask],
-                       #rgp[mask]**2/(rgp[mask]**2-1) * disc[mask],
-                     ])
-    print 'A.shape = ',A.shape
-    B = numpy.vstack([ 
-                       1. / snr[mask]**2,
-                       Tp_Tg[mask] / snr[mask]**2,
-                       numpy.ones(n),
-                       Tp_Tg[mask],
-                     ])
-    print 'B.shape = ',B.shape
-    M = numpy.vstack([ 
-                       A * g[mask] * sw[mask], 
-                       B * e_psf[mask] * sw[mask],
-                     ]).T
-    print 'M.shape = ',M.shape
-    if e_true is None:
-        b = sw[mask] * (e[mask]-g[mask])
-    else:
-        b = sw[mask] * (e[mask]-e_true[mask])
-    print 'b.shape = ',b.shape
-    fit = numpy.linalg.lstsq(M,b)[0]
-    print 'fit = ',fit
-    fit = fit.real
-    print 'fit => ',fit
-    #m_corr = fit[0] + fit[1]/snr**2 + fit[2]*rgp + fit[3]*rgp/snr**2
-    #c_corr = (fit[4] + fit[5]/snr**2 + fit[6]*rgp + fit[7]/snr**2) * e_psf
-    m_corr = fit[0] + fit[1]/snr**2 #+ fit[2]*rgpz
-    #m_corr += (fit[4] + (fit[5] + fit[6]*rgp**2/(rgp**2-1))/snr**2 + fit[7]*rgp**2/(rgp**2-1)) * disc
-    nm = A.shape[0]
-    c_corr = (fit[nm+0] + fit[nm+1]*Tp_Tg)/snr**2 * e_psf
-    c_corr += ((fit[nm+2] + fit[nm+3]*Tp_Tg)) * e_psf
-    return m_corr, c_corr, fit
+    ids, rows, starts = group_by_id(id, numpy.ones(len(id), dtype=bool))
+    ww = w[rows]
+    sw = numpy.sum(ww)
+    sums = []
+    x0 = []
+    y0 = []
+    for y, x in zip(ys, xs):
+        x = x[rows]
+        y = y[rows]
+        x0.append(numpy.sum(ww * x) / sw)
+        y0.append(numpy.sum(ww * y) / sw)
+        x = x - x0[-1]
+        y = y - y0[-1]
+        wx = ww * x
+        wy = ww * y
+        sums.append([ group_sum(v, starts) for v in
+                      (ww, wx, wy, wx.conjugate() * x, wy.conjugate() * y, wx.conjugate() * y) ])
+    sums = numpy.array(sums, dtype=complex).transpose(2,0,1)
+    return sums, numpy.array(x0), numpy.array(y0)
+
+def fits_from_sums(sums, x0, y0):
+    """m, c of the fits of y = m x + c from some (total) sums from fit_sums, which may have any
+    number of leading axes.
+    """
+    import numpy
+    sw, swx, swy, swxx, swyy, swxy = [ sums[...,k] for k in range(6) ]
+    xm = swx / sw
+    ym = swy / sw
+    ssxx = swxx.real - sw.real * numpy.abs(xm)**2
+    ssxy = swxy - sw * xm.conjugate() * ym
+    m = ssxy / ssxx
+    c = ym + y0 - m * (xm + x0)
+    if not numpy.iscomplexobj(x0) and not numpy.iscomplexobj(y0):
+        m = m.real
+        c = c.real
+    return m, c
+
+def _bootstrap_chunk(sums, args):
+    import numpy
+    seed, nb = args
+    nid = sums.shape[0]
+    rng = numpy.random.RandomState(seed)
+    # How many times each id is drawn in each resampling
+    counts = rng.multinomial(nid, numpy.ones(nid) / nid, size=nb).astype(float)
+    return numpy.tensordot(counts, sums, axes=1)
+
+def bootstrap_sums(ys, xs, w, id, nboot=1000, nproc=1, seed=1234, chunk=50):
+    """Bootstrap the sums from fit_sums over the ids, so objects with the same id (such as
+    the rotated pairs, with the id of their simulation) are always drawn together.
+
+    The sums are added up once for each id, so each resampling is just a weighted sum of
+    those, done chunk resamplings at a time by nproc processes.
+
+    Returns the sums for each resampling, with shape (nboot, len(ys), 6), x0, y0.
+    """
+    import numpy
+    from parallel import fork_map
+    sums, x0, y0 = fit_sums(ys, xs, w, id)
+    print 'Bootstrap over %d ids with %d resamplings'%(sums.shape[0], nboot)
+    tasks = [ ((seed, k), min(chunk, nboot-start))
+              for k, start in enumerate(range(0, nboot, chunk)) ]
+    boot = fork_map(_bootstrap_chunk, sums, tasks, nproc)
+    return numpy.concatenate(boot), x0, y0
+
+def bootstrap_fits(ys, xs, w, id, nboot=1000, nproc=1, seed=1234):
+    """Bootstrap the fits of each y = m x + c over the ids.  (cf. bootstrap_sums)
+
+    Returns m, c of each resampling, with shape (nboot, len(ys)).
+    """
+    return fits_from_sums(*bootstrap_sums(ys, xs, w, id, nboot, nproc, seed))
+
+def decile_edges(x, nbin):
+    """The edges of nbin bins with about equal numbers of x in each: the sorted x at
+    i*len(x)/nbin, and then the largest x (which is not counted in any bin).
+    """
+    import numpy
+    n = len(x)
+    k = numpy.arange(nbin) * n // nbin
+    return numpy.append(numpy.partition(x, k)[k], numpy.max(x))
+
+def bin_index(x, edges):
+    """Which bin each x is in, where bin i has edges[i] <= x < edges[i+1], or -1 if none.
+    """
+    import numpy
+    k = numpy.searchsorted(edges, x, side='right') - 1
+    k[k >= len(edges)-1] = -1
+    return k
+
+def binned_sum(bin, nbin, v):
+    """Sum v (which may be complex) in each bin, like numpy.bincount with weights.
+    """
+    import numpy
+    if numpy.iscomplexobj(v):
+        return numpy.bincount(bin, v.real, nbin) + 1j * numpy.bincount(bin, v.imag, nbin)
+    return numpy.bincount(bin, v, nbin)
+
+def binned_linear_fit(bin, nbin, x, ys, w=None):
+    """Do linear_fit(y, x, w) for the objects in each bin, for each y in ys.
 
+    Rather than selecting each bin's objects in turn, this accumulates Sum(w), Sum(wx),
+    Sum(wy), Sum(w|x|^2), Sum(w conj(x) y) and Sum(w|y|^2) in every bin at once with
+    bincount, and gets the fits from those.
+
+    bin is the bin number of each object (anything outside 0..nbin-1 is skipped).  For
+    2-d binning, nbin can be a tuple of the numbers of bins along each axis, with bin a
+    tuple of the bin numbers along each.
+
+    Returns m, c, sigm, sigc, each with shape (len(ys),) + the shape of the bins.  Empty bins
+    get nan.
+    """
+    import numpy
+    if isinstance(nbin, tuple):
+        shape = nbin
+        inside = numpy.all([ (b >= 0) & (b < nb) for b, nb in zip(bin, nbin) ], axis=0)
+        bin = numpy.ravel_multi_index([ b[inside] for b in bin ], nbin)
+    else:
+        shape = (nbin,)
+        inside = (bin >= 0) & (bin < nbin)
+        bin = bin[inside]
+    size = int(numpy.prod(shape))
+    n = numpy.bincount(bin, minlength=size)
+    x = numpy.asarray(x)[inside]
+    w = numpy.ones(len(x)) if w is None else numpy.asarray(w)[inside]
+
+    # Work relative to the overall means, so the sums don't lose precision
+    x0 = numpy.sum(w * x) / numpy.sum(w)
+    x = x - x0
+    sw = numpy.bincount(bin, w, size)
+    swx = binned_sum(bin, size, w * x)
+    swxx = numpy.bincount(bin, w * numpy.abs(x)**2, size)
+
+    m = []
+    c = []
+    sigm = []
+    sigc = []
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        xm = swx / sw
+        ssxx = swxx - sw * numpy.abs(xm)**2
+        for y in ys:
+            y = numpy.asarray(y)[inside]
+            y0 = numpy.sum(w * y) / numpy.sum(w)
+            y = y - y0
+            ym = binned_sum(bin, size, w * y) / sw
+            ssyy = numpy.bincount(bin, w * numpy.abs(y)**2, size) - sw * numpy.abs(ym)**2
+            ssxy = binned_sum(bin, size, w * numpy.conjugate(x) * y) - sw * numpy.conjugate(xm) * ym
+            mi = ssxy / ssxx
+            s = numpy.sqrt( (ssyy - numpy.abs(mi*ssxy)) / (n-2) )
+            m.append(mi)
+            c.append(ym + y0 - mi * (xm + x0))
+            sigm.append(s / numpy.sqrt(ssxx))
+            sigc.append(s * numpy.sqrt( 1./n + numpy.abs(xm + x0)**2/ssxx ))
+
+    shape = (len(ys),) + shape
+    return [ numpy.array(a).reshape(shape) for a in (m, c, sigm, sigc) ]
+
+def compare_nbc_bases(e, e_true, g_app, e_psf, rgp, snr, disc, w, mask, num, k=5, nproc=1):
+    """Compare some choices of NBC basis by k-fold cross validation across the simulations.
+    """
+    import nbc_calib
+    c_terms = nbc_calib.NBC_BASIS.c
+    bases = [
+        nbc_calib.NBC_BASIS,
+        nbc_calib.Basis(['1', 'snr^-2', 'rgpz snr^-2'], c_terms),
+        nbc_calib.Basis(['1', 'snr^-2', 'rgpz snr^-2', 'rgpz'], c_terms),
+        nbc_calib.Basis(['1', 'snr^-2', 'disc', 'disc snr^-2'], c_terms),
+        nbc_calib.Basis(['1', 'snr^-2', 'disc', 'disc snr^-2', 'Tobs/Tg disc snr^-2',
+                         'Tobs/Tg disc'], c_terms),
+    ]
+    data = { 'snr' : snr, 'rgp' : rgp, 'disc' : disc }
+    scores, fold_scores = nbc_calib.cross_validate(bases, data, g_app, e_psf, e-e_true, w, mask,
+                                                   sim_id(num), k=k, nproc=nproc)
+    best = scores.argmin()
+    print 'Best basis is ',bases[best]
+    return bases[best]
 
 def nbc(e, e_true, g_app, e_psf, rgp, snr, disc, w, mask, title='NBC solution', filename=None,
-        mask_fit=None):
+        mask_fit=None, basis=None):
     import matplotlib.pyplot as plt
     import matplotlib
     import numpy
+    import nbc_calib
     plt.style.use('supermongo')
     matplotlib.rcParams.update({'font.size': 12})
     fig, axes = plt.subplots(2, 2, sharey='row', sharex='col')
@@ -870,7 +1265,10 @@ def nbc(e, e_true, g_app, e_psf, rgp, snr, disc, w, mask, title='NBC solution',
 
     if mask_fit is None:
         mask_fit = mask
-    m_corr, c_corr, fit = calc_nbc(e, g_app, e_psf, rgp, snr, disc, w, mask_fit, e_true=e_true)
+    if basis is None:
+        basis = nbc_calib.NBC_BASIS
+    data = { 'snr' : snr, 'rgp' : rgp, 'disc' : disc }
+    m_corr, c_corr, fit = nbc_calib.calibrate(basis, data, g_app, e_psf, e-e_true, w, mask_fit)
 
     rmean = []
     fits = []
@@ -907,23 +1305,10 @@ def nbc(e, e_true, g_app, e_psf, rgp, snr, disc, w, mask, title='NBC solution',
         ax.errorbar(s, m, yerr=sm, color=color, fmt='o', label='%.2f < rgpp_rp < %.2f'%(rmin,rmax))
 
         mask2 = mask & (rgp >= rmin) & (rgp < rmax)
-        #meanrgp = numpy.mean(rgp[mask2])
-        #meandisc = numpy.mean(disc[mask2])
-        #meanrgpsq = numpy.mean(rgp[mask2]**2)
-        # Tobs / Tg = (Tobs/Tp) / ((Tobs-Tp)/Tp) = rgp^2 / (rgp^2-1)
-        #meanrgpx = numpy.mean(rgp[mask2]**2/(rgp[mask2]**2-1))
-        # Tg/Tp = 1 / ((Tobs-Tp)/Tp) = 1 / (rgp^2-1)
-        #meanrgpy = numpy.mean(1/(rgp[mask2]**2-1))
-        #meanrgpysq = numpy.mean(1/(rgp[mask2]**2-1)**2)
-        # Tp Tg / (Tp^2 + Tg^2) = Tp/Tg / (1 + Tp^2/Tg^2) = (rgp^2-1) / ( (rgp^2-1)^2 + 1)
-        #meanrgpz = numpy.mean( (rgp[mask2]**2-1) / ( (rgp[mask2]**2-1)**2 + 1) )
-        fitline = fit[0] + fit[1]/s_fine**2 #+ fit[2]*meanrgpz
-        #fitline += (fit[4] + (fit[5] + fit[6]*meanrgpx)/s_fine**2 + fit[7]*meanrgpx)*meandisc
+        fitline = basis.snr_lines(fit, dict((k, v[mask2]) for k, v in data.items()), s_fine)[0]
         print 'fitline = ',fitline
         ax.plot(s_fine, fitline, color=color)
-    nm = 2 # How many fit coefficients are in the m part of the fit.
-    #ax.set_title(r'fit parameters $\{1, TpTg/(Tp^2+Tg^2)\} \times \{1, \nu^{-2}\}$')
-    ax.set_title(r'fit parameters $\{1, \nu^{-2}\}$')
+    ax.set_title('fit terms: %s'%', '.join(basis.m))
 
     ax.legend(loc='upper right', fontsize=10)
     ax.plot( [snr_bins[0],snr_bins[-1]], [0.,0.], color='k')
@@ -1005,14 +1390,10 @@ def nbc(e, e_true, g_app, e_psf, rgp, snr, disc, w, mask, title='NBC solution',
         ax.errorbar(s, a, yerr=sa, color=color, fmt='o', label='%.2f < rgpp_rp < %.2f'%(rmin,rmax))
 
         mask2 = mask & (rgp >= rmin) & (rgp < rmax)
-        #meanrgp = numpy.mean(rgp[mask2])
-        meanrgpx = numpy.mean(1./(rgp[mask2]**2-1))
-        #meanrgpsq = numpy.mean(rgp[mask2]**2)
-        fitline = (fit[nm+0] + fit[nm+1]*meanrgpx)/s_fine**2
-        fitline += (fit[nm+2] + fit[nm+3]*meanrgpx)
+        fitline = basis.snr_lines(fit, dict((k, v[mask2]) for k, v in data.items()), s_fine)[1]
         print 'fitline = ',fitline
         ax.plot(s_fine, fitline, color=color)
-    ax.set_title(r'fit parameters $\{1, 1/(rgp^2-1)\} \times \{1, \nu^{-2}\}$')
+    ax.set_title('fit terms: %s'%', '.join(basis.c))
 
     ax.legend(loc='upper right', fontsize=10)
     ax.plot( [snr_bins[0],snr_bins[-1]], [0.,0.], color='k')
@@ -1134,25 +1515,15 @@ def alpha_vs_x(e, e_true, g_app, e_psf, x, w, mask, label, filename, title=None,
 
     ax = axes[0]
     nx = 10
-    sortx = numpy.sort(x[mask])
-    print len(sortx)
-    deciles = numpy.array([ sortx[i*len(sortx)/nx] for i in range(nx) ] + [ sortx[-1] ])
+    print len(x[mask])
+    deciles = decile_edges(x[mask], nx)
     print deciles
-
+    bin = numpy.where(mask, bin_index(x, deciles), -1)
+    inbin = bin >= 0
+    count = numpy.bincount(bin[inbin], minlength=nx)
+    use = count > 0
     mx = numpy.zeros(nx)
-    a1 = numpy.zeros(nx)
-    sa1 = numpy.zeros(nx)
-    a2 = numpy.zeros(nx)
-    sa2 = numpy.zeros(nx)
-    a1_t = numpy.zeros(nx)
-    sa1_t = numpy.zeros(nx)
-    a2_t = numpy.zeros(nx)
-    sa2_t = numpy.zeros(nx)
-    a1_c = numpy.zeros(nx)
-    sa1_c = numpy.zeros(nx)
-    a2_c = numpy.zeros(nx)
-    sa2_c = numpy.zeros(nx)
-    use = numpy.ones(nx, dtype=bool)
+    mx[use] = numpy.bincount(bin[inbin], x[inbin], nx)[use] / count[use]
 
     if m_corr is not None or c_corr is not None:
         if m_corr is None:
@@ -1160,25 +1531,26 @@ def alpha_vs_x(e, e_true, g_app, e_psf, x, w, mask, label, filename, title=None,
         if c_corr is None:
             c_corr = numpy.zeros(len(e))
         corr = True
+        # Each bin's shapes are corrected with the mean m in that bin
+        sw = numpy.bincount(bin[inbin], w[inbin], nx)
+        means = 1. + numpy.bincount(bin[inbin], (w * m_corr)[inbin], nx) / numpy.where(use, sw, 1.)
+        e_corr = (e - c_corr) / means[bin]
     else:
         corr = False
+        e_corr = e
+
+    def fits(x1, x2):
+        # The slopes (and their errors) of e1 vs x1 and e2 vs x2 in each bin, for the
+        # measured, true and corrected shapes.
+        ys1 = [ e1.real - g_app.real for e1 in (e, e_true, e_corr) ]
+        ys2 = [ e2.imag - g_app.imag for e2 in (e, e_true, e_corr) ]
+        m1, _, sigm1, _ = binned_linear_fit(bin, nx, x1, ys1, w)
+        m2, _, sigm2, _ = binned_linear_fit(bin, nx, x2, ys2, w)
+        return m1, sigm1, m2, sigm2
+
+    (a1, a1_t, a1_c), (sa1, sa1_t, sa1_c), (a2, a2_t, a2_c), (sa2, sa2_t, sa2_c) = \
+            fits(e_psf.real, e_psf.imag)
 
-    for j in range(nx):
-        sample = numpy.where(mask & (x >= deciles[j]) & (x < deciles[j+1]))
-        if numpy.sum(sample) == 0:
-            use[j] = False
-            continue
-        mx[j] = numpy.mean(x[sample])
-        a1[j], _, sa1[j], _ = linear_fit(e[sample].real-g_app[sample].real, e_psf[sample].real, w[sample])
-        a2[j], _, sa2[j], _ = linear_fit(e[sample].imag-g_app[sample].imag, e_psf[sample].imag, w[sample])
-        a1_t[j], _, sa1_t[j], _ = linear_fit(e_true[sample].real-g_app[sample].real, e_psf[sample].real, w[sample])
-        a2_t[j], _, sa2_t[j], _ = linear_fit(e_true[sample].imag-g_app[sample].imag, e_psf[sample].imag, w[sample])
-        if corr:
-            means = 1. + numpy.sum(w[sample] * m_corr[sample]) / numpy.sum(w[sample])
-            e_corr = (e[sample] - c_corr[sample]) / means
-            a1_c[j], _, sa1_c[j], _ = linear_fit(e_corr.real-g_app[sample].real, e_psf[sample].real, w[sample])
-            a2_c[j], _, sa2_c[j], _ = linear_fit(e_corr.imag-g_app[sample].imag, e_psf[sample].imag, w[sample])
-            
     print 'mx = ',mx
     print 'alpha1_t = ',a1_t
     print 'alpha2_t = ',a2_t
@@ -1204,20 +1576,8 @@ def alpha_vs_x(e, e_true, g_app, e_psf, x, w, mask, label, filename, title=None,
         ax.set_title(title)
 
     ax = axes[1]
-    for j in range(nx):
-        if not use[j]:
-            continue
-        sample = numpy.where(mask & (x >= deciles[j]) & (x < deciles[j+1]))
-        mx[j] = numpy.mean(x[sample])
-        a1[j], _, sa1[j], _ = linear_fit(e[sample].real-g_app[sample].real, g_app[sample].real, w[sample])
-        a2[j], _, sa2[j], _ = linear_fit(e[sample].imag-g_app[sample].imag, g_app[sample].imag, w[sample])
-        a1_t[j], _, sa1_t[j], _ = linear_fit(e_true[sample].real-g_app[sample].real, g_app[sample].real, w[sample])
-        a2_t[j], _, sa2_t[j], _ = linear_fit(e_true[sample].imag-g_app[sample].imag, g_app[sample].imag, w[sample])
-        if corr:
-            means = 1. + numpy.sum(w[sample] * m_corr[sample]) / numpy.sum(w[sample])
-            e_corr = (e[sample] - c_corr[sample]) / means
-            a1_c[j], _, sa1_c[j], _ = linear_fit(e_corr.real-g_app[sample].real, g_app[sample].real, w[sample])
-            a2_c[j], _, sa2_c[j], _ = linear_fit(e_corr.imag-g_app[sample].imag, g_app[sample].imag, w[sample])
+    (a1, a1_t, a1_c), (sa1, sa1_t, sa1_c), (a2, a2_t, a2_c), (sa2, sa2_t, sa2_c) = \
+            fits(g_app.real, g_app.imag)
     print 'mx = ',mx
     print 'm1_t = ',a1_t
     print 'm2_t = ',a2_t
@@ -1255,32 +1615,34 @@ def alpha_vs_xy(e, e_true, g_app, e_psf, x, y, w, mask, xlabel, ylabel, filename
     fig, ax = plt.subplots(2, 3, sharex='col', sharey='row')
 
     nbin = 30
-    sortx = numpy.sort(x[mask])
-    print len(sortx)
-    xbins = numpy.array([ sortx[i*len(sortx)/nbin] for i in range(nbin) ] + [ sortx[-1] ])
+    print len(x[mask])
+    xbins = decile_edges(x[mask], nbin)
     print xbins
-
-    sorty = numpy.sort(y[mask])
-    ybins = numpy.array([ sorty[i*len(sorty)/nbin] for i in range(nbin) ] + [ sorty[-1] ])
+    ybins = decile_edges(y[mask], nbin)
     print ybins
 
     xx,yy = numpy.meshgrid(xbins,ybins)
 
-    alpha_m = numpy.zeros((nbin,nbin))
-    alpha_t = numpy.zeros((nbin,nbin))
-    m_m = numpy.zeros((nbin,nbin))
-    m_t = numpy.zeros((nbin,nbin))
-    for i in range(nbin):
-      for j in range(nbin):
-        sample = numpy.where(mask & (x >= xbins[i]) & (x < xbins[i+1]) & (y >= ybins[j]) & (y < ybins[j+1]))
-        if numpy.sum(sample) == 0:
-            continue
-        alpha_m[j,i] = linear_fit(e[sample]-g_app[sample], e_psf[sample], w[sample])[0].real
-        alpha_t[j,i] = linear_fit(e_true[sample]-g_app[sample], e_psf[sample], w[sample])[0].real
-        m_m[j,i] = linear_fit(e[sample]-g_app[sample], g_app[sample], w[sample])[0].real
-        m_t[j,i] = linear_fit(e_true[sample]-g_app[sample], g_app[sample], w[sample])[0].real
-        xx[j,i] = numpy.mean(x[sample])
-        yy[j,i] = numpy.mean(y[sample])
+    # Bins are indexed [j,i] for the j-th bin in y and the i-th in x.
+    ix = numpy.where(mask, bin_index(x, xbins), -1)
+    iy = numpy.where(mask, bin_index(y, ybins), -1)
+    inbin = (ix >= 0) & (iy >= 0)
+    k = iy[inbin] * nbin + ix[inbin]
+    count = numpy.bincount(k, minlength=nbin*nbin).reshape(nbin,nbin)
+    use = count > 0
+    ncount = numpy.where(use, count, 1)
+    mean_x = numpy.bincount(k, x[inbin], nbin*nbin).reshape(nbin,nbin) / ncount
+    mean_y = numpy.bincount(k, y[inbin], nbin*nbin).reshape(nbin,nbin) / ncount
+    xx[:nbin,:nbin] = numpy.where(use, mean_x, xx[:nbin,:nbin])
+    yy[:nbin,:nbin] = numpy.where(use, mean_y, yy[:nbin,:nbin])
+
+    ys = [ e-g_app, e_true-g_app ]
+    alpha_m, alpha_t = binned_linear_fit((iy, ix), (nbin, nbin), e_psf, ys, w)[0].real
+    m_m, m_t = binned_linear_fit((iy, ix), (nbin, nbin), g_app, ys, w)[0].real
+    alpha_m = numpy.where(use, alpha_m, 0.)
+    alpha_t = numpy.where(use, alpha_t, 0.)
+    m_m = numpy.where(use, m_m, 0.)
+    m_t = numpy.where(use, m_t, 0.)
 
     amax = numpy.max([alpha_m, alpha_t, alpha_m-alpha_t])
     amin = numpy.min([alpha_m, alpha_t, alpha_m-alpha_t])
@@ -1321,233 +1683,11 @@ def alpha_vs_xy(e, e_true, g_app, e_psf, x, y, w, mask, xlabel, ylabel, filename
     plt.savefig(filename)
 
 
-def plot_nbc(ax, rgp, snr, e, g_app, w, mask, rgp_bins, snr_bins, e_true=None):
-    import matplotlib.pyplot as plt
-    import numpy
-    nrgp = len(rgp_bins) - 1
-    nsnr = len(snr_bins) - 1
-    cm = plt.cm.rainbow
-
-    for i in range(nrgp):
-        rmin = rgp_bins[i]
-        rmax = rgp_bins[i+1]
-        print 'r min/max = ',rmin,rmax
-        # cf. https://geetduggal.wordpress.com/2011/08/22/grabbing-individual-colors-from-color-maps-in-matplotlib/
-        color = cm( (i + 0.5) / nrgp )
-        s = numpy.zeros(nsnr)
-        m = numpy.zeros(nsnr)
-        sm = numpy.zeros(nsnr)
-        for j in range(nsnr):
-            smin = snr_bins[j]
-            smax = snr_bins[j+1]
-            sample = mask & (rgp >= rmin) & (rgp < rmax) & (snr >= smin) & (snr < smax)
-            if numpy.sum(sample) == 0:
-                continue
-            s[j] = numpy.mean(snr[sample])
-            #print 'snr = ',s[j]
-            #print 'n = ',numpy.sum(sample)
-            m1, m2, sigm1, sigm2 = calc_m(e[sample], g_app[sample], w[sample])
-            if e_true is not None:
-                m1t, m2t, sigm1t, sigm2t = calc_m(e_true[sample], g_app[sample], w[sample])
-                m1 -= m1t
-                m2 -= m2t
-
-            #print 'm1 = %f +- %f'%(m1,sigm1)
-            #print 'm2 = %f +- %f'%(m2,sigm2)
-            m[j] = (m1 + m2) / 2.
-            sm[j] = (sigm1 + sigm2) / numpy.sqrt(2.)  # Not really right, but fine for now.
-        #print 's = ',s
-        #print 'm = ',m
-        #print 'sm = ',sm
-        ax.errorbar(s, m, yerr=sm, color=color, fmt='o', label='%.2f < rgpp_rp < %.2f'%(rmin,rmax))
-
-
-
-def old_nbc(e, e_true, g_app, rgp, snr, w, mask, title='nbc', filename=None, mask_fit=None):
-    import matplotlib.pyplot as plt
-    import matplotlib
-    import numpy
-    plt.style.use('supermongo')
-    matplotlib.rcParams.update({'font.size': 12})
-    fig, axes = plt.subplots(2, 2)
-
-    #rgp_bins = [ 1.15, 1.2, 1.25, 1.3, 1.4, 1.5, 1.6 ]
-    rgp_bins = [ 1.2, 1.25, 1.3, 1.4, 1.6, 2.0, 3.0 ]
-    snr_bins = [ 10, 12.5, 15, 17.5, 20, 25, 30, 50, 80, 200, 2000 ]
-    #snr_bins = [ 15, 17.5, 20, 25, 30, 50, 80, 200, 2000 ]
-    nrgp = len(rgp_bins) - 1
-    nsnr = len(snr_bins) - 1
-    cm = plt.cm.rainbow
-
-    rmean = []
-    fits = []
-    s_fine = numpy.linspace(snr_bins[0], snr_bins[-1], 10000)
-
-    if mask_fit is None:
-        mask_fit = mask
-    ax = axes[0,0]
-    plot_nbc(ax, rgp, snr, e, g_app, w, mask, rgp_bins, snr_bins, e_true=e_true)
-    sw = numpy.sqrt(w)
-    for i in range(nrgp):
-        rmin = rgp_bins[i]
-        rmax = rgp_bins[i+1]
-        color = cm( (i + 0.5) / nrgp )
-        mask2 = mask & (rgp >= rmin) & (rgp < rmax)
-        if numpy.sum(mask2) == 0:
-            continue
-        # fit points to m = a/nu^2 + c
-        n = numpy.sum(mask2)
-        a = (numpy.vstack([ g_app[mask2]/snr[mask2]**2 ]) * sw[mask2]).t
-        if e_true is None:
-            b = sw[mask2] * (e[mask2]-g_app[mask2])
-        else:
-            b = sw[mask2] * (e[mask2]-e_true[mask2])
-        fit = numpy.linalg.lstsq(a,b)[0]
-        print 'fit = ',fit
-        a, = fit
-        fits.append(a.real)
-        rmean.append(numpy.mean(rgp[mask2]))
-        ax.plot(s_fine, a/s_fine**2, color=color)
-
-    #ax.set_yscale('log')
-    ax.plot( [snr_bins[0],snr_bins[-1]], [0.,0.], color='k')
-    ax.set_xlabel('$s/n$')
-    ax.set_ylabel('m')
-    ax.set_ylim(-0.5,0.5)
-    ax.set_xscale('log')
-    ax.set_xlim(snr_bins[0], snr_bins[-1])
-    ax.set_title(title)
-    ax.legend(loc='lower right')
-
-    # look at fit vs rgp:
-    ax = axes[0,1]
-    ax.scatter(rmean, fits)
-    ax.set_xlabel(r'<rgpp_rp>')
-    ax.set_ylabel(r'fit coeff of $m$ vs $1/nu^2$')
-    ax.set_title(r'dependence of nbc on rgp')
-
-    # this is very linear.  so repeat this as a single fit using the functional form:
-    # m = a/nu^2 + b rgp/nu^2
-    # e-g = ( a/nu^2 + b rgp/nu^2 + c rgp^2/nu^2 + d ) g
-    ax = axes[1,0]
-    m_corr, fit = calc_nbc(e, g_app, rgp, snr, w, mask_fit, e_true=e_true)
-    #junk = [1./10.**2, 1./10**4, 1./10**3, 1./10**1]
-    #print 'junk = ',junk
-    #print 'fit.dot(junk) = ',fit.dot(junk)
-    #print 'fit.real.dot(junk) = ',fit.real.dot(junk)
-    #junk2 = numpy.array([1./s_fine**2, 1./s_fine*4, 1./s_fine*3, 1./s_fine*1])
-    #print 'junk2 = ',junk2
-    #print 'fit.real.dot(junk2) = ',fit.real.dot(junk)
-
-    plot_nbc(ax, rgp, snr, e, g_app, w, mask, rgp_bins, snr_bins, e_true=e_true)
-    for i in range(nrgp):
-        rmin = rgp_bins[i]
-        rmax = rgp_bins[i+1]
-        color = cm( (i + 0.5) / nrgp )
-        meanrgp = numpy.mean(rgp[mask & (rgp >= rmin) & (rgp < rmax)])
-        meanrgpsq = numpy.mean(rgp[mask & (rgp >= rmin) & (rgp < rmax)]**2)
-        #fitline = fit[0].real/s_fine**2
-        #fitline += fit[1].real/s_fine**4
-        #fitline += fit[2].real/s_fine**3
-        #fitline += fit[3].real/s_fine**1
-        #fitline += fit[1].real
-        fitline = (fit[0].real + fit[1].real*meanrgp)/s_fine**2
-        #fitline += (fit[2].real + fit[3].real*meanrgp)/s_fine**4
-        #fitline += (fit[2].real + fit[3].real*meanrgp)/s_fine**3
-        #fitline += (fit[4].real + fit[5].real*meanrgp)/s_fine**1
-        #fitline += (fit[6].real + fit[7].real*meanrgp)
-        #fitline += fit[2].real + fit[3].real*meanrgp
-        #fitline = (fit[0].real + fit[1].real*meanrgp + fit[2].real*meanrgpsq)/s_fine**2
-        #fitline += (fit[3].real + fit[4].real*meanrgp + fit[5].real*meanrgpsq)/s_fine**4
-        #fitline += (fit[6].real + fit[7].real*meanrgp + fit[8].real*meanrgpsq)/s_fine**3
-        #fitline += (fit[9].real + fit[10].real*meanrgp + fit[11].real*meanrgpsq)/s_fine**1
-        print 'fitline = ',fitline
-        ax.plot(s_fine, fitline, color=color)
-
-    ax.plot( [snr_bins[0],snr_bins[-1]], [0.,0.], color='k')
-    ax.set_xlabel('$s/n$')
-    ax.set_ylabel('m')
-    ax.set_ylim(-0.5,0.5)
-    ax.set_xscale('log')
-    ax.set_xlim(snr_bins[0], snr_bins[-1])
-    ax.set_title(r'fit parameters $\{1,rgp\}\times\{nu^{-0},nu^{-1},nu^{-2},nu^{-3}\}$')
-    #ax.set_title(r'fit parameters $\{1,rgp\}\times\{1,nu^{-2}\}$')
-    #ax.set_title(r'fit parameters $\{1\}\times\{1,nu^{-2}\}$')
-
-    # finally, repeat with the correction applied directly to the shapes.
-    ax = axes[1,1]
-
-    e_corr = e.copy()
-    for i in range(nrgp):
-        rmin = rgp_bins[i]
-        rmax = rgp_bins[i+1]
-        for j in range(nsnr):
-            smin = snr_bins[j]
-            smax = snr_bins[j+1]
-            sample = mask & (rgp >= rmin) & (rgp < rmax) & (snr >= smin) & (snr < smax)
-            means = 1. + numpy.sum(w[sample] * m_corr[sample]) / numpy.sum(w[sample])
-            e_corr[sample] /= means
-    plot_nbc(ax, rgp, snr, e_corr, g_app, w, mask, rgp_bins, snr_bins, e_true=e_true)
-
-    ax.plot( [snr_bins[0],snr_bins[-1]], [0.,0.], color='k')
-    ax.set_xlabel('$s/n$')
-    ax.set_ylabel('m after correction')
-    ax.set_ylim(-0.5,0.5)
-    ax.set_xscale('log')
-    ax.set_xlim(snr_bins[0], snr_bins[-1])
-    ax.set_title(r'corrected shapes')
-
-    fig.set_size_inches(12.,12.0)
-    plt.tight_layout()
-    if filename is None:
-        plt.show()
-    else:
-        plt.savefig(filename)
-
-    return m_corr
-
-
-
-def calc_nbc_cov(e, g, e_psf, rgp, cov, w, mask):
-    import numpy
-    n = len(e[mask])
-    print 'Start calc_nbc_cov. n = ',n
-    sw = numpy.sqrt(w)
-    A = numpy.vstack([ 
-                       numpy.ones(n),
-                       cov[mask],
-                       cov[mask]**2,
-                     ])
-    print 'A.shape = ',A.shape
-    M = numpy.vstack([ 
-                       A * g[mask] * sw[mask], 
-                       A * e_psf[mask] * sw[mask],
-                       #A * e_psf[mask] / (rgp[mask]**2-1) * sw[mask],
-                       #A * e_psf[mask].conjugate() / (rgp[mask]**2-1) * sw[mask]
-                       #A * e_psf[mask].real / (rgp[mask]**2-1) * sw[mask],
-                       #A * 1j * e_psf[mask].imag / (rgp[mask]**2-1) * sw[mask]
-                     ]).T
-    print 'M.shape = ',M.shape
-    b = sw[mask] * (e[mask]-g[mask])
-    print 'b.shape = ',b.shape
-    fit = numpy.linalg.lstsq(M,b)[0]
-    print 'fit = ',fit
-    fit = fit.real
-    print 'fit => ',fit
-    m_corr = fit[0] + fit[1]*cov + fit[2]*cov**2
-    #c_corr = (fit[3] + fit[4]/(rgp**2-1.)) * e_psf
-    c_corr = (fit[3] + fit[4]*cov + fit[5]*cov**2) * e_psf
-    #c_corr = (fit[3] + fit[4]*cov + fit[5]*cov**2)/(rgp**2-1.) * e_psf
-    #c_corr += (fit[6] + fit[7]*cov + fit[8]*cov**2)/(rgp**2-1.) * e_psf.conjugate()
-    #c_corr = (fit[3] + fit[4]*cov + fit[5]*cov**2)/(rgp**2-1.) * (1+0j) * e_psf.real
-    #c_corr += (fit[6] + fit[7]*cov + fit[8]*cov**2)/(rgp**2-1.) * 1j * e_psf.imag
-    return m_corr, c_corr, fit
-
-
 def nbc_c(e, e_true, g_app, e_psf, rgp, cov, w, mask, title=None, filename=None, mask_fit=None):
     import matplotlib.pyplot as plt
     import matplotlib
     import numpy
+    import nbc_calib
     plt.style.use('supermongo')
     matplotlib.rcParams.update({'font.size': 8})
     #fig, axes = plt.subplots(1, 2, sharex='col', sharey='row')
@@ -1559,7 +1699,9 @@ def nbc_c(e, e_true, g_app, e_psf, rgp, cov, w, mask, title=None, filename=None,
     if mask_fit is None:
         mask_fit = mask
 
-    m_corr, c_corr, fit = calc_nbc_cov(e-e_true, g_app, e_psf, rgp, cov, w, mask_fit)
+    data = { 'cov' : cov }
+    m_corr, c_corr, fit = nbc_calib.calibrate(nbc_calib.COV_BASIS, data, g_app, e_psf,
+                                              e-e_true-g_app, w, mask_fit)
     e_corr = e.copy()
     e_corr -= c_corr
 
@@ -1685,6 +1827,7 @@ def nbc_cov(e, e_true, g_app, e_psf, rgp, cov, w, mask, filename=None, mask_fit=
     import matplotlib.pyplot as plt
     import matplotlib
     import numpy
+    import nbc_calib
     plt.style.use('supermongo')
     matplotlib.rcParams.update({'font.size': 12})
     fig, ax = plt.subplots(1, 1)
@@ -1699,7 +1842,9 @@ def nbc_cov(e, e_true, g_app, e_psf, rgp, cov, w, mask, filename=None, mask_fit=
 
     if mask_fit is None:
         mask_fit = mask
-    m_corr, c_corr, fit = calc_nbc_cov(e-e_true, g_app, e_psf, rgp, cov, w, mask_fit)
+    data = { 'cov' : cov }
+    m_corr, c_corr, fit = nbc_calib.calibrate(nbc_calib.COV_BASIS, data, g_app, e_psf,
+                                              e-e_true-g_app, w, mask_fit)
     e_corr = e.copy()
     e_corr -= c_corr
 
@@ -1802,7 +1947,8 @@ def mean_e_vs_r(r, e, g_app, mask, title='e vs radius', filename=None):
     else:
         plt.savefig(filename)
 
-def mean_e_vs_z(z, e, m_corr, c_corr, g_app, e_true, e_psf, w, mask, title='e vs z', filename=None):
+def mean_e_vs_z(z, e, m_corr, c_corr, g_app, e_true, e_psf, w, mask, title='e vs z', filename=None,
+                id=None):
     import matplotlib
     import matplotlib.pyplot as plt
     import numpy
@@ -1831,15 +1977,16 @@ def mean_e_vs_z(z, e, m_corr, c_corr, g_app, e_true, e_psf, w, mask, title='e vs
     # Plot m vs z
     for i in range(nz):
         mask2 = mask & (z > zbins[i]) & (z < zbins[i+1])
+        id2 = None if id is None else id[mask2]
         print 'z = ',zbins[i],zbins[i+1]
         print 'mean m = ',numpy.mean(m_corr[mask2])
         print 'n = ',numpy.sum(mask2)
-        mc = calc_mc(e_true, g_app, w, mask2)
+        mc = calc_mc(e_true, g_app, w, mask2, id=id)
         m1[i], m2[i], c1[i], c2[i], sigm1[i], sigm2[i], sigc1[i], sigc2[i] = mc
         zz[i] = numpy.mean(z[mask2])
         nn[i] = numpy.sum(mask2)
-        alpha1[i], _, sigalpha1[i], _ = linear_fit(e_true[mask2].real-g_app[mask2].real, e_psf[mask2].real, w[mask2])
-        alpha2[i], _, sigalpha2[i], _ = linear_fit(e_true[mask2].imag-g_app[mask2].real, e_psf[mask2].imag, w[mask2])
+        alpha1[i], _, sigalpha1[i], _ = linear_fit(e_true[mask2].real-g_app[mask2].real, e_psf[mask2].real, w[mask2], id=id2)
+        alpha2[i], _, sigalpha2[i], _ = linear_fit(e_true[mask2].imag-g_app[mask2].real, e_psf[mask2].imag, w[mask2], id=id2)
     print 'zz = ',zz
     print 'nn = ',nn
     print 'm1 = ',m1
@@ -1855,10 +2002,11 @@ def mean_e_vs_z(z, e, m_corr, c_corr, g_app, e_true, e_psf, w, mask, title='e vs
     
     for i in range(nz):
         mask2 = mask & (z > zbins[i]) & (z < zbins[i+1])
-        mc = calc_mc(e, g_app, w, mask2)
+        id2 = None if id is None else id[mask2]
+        mc = calc_mc(e, g_app, w, mask2, id=id)
         m1[i], m2[i], c1[i], c2[i], sigm1[i], sigm2[i], sigc1[i], sigc2[i] = mc
-        alpha1[i], _, sigalpha1[i], _ = linear_fit(e[mask2].real-g_app[mask2].real, e_psf[mask2].real, w[mask2])
-        alpha2[i], _, sigalpha2[i], _ = linear_fit(e[mask2].imag-g_app[mask2].imag, e_psf[mask2].imag, w[mask2])
+        alpha1[i], _, sigalpha1[i], _ = linear_fit(e[mask2].real-g_app[mask2].real, e_psf[mask2].real, w[mask2], id=id2)
+        alpha2[i], _, sigalpha2[i], _ = linear_fit(e[mask2].imag-g_app[mask2].imag, e_psf[mask2].imag, w[mask2], id=id2)
     print 'm1 = ',m1
     print 'm2 = ',m2
     print 'sigm1 = ',sigm1
@@ -1873,12 +2021,13 @@ def mean_e_vs_z(z, e, m_corr, c_corr, g_app, e_true, e_psf, w, mask, title='e vs
 
     for i in range(nz):
         mask2 = mask & (z > zbins[i]) & (z < zbins[i+1])
+        id2 = None if id is None else id[mask2]
         means = 1. + numpy.sum(w[mask2] * m_corr[mask2]) / numpy.sum(w[mask2])
         ee = (e[mask2] - c_corr[mask2]) / means
-        mc = calc_mc(ee, g_app[mask2], w[mask2])
+        mc = calc_mc(ee, g_app[mask2], w[mask2], id=id2)
         m1[i], m2[i], c1[i], c2[i], sigm1[i], sigm2[i], sigc1[i], sigc2[i] = mc
-        alpha1[i], _, sigalpha1[i], _ = linear_fit(ee.real-g_app[mask2].real, e_psf[mask2].real, w[mask2])
-        alpha2[i], _, sigalpha2[i], _ = linear_fit(ee.imag-g_app[mask2].imag, e_psf[mask2].imag, w[mask2])
+        alpha1[i], _, sigalpha1[i], _ = linear_fit(ee.real-g_app[mask2].real, e_psf[mask2].real, w[mask2], id=id2)
+        alpha2[i], _, sigalpha2[i], _ = linear_fit(ee.imag-g_app[mask2].imag, e_psf[mask2].imag, w[mask2], id=id2)
     print 'm1 = ',m1
     print 'm2 = ',m2
     print 'sigm1 = ',sigm1
@@ -2259,19 +2408,15 @@ def build_m_vs_z_ngmix():
     import tests
     # Pull out the complete script for building the m_vs_z plot for ngmix.
 
-    # Read in the ngmix data
-    num_ng, t_ng, flux_ng, snr_ng, tsnr_ng, flag_ng, tr_ng, snrr_ng, flagr_ng, e_ng, epsf_ng, tpsf_ng, sens_ng, chisq_ng, trcov_ng = tests.load_ng_data()
-
-    # Read in the truth data
-    num_true, r_true, f_true, e_true, e_raw, g_app, id_cosmos, srcn, z, use = tests.load_truth()
-
-    # Find the index into truth values that refer to the corresponding ngmix values
-    # i.e. num_true[ng] == num_ng
-    ng = numpy.in1d(num_true, num_ng)
-    assert numpy.all(num_true[ng] == num_ng)
+    # Read in the ngmix data, along with the truth for the same objects.
+    ng = tests.load_matched('ngmix')
+    num_ng, t_ng, flux_ng, snr_ng, tsnr_ng, flag_ng, tr_ng, snrr_ng, flagr_ng, e_ng, epsf_ng, tpsf_ng, sens_ng, chisq_ng, trcov_ng = tuple(ng[name] for name in tests.NG_COLUMNS)
+    e_true_ng = ng['true_e']
+    g_app_ng = ng['true_g_app']
+    z_ng = ng['true_z']
 
     # Select good objects
-    good_ng = (flag_ng == 0) & (flagr_ng == 0) & (sens_ng.real > 0) & (sens_ng.imag > 0) & (use[ng])
+    good_ng = (flag_ng == 0) & (flagr_ng == 0) & (sens_ng.real > 0) & (sens_ng.imag > 0) & (ng['true_use'])
 
     # Convert ngmix sensitivity into m,c terminology.
     c0 = numpy.zeros(len(e_ng))
@@ -2284,66 +2429,60 @@ def build_m_vs_z_ngmix():
     mask_ng = good_ng & (snrr_ng > 15) & (tr_ng/tpsf_ng > 0.15)
 
     # Plot m vs z.  (Wrongly called e here, but that's what it means.)
-    tests.mean_e_vs_z(z[ng], e_ng, m_ng, c0, g_app[ng], e_true[ng], epsf_ng, w_ng, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$, normal $w$', filename='mvsz_ngmix.pdf')
+    tests.mean_e_vs_z(z_ng, e_ng, m_ng, c0, g_app_ng, e_true_ng, epsf_ng, w_ng, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$, normal $w$', filename='mvsz_ngmix.pdf')
 
     # Make unweighted version
     w1 = numpy.ones(len(e_ng))
-    tests.mean_e_vs_z(z[ng], e_ng, m_ng, c0, g_app[ng], e_true[ng], epsf_ng, w1, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$, $w=1$', filename='mvsz_ngmix_unweighted.pdf')
+    tests.mean_e_vs_z(z_ng, e_ng, m_ng, c0, g_app_ng, e_true_ng, epsf_ng, w1, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$, $w=1$', filename='mvsz_ngmix_unweighted.pdf')
 
     # Load im3shape catalog
-    num_im, r_im, rgp_im, f_im, snrw_im, flag_im, e_im, snrr_im, disc_im, niter_im, chisq_im, minres_im, maxres_im, info_im, epsf_im, fwhmpsf_im, trcov_im, detcov_im, varr_im, vare_im = tests.load_im_data()
-    im = numpy.in1d(num_true, num_im)
-    assert numpy.all(num_true[im] == num_im)
+    im = tests.load_matched('im3shape')
+    num_im, r_im, rgp_im, f_im, snrw_im, flag_im, e_im, snrr_im, disc_im, niter_im, chisq_im, minres_im, maxres_im, info_im, epsf_im, fwhmpsf_im, trcov_im, detcov_im, varr_im, vare_im = tuple(im.get(name, []) for name in tests.IM_COLUMNS)
     good_im = (flag_im == 0) & (info_im == 0)
     mask_im = good_im & (snrw_im > 15) & (rgp_im > 1.2)
 
-    # Find indices between ng and im catalogs
-    # im_ng gives the index into the im catalog to get objects also in ng
-    im_ng = numpy.in1d(num_im, num_ng)
-    # ng_im gives the index into the ng catalog to get objects also in im
-    ng_im = numpy.in1d(num_ng, num_im)
-    assert numpy.all(num_im[im_ng] == num_ng[ng_im])
-
-    # mask_c is the combined mask.  Can be used with any of the catalogs by first
-    # applying the appropriate mask to get objects that are in both.
-    assert len(mask_ng[ng_im]) == len(mask_im[im_ng])
-    mask_c = mask_ng[ng_im] & mask_im[im_ng]
-    assert len(mask_c) == len(num_true[ng & im])
-    assert len(mask_c) == len(num_ng[ng_im])
-    assert len(mask_c) == len(num_im[im_ng])
+    # Find the objects in both the ng and im catalogs: num_ng[i_ng] == num_im[i_im]
+    i_ng, i_im = tests.join_sorted(num_ng, num_im)
+
+    # mask_c is the combined mask for the objects in both.
+    mask_c = mask_ng[i_ng] & mask_im[i_im]
 
     # m_true for the matched catalog:
-    print 'm_true for matched catalog: ',tests.calc_mc(e_true[ng&im][mask_c], g_app[ng&im][mask_c])[:2]
-    s_match = 1. + numpy.sum(w_ng[ng_im] * m_ng[ng_im]) / numpy.sum(w_ng[ng_im])
-    print 'm_ngmix for matched catalog: ',tests.calc_mc(e_ng[ng_im][mask_c]/s_match, g_app[ng&im][mask_c], w=w_ng[ng_im])[:2]
+    print 'm_true for matched catalog: ',tests.calc_mc(e_true_ng[i_ng][mask_c], g_app_ng[i_ng][mask_c])[:2]
+    s_match = 1. + numpy.sum(w_ng[i_ng] * m_ng[i_ng]) / numpy.sum(w_ng[i_ng])
+    print 'm_ngmix for matched catalog: ',tests.calc_mc(e_ng[i_ng][mask_c]/s_match, g_app_ng[i_ng][mask_c], w=w_ng[i_ng][mask_c])[:2]
     s_ave = 1. + numpy.sum(w_ng[mask_ng] * m_ng[mask_ng]) / numpy.sum(w_ng[mask_ng])
-    print 'm_ngmix ngmix cuts: ',tests.calc_mc(e_ng[mask_ng]/s_ave, g_app[ng][mask_ng], w_ng[mask_ng])[:2]
+    print 'm_ngmix ngmix cuts: ',tests.calc_mc(e_ng[mask_ng]/s_ave, g_app_ng[mask_ng], w_ng[mask_ng])[:2]
 
     # m vs z for ngmix shapes on the matched catalog
-    tests.mean_e_vs_z(z[ng&im], e_ng[ng_im], m_ng[ng_im], c0[ng_im], g_app[ng&im], e_true[ng&im], epsf_ng[ng_im], w_ng[ng_im], mask_c, title=r'ngmix shears on matched selection, normal $w$', filename='mvsz_ngmix_match.pdf')
-    tests.mean_e_vs_z(z[ng&im], e_ng[ng_im], m_ng[ng_im], c0[ng_im], g_app[ng&im], e_true[ng&im], epsf_ng[ng_im], w1[ng_im], mask_c, title=r'ngmix shears on matched selection, $w=1$', filename='mvsz_ngmix_match_unweighted.pdf')
+    tests.mean_e_vs_z(z_ng[i_ng], e_ng[i_ng], m_ng[i_ng], c0[i_ng], g_app_ng[i_ng], e_true_ng[i_ng], epsf_ng[i_ng], w_ng[i_ng], mask_c, title=r'ngmix shears on matched selection, normal $w$', filename='mvsz_ngmix_match.pdf')
+    tests.mean_e_vs_z(z_ng[i_ng], e_ng[i_ng], m_ng[i_ng], c0[i_ng], g_app_ng[i_ng], e_true_ng[i_ng], epsf_ng[i_ng], w1[i_ng], mask_c, title=r'ngmix shears on matched selection, $w=1$', filename='mvsz_ngmix_match_unweighted.pdf')
 
 
-def main():
+def main(compare_bases=False, nproc=1):
+    # With compare_bases, the NBC uses the basis that does best in cross validation
+    # (compare_nbc_bases, with nproc processes) rather than NBC_BASIS.
     import numpy
-    num_im, r_im, rgp_im, f_im, snrw_im, flag_im, e_im, snrr_im, disc_im, niter_im, chisq_im, minres_im, maxres_im, info_im, epsf_im, fwhmpsf_im, trcov_im, detcov_im, varr_im, vare_im = tests.load_im_data()
-    num_ng, t_ng, flux_ng, snr_ng, tsnr_ng, flag_ng, tr_ng, snrr_ng, flagr_ng, e_ng, epsf_ng, tpsf_ng, sens_ng, chisq_ng, trcov_ng = tests.load_ng_data()
-    num_true, r_true, f_true, e_true, e_raw, g_app, id_cosmos, srcn, z, use = tests.load_truth()
-    great3, w_great3 = tests.load_great3(id_cosmos)
-    ng = numpy.in1d(num_true, num_ng)
-    im = numpy.in1d(num_true, num_im)
+    # The measurements, each along with the truth for the same objects.
+    im = tests.load_matched('im3shape')
+    ng = tests.load_matched('ngmix')
+    num_im, r_im, rgp_im, f_im, snrw_im, flag_im, e_im, snrr_im, disc_im, niter_im, chisq_im, minres_im, maxres_im, info_im, epsf_im, fwhmpsf_im, trcov_im, detcov_im, varr_im, vare_im = tuple(im.get(name, []) for name in tests.IM_COLUMNS)
+    num_ng, t_ng, flux_ng, snr_ng, tsnr_ng, flag_ng, tr_ng, snrr_ng, flagr_ng, e_ng, epsf_ng, tpsf_ng, sens_ng, chisq_ng, trcov_ng = tuple(ng[name] for name in tests.NG_COLUMNS)
+    r_true_im, e_true_im, g_app_im, z_im = im['true_rad'], im['true_e'], im['true_g_app'], im['true_z']
+    r_true_ng, e_true_ng, g_app_ng, z_ng = ng['true_rad'], ng['true_e'], ng['true_g_app'], ng['true_z']
+    great3, w_great3 = tests.load_great3(tests.load_truth()[6])
 
     bade = numpy.abs(e_im) > numpy.max(numpy.abs(e_im)) * 0.999
     good_im = (flag_im == 0) & (info_im == 0) & ~bade
     snr15_im = good_im & (snrr_im > 15)
-    tests.check_meas(r_true[im], r_im, e_true[im], e_im, snr15_im, filename='check.pdf')
+    tests.check_meas(r_true_im, r_im, e_true_im, e_im, snr15_im, filename='check.pdf')
 
     good_ng = (flag_ng == 0) & (flagr_ng == 0) & (sens_ng.real > 0) & (sens_ng.imag > 0)
     snr15_ng = good_ng & (snrr_ng > 15)
-    tests.check_meas(r_true[ng], t_ng, e_true[ng], e_ng, snr15_ng, filename='check.pdf')
+    tests.check_meas(r_true_ng, t_ng, e_true_ng, e_ng, snr15_ng, filename='check.pdf')
 
-    tests.mean_e_vs_r(r_im, e_im, g_app, snr15_im, title=r'$S/N > 15$, Measured shapes', filename='evsr_snr15_im.pdf')
-    tests.mean_e_vs_r(r_im, e_true, g_app, snr15_im, title=r'$S/N > 15$, True shapes', filename='evsr_snr15_true.pdf')
+    tests.mean_e_vs_r(r_im, e_im, g_app_im, snr15_im, title=r'$S/N > 15$, Measured shapes', filename='evsr_snr15_im.pdf')
+    tests.mean_e_vs_r(r_im, e_true_im, g_app_im, snr15_im, title=r'$S/N > 15$, True shapes', filename='evsr_snr15_true.pdf')
 
     snr10 = (flag_im == 0) & (snrr_im > 10)
     tests.niter_vs_r_e(r_im, e_im, niter, snr10, r'Measured size, shape, $(S/N)_r > 10$', filename='meas_snrgt10.png')
@@ -2352,25 +2491,29 @@ def main():
     mask_im = good_im & (snrw_im > 15) & (rgp_im > 1.2)
     w_im = 1. / ( 2.*0.22**2 + 2./snrr_im**2)
 
-    global_alpha = tests.linear_fit(e_true[mask]-g_app[mask], e_psf[mask])[0].real
-    global_m = tests.linear_fit(e_true[mask]-g_app[mask], g_app[mask])[0].real
+    global_alpha = tests.linear_fit(e_true_im[mask_im]-g_app_im[mask_im], epsf_im[mask_im])[0].real
+    global_m = tests.linear_fit(e_true_im[mask_im]-g_app_im[mask_im], g_app_im[mask_im])[0].real
 
-    m_corr, c_corr = tests.nbc(e_im, e_true[im], g_app[im], epsf_im, rgp_im, snrw_im, disc_im, w_im, mask_im, title='NBC with $(S/N)_w$, with $(S/N)_r$ cut', filename='nbc.pdf')
-    tests.mean_e_vs_z(z[im], e_im, m_corr, c_corr, g_app[im], e_true[im], epsf_im, w_im, mask_im, title=r'im3shape $(S/N)_r > 15$, $rgp > 1.2$', filename='evsz.pdf')
+    basis = None
+    if compare_bases:
+        basis = tests.compare_nbc_bases(e_im, e_true_im, g_app_im, epsf_im, rgp_im, snrw_im, disc_im, w_im, mask_im, num_im, nproc=nproc)
+    m_corr, c_corr = tests.nbc(e_im, e_true_im, g_app_im, epsf_im, rgp_im, snrw_im, disc_im, w_im, mask_im, title='NBC with $(S/N)_w$, with $(S/N)_r$ cut', filename='nbc.pdf', basis=basis)
+    tests.mean_e_vs_z(z_im, e_im, m_corr, c_corr, g_app_im, e_true_im, epsf_im, w_im, mask_im, title=r'im3shape $(S/N)_r > 15$, $rgp > 1.2$', filename='evsz.pdf', id=tests.sim_id(num_im))
 
     c0 = numpy.zeros(len(e_ng))
     m_ng = (sens_ng.real + sens_ng.imag)/2. - 1.
     w_ng = 1. / (2 * 0.22**2 + trcov_ng)
     mask_ng = good_ng & (snrr_ng > 15) & (tr_ng/tpsf_ng > 0.15)
-    tests.mean_e_vs_z(z[ng], e_ng, m_ng, c0, g_app[ng], e_true[ng], epsf_ng, w_ng, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$', filename='evsz.pdf')
+    tests.mean_e_vs_z(z_ng, e_ng, m_ng, c0, g_app_ng, e_true_ng, epsf_ng, w_ng, mask_ng, title=r'ngmix $(S/N)_r > 15$, $Tr/Tp > 0.15$', filename='evsz.pdf', id=tests.sim_id(num_ng))
 
-    im_ng = numpy.in1d(num_im, num_ng)
-    ng_im = numpy.in1d(num_ng, num_im)
-    mask_c = mask_ng[ng_im] & mask_im[im_ng]
+    # The objects in both catalogs: num_im[i_im] == num_ng[i_ng]
+    i_im, i_ng = tests.join_sorted(num_im, num_ng)
+    mask_c = mask_ng[i_ng] & mask_im[i_im]
     # m,c for the matched catalog:
-    tests.calc_mc(e_true[ng&im][mask_c], g_app[ng&im][mask_c])
+    tests.calc_mc(e_true_im[i_im][mask_c], g_app_im[i_im][mask_c])
     # As a function of z:
-    tests.calc_mc(e_true[ng&im&(z<0.8)][mask_c[z[ng&im]<0.8]], g_app[ng&im&(z<0.8)][mask_c[z[ng&im]<0.8]])
+    lowz = mask_c & (z_im[i_im] < 0.8)
+    tests.calc_mc(e_true_im[i_im][lowz], g_app_im[i_im][lowz])
 
 def figure11():
     # Make figure 11
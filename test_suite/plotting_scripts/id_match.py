@@ -0,0 +1,65 @@
+import numpy
+
+def _strictly_increasing(id, chunk_size):
+    """Whether id is sorted with no repeats, checked chunk_size at a time so that a memory
+    mapped column is never read all at once.
+    """
+    for start in range(0, len(id), chunk_size):
+        a = numpy.asarray(id[start:start+chunk_size+1])
+        if numpy.any(a[1:] <= a[:-1]):
+            return False
+    return True
+
+def _check_unique(sorted_id, name, chunk_size):
+    for start in range(0, len(sorted_id), chunk_size):
+        a = numpy.asarray(sorted_id[start:start+chunk_size+1])
+        dup = a[1:][a[1:] == a[:-1]]
+        if len(dup) > 0:
+            raise ValueError("%s has repeated ids, e.g. %s"%(name, dup[:5]))
+
+def _sorted(id, name, chunk_size):
+    """Returns (order, id[order]), with None as the order if id is already sorted.
+    """
+    if _strictly_increasing(id, chunk_size):
+        return None, id
+    id = numpy.asarray(id)
+    if not id.dtype.isnative:
+        # FITS columns are big endian, which is much slower to sort.
+        id = id.astype(id.dtype.newbyteorder('='))
+    order = numpy.argsort(id, kind='mergesort')
+    sorted_id = id[order]
+    _check_unique(sorted_id, name, chunk_size)
+    return order, sorted_id
+
+def match(id1, id2, chunk_size=10000000):
+    """Find the objects that are in both of two catalogs, by their ids.
+
+    Returns index1, index2 such that id1[index1] == id2[index2], in order of increasing id.
+
+    The ids can be in any order, and can be memory mapped columns (e.g. from numpy.load with
+    mmap_mode='r').  Each list of ids is only sorted if it isn't already, and the matching is
+    done chunk_size ids of id1 at a time with a binary search in the sorted id2, so the only
+    arrays as long as the catalogs are the sort orders.  Raises ValueError if either list of
+    ids has any repeats, since then there is no one to one match.
+    """
+    order1, sorted1 = _sorted(id1, 'id1', chunk_size)
+    order2, sorted2 = _sorted(id2, 'id2', chunk_size)
+    n2 = len(sorted2)
+
+    index1 = []
+    index2 = []
+    for start in range(0, len(sorted1), chunk_size):
+        a = numpy.asarray(sorted1[start:start+chunk_size])
+        k = numpy.searchsorted(sorted2, a)
+        found = k < n2
+        found[found] = numpy.asarray(sorted2[k[found]]) == a[found]
+        index1.append(start + numpy.where(found)[0])
+        index2.append(k[found])
+    index1 = numpy.concatenate(index1) if index1 else numpy.zeros(0, dtype=int)
+    index2 = numpy.concatenate(index2) if index2 else numpy.zeros(0, dtype=int)
+
+    if order1 is not None:
+        index1 = order1[index1]
+    if order2 is not None:
+        index2 = order2[index2]
+    return index1, index2
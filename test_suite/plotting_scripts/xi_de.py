@@ -1,6 +1,7 @@
 import pyfits
 import numpy
 import treecorr
+import id_match
 
 def plot_dxi(gg, filename, sqrtn=1, label=None, ximinus=False):
     import matplotlib.pyplot as plt
@@ -141,75 +142,132 @@ def plot_xi(gg, filename):
     plt.savefig(filename)
 
 
+# The kernels made by EBKernel.for_binning, so that calculateEB on the same binning again (e.g.
+# plotting the same gg twice) reuses the kernel, along with its matrix for the last varxi.
+# Cleared once it has MAX_EB_KERNELS of them.
+_eb_kernels = {}
+MAX_EB_KERNELS = 16
+
+class EBKernel(object):
+    """The E/B mode decomposition of xi+ and xi- for one binning.
+
+    Everything calculateEB does is linear in xi+ and xi-, so for a given binning (and
+    varxi, which sets the weights of the fits for the parts of the integrals we can't do)
+    it is a single matrix, which is applied to any number of xi+, xi- at once.
+    """
+    def __init__(self, logr, meanlogr, bin_size):
+        self.logr = numpy.asarray(logr)
+        self.meanlogr = numpy.asarray(meanlogr)
+        self.bin_size = bin_size
+
+        # Make s a matrix, so we can eventually do the integral by doing a matrix product.
+        r = numpy.exp(self.logr)
+        meanr = numpy.exp(self.meanlogr) # Use the actual mean r for each bin
+        s = numpy.outer(1./r, meanr)
+        ssq = s*s
+
+        # xip_E(R) = 1/2 (xip(R) + xim(R) + int(dlogr xim(r) (4 - 12 R^2/r^2) H(r-R)
+        # Let Gm be the factor we multiply by xim.  Note: s = r/R
+        self.Gm = numpy.zeros_like(s)
+        self.Gm[s>1.] = 4. - 12./ssq[s>1.]
+
+        # xim_E(R) = 1/2 (xip(R) + xim(R) + int(dlogr xip(r) (4 - 12 r^2/R^2) r^2/R^2 H(R-r)
+        # Let Gp be the factor we multiply by xip.
+        self.Gp = numpy.zeros_like(s)
+        self.Gp[s<1.] = (4. - 12.*ssq[s<1.]) * ssq[s<1.]
+
+        self._varxi = None
+
+    @classmethod
+    def for_binning(cls, logr, meanlogr, bin_size):
+        """The kernel for this binning, which is only made the first time it is needed.
+        """
+        key = (numpy.asarray(logr, dtype=float).tobytes(),
+               numpy.asarray(meanlogr, dtype=float).tobytes(), float(bin_size))
+        kernel = _eb_kernels.get(key)
+        if kernel is None:
+            if len(_eb_kernels) >= MAX_EB_KERNELS:
+                _eb_kernels.clear()
+            kernel = _eb_kernels[key] = cls(logr, meanlogr, bin_size)
+        return kernel
+
+    @classmethod
+    def for_gg(cls, gg):
+        return cls.for_binning(gg.logr, gg.meanlogr, gg.bin_size)
+
+    def set_varxi(self, varxi):
+        """Make the matrix for this varxi.  This sets self.matrix, which takes the
+        concatenation of xip and xim to that of xip_E, xip_B, xim_E, xim_B, and self.varxip,
+        self.varxim.
+        """
+        varxi = numpy.asarray(varxi)
+        if self._varxi is not None and numpy.array_equal(varxi, self._varxi):
+            return
+        n = len(self.logr)
+        r = numpy.exp(self.logr)
+        bs = self.bin_size
+        # The matrices that pick out xip and xim from the concatenation of the two
+        Xp = numpy.hstack([ numpy.eye(n), numpy.zeros((n,n)) ])
+        Xm = numpy.hstack([ numpy.zeros((n,n)), numpy.eye(n) ])
+
+        # Note that dlogr = bin_size
+        xipE = 0.5 * (Xp + Xm + bs * self.Gm.dot(Xm))
+        ximE = 0.5 * (Xp + Xm + bs * self.Gp.dot(Xp))
+        xipB = Xp - xipE
+        ximB = Xm - ximE
+
+        # The variance of each of these is the original varxi plus an extra term
+        # dGpxip = int_r=0..2R [1/4 dlogr^2 (T+(s)^2 + T-(s)^2) Var(xi)]
+        self.varxip = varxi + (self.Gp**2).dot(varxi) * 0.25 * bs**2
+        self.varxim = varxi + (self.Gm**2).dot(varxi) * 0.25 * bs**2
+
+        # In both cases, there is a part of the integral we cannot do.  We make the ansatz that
+        # the B mode at the largest scales is consistent with zero.
+        nmean = int(numpy.ceil(numpy.log(10) / bs))  # Average over the last factor of 2 in scales.
+
+        # For xip, using the Gmxim integral, the unknown part is of the form a + b R^2
+        k = numpy.arange(n-nmean, n)
+        sw = 1./numpy.sqrt(self.varxip[k])
+        A = numpy.vstack([ numpy.ones(len(k)) * sw, r[k]**2 * sw ]).T
+        ab = numpy.linalg.pinv(A).dot(sw[:,numpy.newaxis] * xipB[k])
+        fit = numpy.vstack([ numpy.ones(n), r**2 ]).T.dot(ab)
+        xipE += fit
+        xipB -= fit
+
+        # For xim, using the Gpxip integral, the unknown part is of the form a/R^2 + b/R^4
+        k = numpy.concatenate([ numpy.arange(nmean//2), numpy.arange(n-nmean, n) ])
+        sw = 1./numpy.sqrt(self.varxim[k])
+        A = numpy.vstack([ r[k]**-2 * sw, r[k]**-4 * sw ]).T
+        ab = numpy.linalg.pinv(A).dot(sw[:,numpy.newaxis] * ximB[k])
+        fit = numpy.vstack([ r**-2, r**-4 ]).T.dot(ab)
+        ximE += fit
+        ximB -= fit
+
+        self.matrix = numpy.vstack([ xipE, xipB, ximE, ximB ])
+        self._varxi = varxi.copy()
+
+    def apply(self, xip, xim, varxi):
+        """The E and B modes of xip, xim, which may be stacks of any number of xi+, xi- (with
+        shape (..., nbins)), all of which use the fits for this varxi.
+
+        Returns xip_E, xip_B, xim_E, xim_B, each with the same shape as xip.
+        """
+        self.set_varxi(varxi)
+        n = len(self.logr)
+        eb = numpy.concatenate([xip, xim], axis=-1).dot(self.matrix.T)
+        return [ eb[...,i*n:(i+1)*n] for i in range(4) ]
+
+    def propagate(self, cov, varxi):
+        """The covariance matrix of (xip_E, xip_B, xim_E, xim_B) given that of (xip, xim).
+        """
+        self.set_varxi(varxi)
+        return self.matrix.dot(cov).dot(self.matrix.T)
+
+
 def calculateEB(gg):
-    # Make s a matrix, so we can eventually do the integral by doing a matrix product.
-    r = numpy.exp(gg.logr)
-    meanr = numpy.exp(gg.meanlogr) # Use the actual mean r for each bin
-    s = numpy.outer(1./r, meanr)  
-    ssq = s*s
-
-    # xip_E(R) = 1/2 (xip(R) + xim(R) + int(dlogr xim(r) (4 - 12 R^2/r^2) H(r-R)
-    # Let Gm be the factor we multiply by xim.  Note: s = r/R
-    Gm = numpy.zeros_like(s)
-    Gm[s>1.] = 4. - 12./ssq[s>1.]
-
-    # xim_E(R) = 1/2 (xip(R) + xim(R) + int(dlogr xip(r) (4 - 12 r^2/R^2) r^2/R^2 H(R-r)
-    # Let Gp be the factor we multiply by xip.
-    Gp = numpy.zeros_like(s)
-    Gp[s<1.] = (4. - 12.*ssq[s<1.]) * ssq[s<1.]
-
-    # Now do the integral by taking the matrix products.
-    # Note that dlogr = bin_size
-    Gpxip = Gp.dot(gg.xip) * gg.bin_size
-    Gmxim = Gm.dot(gg.xim) * gg.bin_size
-
-    # The variance of each of these is the original varxi plus an extra term
-    # dGpxip = int_r=0..2R [1/4 dlogr^2 (T+(s)^2 + T-(s)^2) Var(xi)]
-    varGpxip = (Gp**2).dot(gg.varxi) * 0.25 * gg.bin_size**2
-    varGmxim = (Gm**2).dot(gg.varxi) * 0.25 * gg.bin_size**2
-
-    varxip = gg.varxi + varGpxip
-    varxim = gg.varxi + varGmxim
-
-    xipE = 0.5 * (gg.xip + gg.xim + Gmxim)
-    ximE = 0.5 * (gg.xip + gg.xim + Gpxip)
-    xipB = gg.xip - xipE
-    ximB = gg.xim - ximE
-
-    # In both cases, there is a part of the integral we cannot do.  We make the ansatz that
-    # the B mode at the largest scales is consistent with zero.
-    nmean = int(numpy.ceil(numpy.log(10) / gg.bin_size))  # Average over the last factor of 2 in scales.
-
-    # For xip, using the Gmxim integral, the unknown part is of the form a + b R^2
-    y = xipB[-nmean:]
-    print 'y = ',y
-    x = r[-nmean:]
-    print 'x = ',x
-    sw = 1./numpy.sqrt(varxip[-nmean:])
-    A = numpy.vstack([ numpy.ones(len(x)) * sw, x**2 * sw ]).T
-    print 'A = ',A
-    a,b = numpy.linalg.lstsq(A,y*sw)[0]
-    print 'a,b = ',a,b
-
-    xipE += a + b*r**2
-    xipB -= a + b*r**2
-    print 'xipE -> ',xipE
-    print 'xipB -> ',xipB
-
-    # For xim, using the Gpxip integral, the unknown part is of the form a/R^2 + b/R^4
-    y = numpy.concatenate([ximB[:nmean/2], ximB[-nmean:]])
-    x = numpy.concatenate([r[:nmean/2], r[-nmean:]])
-    sw = 1./numpy.sqrt(numpy.concatenate([varxim[:nmean/2], varxim[-nmean:]]))
-    print 'y = ',y
-    A = numpy.vstack([ x**-2 * sw, x**-4 * sw]).T
-    print 'A = ',A
-    a,b = numpy.linalg.lstsq(A,y*sw)[0]
-    print 'a,b = ',a,b
-
-    ximE += a*r**-2 + b*r**-4
-    ximB -= a*r**-2 + b*r**-4
-
-    return xipE, xipB, ximE, ximB, varxip, varxim
+    kernel = EBKernel.for_gg(gg)
+    xipE, xipB, ximE, ximB = kernel.apply(gg.xip, gg.xim, gg.varxi)
+    return xipE, xipB, ximE, ximB, kernel.varxip.copy(), kernel.varxim.copy()
 
 def smooth(xi, n):
     """Return a smoother version of xi where the values are the average of +-n points."""
@@ -393,10 +451,11 @@ def load_data():
     print 'ng selection includes %d galaxies'%numpy.sum(all_ng)
     print 'im selection includes %d galaxies'%numpy.sum(all_im)
 
-    ngmask = numpy.in1d(ngcat['coadd_objects_id'], fcat['coadd_objects_id'][all_ng])
-    immask = numpy.in1d(imcat['coadd_objects_id'], fcat['coadd_objects_id'][all_im])
+    fid = fcat['coadd_objects_id']
+    ngindex = id_match.match(fid[all_ng], ngcat['coadd_objects_id'])[1]
+    imindex = id_match.match(fid[all_im], imcat['coadd_objects_id'])[1]
 
-    return fcat, ngcat[ngmask], imcat[immask]
+    return fcat, ngcat[ngindex], imcat[imindex]
 
 def match_cats(raw_fcat, raw_ngcat, raw_imcat):
     print 'len raw cats = ',len(raw_fcat), len(raw_ngcat), len(raw_imcat)
@@ -411,12 +470,17 @@ def match_cats(raw_fcat, raw_ngcat, raw_imcat):
     match = all_ng & all_im
     print 'match includes %d galaxies'%numpy.sum(match)
 
-    ngmask = numpy.in1d(raw_ngcat['coadd_objects_id'], raw_fcat['coadd_objects_id'][match])
-    immask = numpy.in1d(raw_imcat['coadd_objects_id'], raw_fcat['coadd_objects_id'][match])
-
-    fcat = raw_fcat[match]
-    ngcat = raw_ngcat[ngmask]
-    imcat = raw_imcat[immask]
+    # Line up the three catalogs by id.  (They don't need to be in the same order to start with.)
+    rows = numpy.where(match)[0]
+    fid = raw_fcat['coadd_objects_id'][rows]
+    find, ngindex = id_match.match(fid, raw_ngcat['coadd_objects_id'])
+    k, imindex = id_match.match(fid[find], raw_imcat['coadd_objects_id'])
+    findex = rows[find[k]]
+    ngindex = ngindex[k]
+
+    fcat = raw_fcat[findex]
+    ngcat = raw_ngcat[ngindex]
+    imcat = raw_imcat[imindex]
     print 'len matched cats = ',len(fcat), len(ngcat),len(imcat)
 
     return fcat, ngcat, imcat
@@ -480,20 +544,24 @@ def compute_xi(ra, dec, e1, e2, w, s):
     #e1c = e1 / means
     #e2c = e2 / means
 
+    # We want xi = <e e> / <s s> in each bin, which used to be a GG correlation divided by a
+    # KK correlation of s.  With weights w s and shears e/s, the GG correlation alone is
+    #     sum w_i s_i w_j s_j (e_i/s_i) (e_j/s_j) / sum w_i s_i w_j s_j
+    #   = sum w_i w_j e_i e_j / sum w_i w_j s_i s_j
+    # which is the same thing, with one tree and one pass through the pairs.
+    # (The weight in each bin is then the KK normalisation, sum w_i w_j s_i s_j.)
+    s_ok = s != 0.
+    g1 = numpy.where(s_ok, e1 / numpy.where(s_ok, s, 1.), 0.)
+    g2 = numpy.where(s_ok, e2 / numpy.where(s_ok, s, 1.), 0.)
+
     # Build a TreeCorr catalog
-    cat = treecorr.Catalog(ra=ra, dec=dec, g1=e1, g2=e2, k=s, w=w, ra_units='deg', dec_units='deg')
+    cat = treecorr.Catalog(ra=ra, dec=dec, g1=g1, g2=g2, w=w*s, ra_units='deg', dec_units='deg')
 
     # Compute the correlation function
     gg = treecorr.GGCorrelation(bin_size=0.05, min_sep=0.1, max_sep=500, sep_units='arcmin', output_dots=True, verbose=2)
-    ss = treecorr.KKCorrelation(bin_size=0.05, min_sep=0.1, max_sep=500, sep_units='arcmin', output_dots=True, verbose=2)
 
     print 'Start corr2'
     gg.process(cat)
-    ss.process(cat)
-
-    gg.xip /= ss.xi
-    gg.xim /= ss.xi
-    gg.varxi /= ss.xi**2
 
     return gg
 
@@ -502,7 +570,10 @@ def compute_xi_ng(fcat, ngcat, mask=None):
     # Get the RA, Dec
     ra = fcat['ra']
     dec = fcat['dec']
-    ng = numpy.in1d(fcat['coadd_objects_id'], ngcat['coadd_objects_id'])
+    find, ngindex = id_match.match(fcat['coadd_objects_id'], ngcat['coadd_objects_id'])
+    if mask is not None:
+        find = find[mask[ngindex]]
+        ngindex = ngindex[mask[ngindex]]
 
     # Get the shear data
     nge1 = ngcat['exp_e_1']
@@ -510,17 +581,17 @@ def compute_xi_ng(fcat, ngcat, mask=None):
     ngw = ngcat['exp_w']
     ngs = ngcat['exp_e_sens_avg']
 
-    if mask is None:
-        return compute_xi(ra[ng], dec[ng], nge1, nge2, ngw, ngs)
-    else:
-        return compute_xi(ra[ng][mask], dec[ng][mask], nge1[mask], nge2[mask], ngw[mask], ngs[mask])
+    return compute_xi(ra[find], dec[find], nge1[ngindex], nge2[ngindex], ngw[ngindex], ngs[ngindex])
 
 
 def compute_xi_im(fcat, imcat, mask=None):
     # Get the RA, Dec
     ra = fcat['ra']
     dec = fcat['dec']
-    im = numpy.in1d(fcat['coadd_objects_id'], imcat['coadd_objects_id'])
+    find, imindex = id_match.match(fcat['coadd_objects_id'], imcat['coadd_objects_id'])
+    if mask is not None:
+        find = find[mask[imindex]]
+        imindex = imindex[mask[imindex]]
 
     # Get the shear data
     ime1 = imcat['e1'] - imcat['nbc_c1']
@@ -529,10 +600,7 @@ def compute_xi_im(fcat, imcat, mask=None):
     numpy.clip(imw, 0.0, 0.24**-2, imw)
     ims = imcat['nbc_m'] + 1.
 
-    if mask is None:
-        return compute_xi(ra[im], dec[im], ime1, ime2, imw, ims)
-    else:
-        return compute_xi(ra[im][mask], dec[im][mask], ime1[mask], ime2[mask], imw[mask], ims[mask])
+    return compute_xi(ra[find], dec[find], ime1[imindex], ime2[imindex], imw[imindex], ims[imindex])
 
 
 
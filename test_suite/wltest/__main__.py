@@ -1,15 +1,67 @@
-from .catalogs import Catalog
+from .catalogs import Catalog, ChunkedCatalog
 from .suite import GreenSuite, Extrapolation
 import sys
 
+def yes_no(value):
+	if value.lower() in ['yes', 'true', '1']: return True
+	if value.lower() in ['no', 'false', '0']: return False
+	raise ValueError("Expected yes or no, not %r" % value)
+
+#Settings that can follow the directory names on the command line as
+#key=value, e.g. python -m wltest dir1 dir2 errors=jackknife npatch=100
+SUITE_OPTIONS = {
+	'errors': str,
+	'npatch': int,
+	'nboot': int,
+	'nproc': int,
+	'use_cache': yes_no,
+}
+
+def suite_options(args):
+	"""The GreenSuite keyword arguments from the key=value settings in args."""
+	options = {}
+	for arg in args:
+		key, _, value = arg.partition('=')
+		if key not in SUITE_OPTIONS or not value:
+			raise ValueError("Unknown setting %r: use %s" % (arg,
+				", ".join("%s=..." % k for k in sorted(SUITE_OPTIONS))))
+		options[key] = SUITE_OPTIONS[key](value)
+	if options.get('errors') not in [None, 'jackknife', 'bootstrap']:
+		raise ValueError("errors should be jackknife or bootstrap, not %r" % options['errors'])
+	return options
+
 def suite_compare():
 	dirname1 = 	sys.argv[1]
 	dirname2 = 	sys.argv[2]
 
+	options = suite_options(sys.argv[3:])
+
 	cat1 = Catalog.from_directory(dirname1)
 	cat2 = Catalog.from_directory(dirname2)
 
-	suite = GreenSuite()
+	suite = GreenSuite(**options)
+	print
+	print "Running tests"
+	print
+	filenames = suite.run(cat1, cat2)
+	print
+	if filenames:
+		print "Made files:"
+		for filename in filenames:
+			print " - ", filename
+
+def suite_compare_chunked():
+	#For catalogs too big to load - the same as suite_compare but reading
+	#the catalogs a chunk at a time
+	dirname1 = 	sys.argv[1]
+	dirname2 = 	sys.argv[2]
+
+	options = suite_options(sys.argv[3:])
+
+	cat1 = ChunkedCatalog.from_directory(dirname1)
+	cat2 = ChunkedCatalog.from_directory(dirname2)
+
+	suite = GreenSuite(**options)
 	print
 	print "Running tests"
 	print
@@ -24,13 +76,14 @@ def suite_extrapolate():
 	testbed_old = sys.argv[1]
 	testbed_new = sys.argv[2]
 	full_old = sys.argv[3]
+	options = suite_options(sys.argv[4:])
 
 	testbed_old = Catalog.from_directory(testbed_old)
 	testbed_new = Catalog.from_directory(testbed_new)
 	full_old = Catalog.from_directory(full_old)
 	
-	testbed_suite = GreenSuite()
-	full_suite = GreenSuite()
+	testbed_suite = GreenSuite(**options)
+	full_suite = GreenSuite(**options)
 
 	filenames = testbed_suite.run(testbed_old, testbed_new)
 	filenames = full_suite.run(full_old)
@@ -45,8 +98,9 @@ def suite_extrapolate():
 
 def suite_single():
 	dirname = sys.argv[1]
+	options = suite_options(sys.argv[2:])
 	cat = Catalog.from_directory(dirname)
-	suite = GreenSuite()
+	suite = GreenSuite(**options)
 	print
 	filenames = suite.run(cat)
 	print
@@ -58,4 +112,5 @@ def suite_single():
 if __name__ == '__main__':
 	# suite_extrapolate()
 	suite_compare()
+	# suite_compare_chunked()
 	# suite_single()
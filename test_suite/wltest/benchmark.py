@@ -0,0 +1,141 @@
+"""
+Time the suite on synthetic catalogs of different sizes, and check that it
+recovers the PSF leakage (and the other statistics) that were put into them.
+
+    python -m wltest.benchmark --sizes 1e5 1e6 1e7 --workdir wltest_benchmark
+
+The catalogs are made with synthetic.make_catalogs the first time each size is
+run and re-used after that.  For each size this prints how long it took to
+load the catalogs (Catalog.from_directory), select and intersect them, and to
+run each GreenSuite test, followed by each statistic against the truth.
+
+"""
+import numpy as np
+import argparse
+import json
+import time
+import os
+from .catalogs import Catalog, ChunkedCatalog
+from .suite import GreenSuite
+from . import synthetic
+
+#Statistics further than this many sigma from the truth fail the check
+MAX_SIGMA = 5.
+
+
+class Timer(object):
+    """Collects (label, seconds) for each step."""
+    def __init__(self):
+        self.timings = []
+
+    def __call__(self, label, function, *args, **kwargs):
+        t0 = time.time()
+        result = function(*args, **kwargs)
+        self.timings.append((label, time.time() - t0))
+        return result
+
+
+def catalog_dirs(workdir, n, seed=1):
+    """Make the synthetic catalogs for this size, if they are not already there."""
+    dirname = os.path.join(workdir, "n%d" % n)
+    truth = synthetic.load_truth(dirname)
+    if truth != json.loads(json.dumps(synthetic.make_truth(n, seed=seed))):
+        synthetic.make_catalogs(dirname, n, seed=seed)
+        truth = synthetic.load_truth(dirname)
+    return [os.path.join(dirname, flavour) for flavour in truth['flavours']], truth
+
+
+def run_size(workdir, n, chunked=False, nproc=1, seed=1):
+    """Time the steps of the suite on catalogs with n objects.
+    Returns the Timer, a dict (catalog name, test name) -> statistic, and the
+    expected statistics from synthetic.expected_statistics."""
+    (dir1, dir2), truth = catalog_dirs(workdir, n, seed)
+    timer = Timer()
+    if chunked:
+        cat1 = timer("load %s" % os.path.basename(dir1), ChunkedCatalog.from_directory, dir1)
+        cat2 = timer("load %s" % os.path.basename(dir2), ChunkedCatalog.from_directory, dir2)
+    else:
+        cat1 = timer("load %s" % os.path.basename(dir1), Catalog.from_directory, dir1, nproc=nproc)
+        cat2 = timer("load %s" % os.path.basename(dir2), Catalog.from_directory, dir2, nproc=nproc)
+
+    suite = GreenSuite(use_cache=False)
+    cat1 = timer("select %s" % cat1.name, suite.select, cat1)
+    cat2 = timer("select %s" % cat2.name, suite.select, cat2)
+    cat1, cat2 = timer("intersection", cat1.intersection, cat2)
+    timer("derive", lambda: [suite.derive(cat, suite.tests) for cat in (cat1, cat2)])
+
+    statistics = {}
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(dir1))
+    try:
+        for test in suite.tests:
+            if chunked:
+                [(results, statistic, filenames)] = timer(test.name, suite.execute_chunked,
+                    [test], cat1, cat2)
+            else:
+                results, statistic, filenames = timer(test.name, suite.execute_test,
+                    test, cat1, cat2)
+            for kind, cat_name, passed, stat in results:
+                statistics[(cat_name, test.name)] = np.array(stat, dtype=float)
+    finally:
+        os.chdir(cwd)
+
+    expected = synthetic.expected_statistics(truth, cat1.name, cat2.name)
+    return timer, statistics, expected
+
+
+def check_statistics(statistics, expected):
+    """Print each statistic against its expected value, and return whether they
+    are all within MAX_SIGMA."""
+    ok = True
+    for key in sorted(expected, key=str):
+        if key not in statistics:
+            continue
+        value, error = expected[key]
+        got = statistics[key]
+        sigma = np.abs(got - value) / error
+        good = np.all(sigma < MAX_SIGMA)
+        ok &= good
+        cat_name, test_name = key
+        print "   %-10s %-20s got %s  expected %s  (%s sigma)  %s" % (
+            cat_name or "pair", test_name, got, value, np.round(sigma, 1),
+            "OK" if good else "WRONG")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the wltest suite on synthetic catalogs")
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e5, 1e6, 1e7],
+        help="Numbers of objects in the catalogs")
+    parser.add_argument("--workdir", default="wltest_benchmark",
+        help="Where to put the catalogs and the suite's plots")
+    parser.add_argument("--chunked", action="store_true",
+        help="Use ChunkedCatalog rather than loading the catalogs into memory")
+    parser.add_argument("--nproc", type=int, default=4, help="Threads for loading the FITS files")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    table = []
+    all_ok = True
+    for n in args.sizes:
+        n = int(n)
+        print
+        print "Benchmarking with %d objects" % n
+        timer, statistics, expected = run_size(args.workdir, n, args.chunked, args.nproc, args.seed)
+        table.append((n, timer.timings))
+        print
+        print "Statistics vs. truth for %d objects:" % n
+        all_ok &= check_statistics(statistics, expected)
+
+    print
+    print "Time taken (s):"
+    labels = [label for label, t in table[0][1]]
+    print "   %-24s" % "" + "".join("%12d" % n for n, timings in table)
+    for i, label in enumerate(labels):
+        print "   %-24s" % label + "".join("%12.2f" % timings[i][1] for n, timings in table)
+    print
+    print "Recovered the injected truth" if all_ok else "Did NOT recover the injected truth"
+
+
+if __name__ == '__main__':
+    main()
@@ -2,49 +2,105 @@ import numpy as np
 from . import lazy_pylab as pylab
 
 class BinnedTrendMethods(object):
+    @staticmethod
+    def binned_stats(ys, bin, n, w=None):
+        # Counts, (weighted) means and standard errors in each of n bins, for
+        # each of the columns in ys, using one bincount per sum rather than
+        # a mask per bin.  Objects with bin outside 0..n-1 are ignored.
+        # Empty bins get nan, as mean() of an empty array would.
+        bin = np.asarray(bin)
+        use = (bin>=0) & (bin<n)
+        if not use.all():
+            bin = bin[use]
+            ys = [np.asarray(y)[use] for y in ys]
+            if w is not None: w = np.asarray(w)[use]
+        count = np.bincount(bin, minlength=n)[:n]
+        if w is None:
+            sumw = count.astype(float)
+            neff = sumw
+        else:
+            w = np.asarray(w, dtype=float)
+            sumw = np.bincount(bin, weights=w, minlength=n)[:n]
+            neff = sumw**2 / np.bincount(bin, weights=w**2, minlength=n)[:n]
+        y_mean = np.empty((len(ys), n))
+        y_err = np.empty((len(ys), n))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i, y in enumerate(ys):
+                y = np.asarray(y, dtype=float)
+                wy = y if w is None else w*y
+                y_mean[i] = np.bincount(bin, weights=wy, minlength=n)[:n] / sumw
+                # Take off the mean before squaring, for accuracy
+                dy2 = (y - y_mean[i][bin])**2
+                if w is not None: dy2 *= w
+                var = np.bincount(bin, weights=dy2, minlength=n)[:n] / sumw
+                y_err[i] = np.sqrt(var / neff)
+        y_mean[:,count==0] = np.nan
+        y_err[:,count==0] = np.nan
+        return count, y_mean, y_err
+
+    @staticmethod
+    def binned_trends(x_mid, ys, bin, n, w=None):
+        # The binned means of several y columns and a straight line fit
+        # to each of them against the bin centres x_mid.
+        # Returns count, y_mean, y_err, p with p[i] the fit for ys[i].
+        count, y_mean, y_err = BinnedTrendMethods.binned_stats(ys, bin, n, w=w)
+        p = np.polyfit(x_mid, y_mean.T, 1).T
+        return count, y_mean, y_err, p
+
     @staticmethod
     def binned_means(y, bin, n):
-        y_mean = []
-        y_std = []
-        for i in xrange(n):
-            w = (bin==i)
-            y_bin = y[w]
-            y_mean.append(y_bin.mean())
-            y_std.append(y_bin.std() / y_bin.size**0.5)
-        y_mean = np.array(y_mean)
-        y_std = np.array(y_std)
-        return y_mean, y_std
+        count, y_mean, y_err = BinnedTrendMethods.binned_stats([y], bin, n)
+        return y_mean[0], y_err[0]
 
     @staticmethod
     def find_equal_count_bins(x,n):
-        xs = np.sort(x)
-        m = len(xs)
-        r = np.linspace(0.0,1.0,n+1) * (m-1)
-        return xs[r.astype(int)]
+        # Only the n+1 order statistics are needed, so partition rather than sort
+        x = np.asarray(x)
+        m = len(x)
+        r = (np.linspace(0.0,1.0,n+1) * (m-1)).astype(int)
+        return np.partition(x, r)[r]
 
     @staticmethod
-    def binned_mean_equal_count_fit(x, y, n, **plot_args):
-        bins = BinnedTrendMethods.find_equal_count_bins(x, n)
-        bin = np.digitize(x, bins) - 1
-        y_mean, y_std = BinnedTrendMethods.binned_means(y, bin, n)
+    def equal_count_bin_index(cat, x_axis, n):
+        # The bins are kept with the catalog (if it is a Catalog), so all the
+        # tests that bin on the same column only need to sort it once.
+        key = ('equal_count_bins', x_axis, n)
+        derived = getattr(cat, 'derived', {})
+        if key not in derived:
+            x = cat[x_axis]
+            bins = BinnedTrendMethods.find_equal_count_bins(x, n)
+            derived[key] = bins, np.digitize(x, bins) - 1
+        return derived[key]
+
+    @staticmethod
+    def binned_mean_equal_count_fit(x, y, n, bins=None, **plot_args):
+        if bins is None:
+            bins = BinnedTrendMethods.find_equal_count_bins(x, n)
+            bin = np.digitize(x, bins) - 1
+        else:
+            bins, bin = bins
         x_mid = (bins[1:]+bins[:-1])/2.
-        return np.polyfit(x_mid, y_mean, 1)
+        count, y_mean, y_std, p = BinnedTrendMethods.binned_trends(x_mid, [y], bin, n)
+        return p[0]
 
 
     @staticmethod
-    def binned_mean_equal_count_plot(x, y, n, **plot_args):
-        bins = BinnedTrendMethods.find_equal_count_bins(x, n)
-        bin = np.digitize(x, bins) - 1
-        y_mean, y_std = BinnedTrendMethods.binned_means(y, bin, n)
+    def binned_mean_equal_count_plot(x, y, n, bins=None, **plot_args):
+        if bins is None:
+            bins = BinnedTrendMethods.find_equal_count_bins(x, n)
+            bin = np.digitize(x, bins) - 1
+        else:
+            bins, bin = bins
         x_mid = (bins[1:]+bins[:-1])/2.
-        pylab.errorbar(x_mid, y_mean, y_std, fmt='.', **plot_args)
-        return np.polyfit(x_mid, y_mean, 1), x_mid, y_mean, y_std 
+        count, y_mean, y_std, p = BinnedTrendMethods.binned_trends(x_mid, [y], bin, n)
+        pylab.errorbar(x_mid, y_mean[0], y_std[0], fmt='.', **plot_args)
+        return p[0], x_mid, y_mean[0], y_std[0]
 
     @staticmethod
     def binned_mean_equal_width_plot(x, y, n, **plot_args):
         bins = np.linspace(x.min(), x.max(), n+1)
         bin = np.digitize(x, bins) - 1
-        y_mean, y_std = BinnedTrendMethods.binned_means(y, bin, n)
         x_mid = (bins[1:]+bins[:-1])/2.
-        pylab.errorbar(x_mid, y_mean, y_std, fmt='.', **plot_args)
-        return np.polyfit(x_mid, y_mean, 1)  
+        count, y_mean, y_std, p = BinnedTrendMethods.binned_trends(x_mid, [y], bin, n)
+        pylab.errorbar(x_mid, y_mean[0], y_std[0], fmt='.', **plot_args)
+        return p[0]
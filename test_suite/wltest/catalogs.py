@@ -19,38 +19,238 @@ USELESS_COLUMNS = [
 
 USEFUL_COLUMNS = ['e1' , 'e2', 'mean_psf_e1_sky', 'mean_psf_e2_sky' , 'info_flag' , 'snr']
 
+#These are also read if they are there, since intersection needs them
+KEY_COLUMNS = ['coadd_objects_id', 'exposure']
+
+#And these, so that objects can be grouped into patches on the sky for
+#jackknife and bootstrap errors (see resampling.py)
+POSITION_COLUMNS = ['ra', 'dec']
+
+
+class FitsColumnLoader(object):
+	"""Reads chosen columns from a set of FITS tables, as one long column each.
+	Only the headers are read when this is made; the row counts in them are
+	used to allocate each output column once, and each file's rows are then
+	copied straight into place.  Files are read in nproc threads.  Loaded columns
+	are kept, so each one is only read once however many catalogs share the loader."""
+	def __init__(self, filenames, nproc=4):
+		import astropy.io.fits
+		self.filenames = filenames
+		self.nproc = nproc
+		self.columns = {}
+		self.counts = []
+		colnames = None
+		for filename in filenames:
+			header = astropy.io.fits.getheader(filename, 1)
+			names = [header['TTYPE%d'%(i+1)] for i in xrange(header['TFIELDS'])]
+			if colnames is None:
+				colnames = names
+			else:
+				colnames = [name for name in colnames if name in names]
+			self.counts.append(header['NAXIS2'])
+		self.colnames = colnames or []
+		self.offsets = np.concatenate([[0], np.cumsum(self.counts)]).astype(int)
+		self.nrows = self.offsets[-1]
+
+	@staticmethod
+	def read_file(filename, names):
+		import astropy.io.fits
+		#With memmap only the requested columns get decoded
+		with astropy.io.fits.open(filename, memmap=True) as hdus:
+			data = hdus[1].data
+			return [np.array(data[name]) for name in names]
+
+	def fingerprint(self):
+		"""The name, size and modification time of each file, for spotting when
+		they have changed."""
+		return repr([(filename, os.path.getsize(filename), os.path.getmtime(filename))
+			for filename in self.filenames])
+
+	def load(self, names):
+		"""Return a dict of the full columns with the given names."""
+		from multiprocessing.pool import ThreadPool
+		new_names = [name for name in names if name not in self.columns]
+		if new_names:
+			columns = {}
+			def read(i):
+				return i, self.read_file(self.filenames[i], new_names)
+			pool = ThreadPool(max(1, min(self.nproc, len(self.filenames))))
+			try:
+				for i, cols in pool.imap_unordered(read, xrange(len(self.filenames))):
+					print " - ", self.filenames[i]
+					for name, col in zip(new_names, cols):
+						if name not in columns:
+							dtype = col.dtype.newbyteorder('=')
+							columns[name] = np.empty((self.nrows,)+col.shape[1:], dtype=dtype)
+						columns[name][self.offsets[i]:self.offsets[i+1]] = col
+			finally:
+				pool.close()
+			self.columns.update(columns)
+		return dict((name, self.columns[name]) for name in names)
+
+	def read_rows(self, rows, names):
+		"""Return a dict of the given rows (indices into the full set of rows) of some
+		columns, reading only those rows from each file."""
+		import astropy.io.fits
+		rows = np.asarray(rows)
+		columns = {}
+		ifile = np.searchsorted(self.offsets, rows, side='right') - 1
+		for i in np.unique(ifile):
+			sel = np.where(ifile==i)[0]
+			local = rows[sel] - self.offsets[i]
+			with astropy.io.fits.open(self.filenames[i], memmap=True) as hdus:
+				data = hdus[1].data
+				for name in names:
+					col = data[name]
+					if len(local) and np.all(np.diff(local)==1):
+						col = col[local[0]:local[-1]+1]
+					else:
+						col = col[local]
+					if name not in columns:
+						dtype = col.dtype.newbyteorder('=')
+						columns[name] = np.empty((len(rows),)+col.shape[1:], dtype=dtype)
+					columns[name][sel] = col
+		return columns
+
+
+class ChunkedCatalog(object):
+	"""A catalog that is never loaded into memory all at once.
+
+	The rows are read chunk_size at a time from the FITS files, and the suite
+	computes its statistics from them with the reductions in reductions.py.
+	Selecting or intersecting just keeps track of which rows of the files are
+	in the catalog.  Whole columns are only read (one at a time) if a test
+	needs them, e.g. for the quantiles in BinnedTrendMethods."""
+	def __init__(self, filenames, name, columns=None, chunk_size=1000000):
+		if columns is None:
+			columns = USEFUL_COLUMNS
+		self.loader = FitsColumnLoader(filenames, nproc=1)
+		keys = [key for key in KEY_COLUMNS if key in self.loader.colnames]
+		self.colnames = keys + [name for name in columns if name not in keys]
+		self.colnames += [name for name in POSITION_COLUMNS
+			if name in self.loader.colnames and name not in self.colnames]
+		self.name = name
+		self.chunk_size = chunk_size
+		self.rows = None
+		self.derived = {}
+
+	@classmethod
+	def from_directory(cls, dirname, **kwargs):
+		print "Loading from directory: ", dirname
+		filenames = glob.glob(dirname+"/*.fits") + glob.glob(dirname+"/*.fits.gz")
+		print 'got %d files' % len(filenames)
+		cat_name=dirname.strip(os.path.sep).split(os.path.sep)[-1]
+		return cls(filenames, cat_name, **kwargs)
+
+	def __len__(self):
+		if self.rows is None:
+			return self.loader.nrows
+		return len(self.rows)
+
+	def chunk_starts(self):
+		return range(0, len(self), self.chunk_size)
+
+	def chunk_rows(self, start, stop):
+		if self.rows is None:
+			return np.arange(start, min(stop, len(self)))
+		return self.rows[start:stop]
+
+	def read_chunk(self, start, names=None):
+		"""Read chunk_size rows starting from row start."""
+		if names is None:
+			names = self.colnames
+		return self.loader.read_rows(self.chunk_rows(start, start+self.chunk_size), names)
+
+	def iter_chunks(self, names=None):
+		for start in self.chunk_starts():
+			yield self.read_chunk(start, names)
+
+	def subset(self, item):
+		"""A new catalog with just some of these rows (a mask or index array)."""
+		import copy
+		cat = copy.copy(self)
+		cat.rows = self.chunk_rows(0, len(self))[item]
+		cat.derived = {}
+		return cat
+
+	def __getitem__(self, item):
+		if isinstance(item, basestring):
+			return np.concatenate([chunk[item] for chunk in self.iter_chunks([item])])
+		return self.subset(item)
+
+	def intersection_indices(self, *cats, **kwargs):
+		field = kwargs.pop('field', 'coadd_objects_id')
+		fields = [field] if isinstance(field, basestring) else list(field)
+		keys = [[cat[f] for f in fields] for cat in (self,)+cats]
+		return join_indices(combine_keys(keys))
+
+	def intersection(self, *cats, **kwargs):
+		indices = self.intersection_indices(*cats, **kwargs)
+		return tuple(cat.subset(index) for cat, index in zip((self,)+cats, indices))
+
+
 class Catalog(astropy.table.Table):
+	#For catalogs where some columns are only loaded when first used
+	_loader = None
+	_rows = None
+
 	@classmethod
-	def from_multiple_fits(cls, filenames, cat_name, quiet=True):
-		tables = []
-		for filename in filenames:
-			print " - ", filename
-			cat = astropy.table.Table.read(filename, format='fits')
-			removals = []
-			for name in cat.colnames:
-				# for useless in USELESS_COLUMNS:
-					# if name.startswith(useless):
-						# removals.append(name)
-						# break
-				if name not in USEFUL_COLUMNS:
-					removals.append(name)				
-			cat.remove_columns(removals)
-			tables.append(cat)
-		if len(tables)>1:
-			cat = astropy.table.vstack(tables, join_type='exact', metadata_conflicts='silent')
+	def from_multiple_fits(cls, filenames, cat_name, quiet=True, columns=None, lazy=False, nproc=4):
+		"""Load the USEFUL_COLUMNS (or the given columns), plus any KEY_COLUMNS, from
+		some FITS files.  With lazy=True only the key columns are read now, and the
+		others are read the first time they are used."""
+		if columns is None:
+			columns = USEFUL_COLUMNS
+		loader = FitsColumnLoader(filenames, nproc=nproc)
+		missing = [name for name in columns if name not in loader.colnames]
+		if missing:
+			print "Columns %s are not in all the files - leaving them out" % missing
+			columns = [name for name in columns if name not in missing]
+		keys = [name for name in KEY_COLUMNS if name in loader.colnames]
+		names = keys + [name for name in columns if name not in keys]
+		names += [name for name in POSITION_COLUMNS
+			if name in loader.colnames and name not in names]
+		if lazy:
+			#Need at least one column to give the table its length
+			load_now = keys or names[:1]
 		else:
-			cat = tables[0]
-		cat = cls(cat)
+			load_now = names
+		data = loader.load(load_now)
+		cat = cls([data[name] for name in load_now], names=load_now)
+		if lazy:
+			cat._loader = loader
+			cat._lazy_names = [name for name in names if name not in load_now]
 		cat.name = cat_name
 		return cat
 
+	@property
+	def derived(self):
+		"""Quantities computed from this catalog that several tests share."""
+		if '_derived' not in self.__dict__:
+			self._derived = {}
+		return self._derived
+
+	def load_columns(self, names):
+		"""Read some columns that were deferred when this catalog was loaded."""
+		data = self._loader.load(names)
+		for name in names:
+			col = data[name]
+			if self._rows is not None:
+				col = col[self._rows]
+			self[name] = col
+			self._lazy_names.remove(name)
+
+	def load_all_columns(self):
+		if self._loader is not None and self._lazy_names:
+			self.load_columns(list(self._lazy_names))
+
 	@classmethod
-	def from_directory(cls, dirname):
+	def from_directory(cls, dirname, lazy=False, nproc=4):
 		print "Loading from directory: ", dirname
 		filenames = glob.glob(dirname+"/*.fits") + glob.glob(dirname+"/*.fits.gz")
 		print 'got %d files' % len(filenames)
 		cat_name=dirname.strip(os.path.sep).split(os.path.sep)[-1]
-		cat = cls.from_multiple_fits(filenames, cat_name)
+		cat = cls.from_multiple_fits(filenames, cat_name, lazy=lazy, nproc=nproc)
 		return cat
 
 	@classmethod
@@ -72,33 +272,90 @@ class Catalog(astropy.table.Table):
 		return astropy.table.Table(catalog)
 
 
-	def intersection(self, cat2, field='coadd_objects_id'):
-		ids1 = set(self[field])
-		ids2 = set(cat2[field])
-		ids_both = ids1.intersection(ids2)
-
-		indices = in_table(self[field], ids_both)
-		c1 = self[indices]
+	def intersection_indices(self, *cats, **kwargs):
+		"""Find the rows of this catalog and each of cats that have matching keys.
+		The key is given by field, which is either a single column name or a
+		list of them, e.g. ['coadd_objects_id', 'exposure'].
+		Returns a list of index arrays, one per catalog, in the row order of this one."""
+		field = kwargs.pop('field', 'coadd_objects_id')
+		fields = [field] if isinstance(field, basestring) else list(field)
+		keys = [[cat[f] for f in fields] for cat in (self,)+cats]
+		return join_indices(combine_keys(keys))
 
-		indices = in_table(cat2[field], ids_both)
-		c2 = cat2[indices]
+	def intersection(self, *cats, **kwargs):
+		"""Cut this catalog and each of cats down to the objects they have in common.
+		The rows of the outputs are aligned with each other, in the order they appear
+		in this catalog."""
+		indices = self.intersection_indices(*cats, **kwargs)
+		return tuple(cat[index] for cat, index in zip((self,)+cats, indices))
 
-		return c1, c2
-
-	def __getitem__(self, *args, **kwargs):
-		cat = super(Catalog, self).__getitem__(*args, **kwargs)
+	def __getitem__(self, item):
+		if (self._loader is not None and isinstance(item, basestring)
+			and item in self._lazy_names):
+			self.load_columns([item])
+		cat = super(Catalog, self).__getitem__(item)
 		if isinstance(cat, Catalog):
 			cat.name = self.name
+			if self._loader is not None and self._lazy_names:
+				#Keep track of which of the original rows this is, so the deferred
+				#columns can still be cut down to match when they are loaded.
+				if is_column_names(item):
+					cat._rows = self._rows
+				else:
+					rows = np.arange(len(self)) if self._rows is None else self._rows
+					cat._rows = rows[item]
+				cat._loader = self._loader
+				cat._lazy_names = list(self._lazy_names)
 		return cat
 
 
 
-def in_table(col, s):
-	#This is not fast 
-	indices = []
-	for i in xrange(len(col)):
-		if col[i] in s:
-			indices.append(i)
-	indices = np.array(indices)
-	return indices
+def is_column_names(item):
+	"""Whether a table index is a list of column names rather than a row selection."""
+	return (isinstance(item, (tuple, list)) and len(item)>0
+		and all(isinstance(x, basestring) for x in item))
+
+
+def combine_keys(keys):
+	"""Turn composite keys into a single integer key per row.
+	keys is a list (one per catalog) of lists of key columns.  Each column is
+	replaced by its index into the unique values of that column across all the
+	catalogs, and the columns are then combined into one int64."""
+	if len(keys[0])==1:
+		return [np.asarray(k[0]) for k in keys]
+	lengths = [len(k[0]) for k in keys]
+	splits = np.cumsum(lengths)[:-1]
+	combined = np.zeros(sum(lengths), dtype=np.int64)
+	for j in xrange(len(keys[0])):
+		col = np.concatenate([np.asarray(k[j]) for k in keys])
+		values, code = np.unique(col, return_inverse=True)
+		combined = combined * len(values) + code
+	return np.split(combined, splits)
 
+
+def join_indices(keys):
+	"""Match up rows of several catalogs by key, with a sort and searchsorted
+	rather than python sets.
+	keys is a list of key arrays, one per catalog.  Returns a list of index
+	arrays such that keys[i][indices[i]] are all the same, in the order the rows
+	appear in the first catalog.  If a key is repeated in one of the other
+	catalogs only its first row is used."""
+	index0 = np.arange(len(keys[0]))
+	others = []
+	for k in keys[1:]:
+		k = np.asarray(k)
+		order = np.argsort(k, kind='mergesort')
+		sorted_k = k[order]
+		if np.any(sorted_k[1:]==sorted_k[:-1]):
+			print "Warning: repeated keys in catalog - only using the first of each"
+		key0 = np.asarray(keys[0])[index0]
+		pos = np.searchsorted(sorted_k, key0)
+		if len(sorted_k)==0:
+			found = np.zeros(len(key0), dtype=bool)
+		else:
+			pos[pos==len(sorted_k)] = 0
+			found = sorted_k[pos]==key0
+		index0 = index0[found]
+		others = [index[found] for index in others]
+		others.append(order[pos[found]])
+	return [index0] + others
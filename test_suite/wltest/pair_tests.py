@@ -1,6 +1,7 @@
 #coding: utf-8
 from .test_base import PairCatalogTest
 from .binnings import BinnedTrendMethods
+from . import reductions
 import numpy as np
 from . import lazy_pylab as pylab
 
@@ -30,20 +31,74 @@ class EDifferenceTest(PairCatalogTest):
 
 		return np.array([d1,d2])
 
+	def reduction(self, cat1, cat2):
+		return reductions.DifferenceReduction(['e1', 'e2'])
+
+	def statistic_from(self, reduction):
+		return reduction.finish()[0]
+
+	def finish(self, reduction, cat1, cat2):
+		(d1, d2), (d1_error, d2_error) = reduction.finish()
+		print "(difference values d1 = %e ± %e)" % (d1, d1_error)
+		print "(difference values d2 = %e ± %e)" % (d2, d2_error)
+		print
+		#Too many points to scatter plot, so show the density instead
+		extent = list(reduction.ranges[0]) + list(reduction.ranges[1])
+		filename = self.filename("e1_difference")
+		fig = self.figure(filename)
+		pylab.imshow(reduction.hists[0].T, origin='lower', extent=extent, aspect='auto',
+			cmap='gray_r')
+		pylab.xlabel("$e^A_1$")
+		pylab.ylabel("$e^B_1 - e^A_1$")
+
+		filename = self.filename("e2_difference")
+		fig = self.figure(filename)
+		pylab.imshow(reduction.hists[1].T, origin='lower', extent=extent, aspect='auto',
+			cmap='gray_r')
+		pylab.xlabel("$e^A_2$")
+		pylab.ylabel("$e^B_2 - e^A_2$")
+
+		return np.array([d1,d2])
+
 class PSFDifferenceTest11(PairCatalogTest, BinnedTrendMethods):
 	name = "psf_m_difference_11"
 	statistic_target = [0.001, 0.01]
+	x_axis = "mean_psf_e1_sky"
+	y_axis = "e1"
+	n = 10
+
+	def derive(self, cat):
+		self.equal_count_bin_index(cat, self.x_axis, self.n)
+
 	def run(self, cat1, cat2):
-		x_axis = "mean_psf_e1_sky"
-		y_axis = "e1"
+		x_axis = self.x_axis
+		y_axis = self.y_axis
 		x1 = cat1[x_axis]
 		y1 = cat1[y_axis]
 		x2 = cat2[x_axis]
 		y2 = cat2[y_axis]
-		n = 10
-		p1 = BinnedTrendMethods.binned_mean_equal_count_fit(x1, y1, n)
-		p2 = BinnedTrendMethods.binned_mean_equal_count_fit(x2, y2, n)
+		n = self.n
+		bins1 = self.equal_count_bin_index(cat1, x_axis, n)
+		bins2 = self.equal_count_bin_index(cat2, x_axis, n)
+		p1 = BinnedTrendMethods.binned_mean_equal_count_fit(x1, y1, n, bins=bins1)
+		p2 = BinnedTrendMethods.binned_mean_equal_count_fit(x2, y2, n, bins=bins2)
+		return self.compare_fits(p1, p2)
+
+	def reduction(self, cat1, cat2):
+		return reductions.PairReduction(*[
+			reductions.BinnedTrendReduction(self.x_axis, [self.y_axis],
+				self.equal_count_bin_index(cat, self.x_axis, self.n)[0])
+			for cat in [cat1, cat2]])
+
+	def finish(self, reduction, cat1, cat2):
+		p1, p2 = [r.finish()[4][0] for r in reduction.reductions]
+		return self.compare_fits(p1, p2)
+
+	def statistic_from(self, reduction):
+		p1, p2 = [r.finish()[4][0] for r in reduction.reductions]
+		return np.array([p2[0]-p1[0], p2[1]-p1[1]])
 
+	def compare_fits(self, p1, p2):
 		m1 = p1[0]
 		m2 = p2[0]
 		c1 = p1[1]
@@ -0,0 +1,210 @@
+"""
+Versions of the GreenSuite statistics that can be computed a chunk of rows at a
+time, for catalogs too big to hold in memory (see catalogs.ChunkedCatalog).
+
+Each reduction has:
+ - update(chunk), which adds in a chunk of rows (a dict of column arrays, or a
+   pair of them for the pair tests)
+ - merge(other), which adds in another partial result of the same reduction,
+   e.g. from another process
+ - scaled(w), a copy with every object's weight multiplied by w, so that
+   partial results from different patches can be recombined with different
+   weights for jackknife or bootstrap errors (see resampling.py)
+and the tests turn the final state into their statistic and plots.
+
+"""
+import numpy as np
+import copy
+
+
+class Moments(object):
+    """Counts, means and sums of squared deviations of some columns in bins.
+    Partial results are combined with the pairwise update of Chan et al., so
+    the means and variances agree with those of the whole columns at once."""
+    def __init__(self, ncol, nbin=1):
+        self.nbin = nbin
+        self.count = np.zeros(nbin)
+        self.mean = np.zeros((ncol, nbin))
+        self.m2 = np.zeros((ncol, nbin))
+
+    def combine(self, count, mean, m2):
+        n = self.count + count
+        use = count > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = mean - self.mean
+            frac = np.where(use, count / n, 0.)
+            self.m2 += np.where(use, m2 + delta**2 * self.count * frac, 0.)
+            self.mean += np.where(use, delta * frac, 0.)
+        self.count = n
+
+    def add(self, ys, bin=None):
+        """Add some values.  bin says which bin each one is in (default all in bin 0),
+        and anything with bin outside 0..nbin-1 is skipped."""
+        n = self.nbin
+        if bin is None:
+            bin = np.zeros(len(ys[0]), dtype=int)
+        use = (bin >= 0) & (bin < n)
+        bin = bin[use]
+        count = np.bincount(bin, minlength=n)[:n].astype(float)
+        mean = np.zeros_like(self.mean)
+        m2 = np.zeros_like(self.m2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i, y in enumerate(ys):
+                y = np.asarray(y, dtype=float)[use]
+                mean[i] = np.where(count > 0, np.bincount(bin, weights=y, minlength=n)[:n] / count, 0.)
+                m2[i] = np.bincount(bin, weights=(y - mean[i][bin])**2, minlength=n)[:n]
+        self.combine(count, mean, m2)
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2)
+
+    def scaled(self, w):
+        m = copy.copy(self)
+        m.count = self.count * w
+        m.mean = self.mean.copy()
+        m.m2 = self.m2 * w
+        return m
+
+    def finish(self):
+        """Return the count, mean, (population) std and std/sqrt(count), with nan for
+        empty bins."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self.m2 / self.count)
+            err = std / np.sqrt(self.count)
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        return self.count, mean, std, err
+
+
+class MeanReduction(object):
+    """The means of some columns, optionally only where cut_column > cut_value."""
+    def __init__(self, columns, cut_column=None, cut_value=None):
+        self.columns = columns
+        self.cut_column = cut_column
+        self.cut_value = cut_value
+        self.moments = Moments(len(columns))
+
+    def update(self, chunk):
+        if self.cut_column is None:
+            ys = [chunk[c] for c in self.columns]
+        else:
+            cut = chunk[self.cut_column] > self.cut_value
+            ys = [chunk[c][cut] for c in self.columns]
+        self.moments.add(ys)
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+
+    def scaled(self, w):
+        r = copy.copy(self)
+        r.moments = self.moments.scaled(w)
+        return r
+
+    def finish(self):
+        count, mean, std, err = self.moments.finish()
+        return mean[:, 0]
+
+
+class BinnedTrendReduction(object):
+    """The means of some y columns in given bins of an x column, and a line
+    fit to them, as in BinnedTrendMethods.binned_trends."""
+    def __init__(self, x_axis, y_axes, bins):
+        self.x_axis = x_axis
+        self.y_axes = y_axes
+        self.bins = bins
+        self.moments = Moments(len(y_axes), len(bins)-1)
+        self.x_range = [np.inf, -np.inf]
+
+    def update(self, chunk):
+        x = chunk[self.x_axis]
+        if len(x) == 0:
+            return
+        bin = np.digitize(x, self.bins) - 1
+        self.moments.add([chunk[y] for y in self.y_axes], bin)
+        self.x_range = [min(self.x_range[0], x.min()), max(self.x_range[1], x.max())]
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.x_range = [min(self.x_range[0], other.x_range[0]),
+                        max(self.x_range[1], other.x_range[1])]
+
+    def scaled(self, w):
+        r = copy.copy(self)
+        r.moments = self.moments.scaled(w)
+        return r
+
+    def finish(self):
+        """Return x_mid, count, y_mean, y_err, p, like binned_trends."""
+        x_mid = (self.bins[1:]+self.bins[:-1])/2.
+        count, y_mean, std, y_err = self.moments.finish()
+        p = np.polyfit(x_mid, y_mean.T, 1).T
+        return x_mid, count, y_mean, y_err, p
+
+
+class DifferenceReduction(object):
+    """The mean and spread of the differences of some columns between two aligned
+    catalogs, plus histograms of the differences against the first catalog's values
+    for plotting."""
+    def __init__(self, columns, value_range=(-1., 1.), diff_range=(-0.5, 0.5), nhist=200):
+        self.columns = columns
+        self.moments = Moments(len(columns))
+        self.ranges = [value_range, diff_range]
+        self.nhist = nhist
+        self.hists = [np.zeros((nhist, nhist)) for c in columns]
+
+    def update(self, chunks):
+        chunk1, chunk2 = chunks
+        diffs = [chunk1[c] - chunk2[c] for c in self.columns]
+        self.moments.add(diffs)
+        for i, c in enumerate(self.columns):
+            self.hists[i] += np.histogram2d(chunk1[c], -diffs[i], bins=self.nhist,
+                                            range=self.ranges)[0]
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        for h, h2 in zip(self.hists, other.hists):
+            h += h2
+
+    def scaled(self, w):
+        r = copy.copy(self)
+        r.moments = self.moments.scaled(w)
+        r.hists = [h * w for h in self.hists]
+        return r
+
+    def finish(self):
+        """Return the mean and std/sqrt(n) of each difference."""
+        count, mean, std, err = self.moments.finish()
+        return mean[:, 0], err[:, 0]
+
+
+class PairReduction(object):
+    """Apply separate reductions to each catalog of a pair."""
+    def __init__(self, reduction1, reduction2):
+        self.reductions = [reduction1, reduction2]
+
+    def update(self, chunks):
+        for r, chunk in zip(self.reductions, chunks):
+            r.update(chunk)
+
+    def merge(self, other):
+        for r, r2 in zip(self.reductions, other.reductions):
+            r.merge(r2)
+
+    def scaled(self, w):
+        return PairReduction(*[r.scaled(w) for r in self.reductions])
+
+
+class ReductionGroup(object):
+    """Apply several reductions to the same chunks."""
+    def __init__(self, reductions):
+        self.reductions = reductions
+
+    def update(self, chunk):
+        for r in self.reductions:
+            r.update(chunk)
+
+    def merge(self, other):
+        for r, r2 in zip(self.reductions, other.reductions):
+            r.merge(r2)
+
+    def scaled(self, w):
+        return ReductionGroup([r.scaled(w) for r in self.reductions])
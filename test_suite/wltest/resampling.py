@@ -0,0 +1,159 @@
+"""
+Jackknife and bootstrap errors on the GreenSuite statistics.
+
+Each object is put in one of npatch patches on the sky, once per catalog, and
+each test's reduction (see reductions.py) is computed separately for every
+patch in a single pass through the catalog.  A resampled catalog is then just
+the patches recombined with different weights - all but one for the jackknife,
+multinomial counts for the bootstrap - so the tests never have to be re-run on
+the resampled catalogs themselves.
+
+"""
+import numpy as np
+from . import test_base
+from .catalogs import ChunkedCatalog
+
+
+def assign_patches(ra, dec, npatch):
+    """Split objects into npatch patches with about equal numbers of objects in
+    each: first into bands in dec, then each band into cells in ra.  Returns the
+    patch number of each object."""
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    n = len(ra)
+    npatch = max(1, min(npatch, n))
+    nband = max(1, int(np.sqrt(npatch)))
+    per_band = np.zeros(nband, dtype=int) + npatch // nband
+    per_band[:npatch % nband] += 1
+    first = np.concatenate([[0], np.cumsum(per_band)])
+    # Each band gets a share of the objects in proportion to its number of patches
+    edges = (first * float(n) / npatch).astype(int)
+    order = np.argsort(dec, kind='mergesort')
+    patch = np.empty(n, dtype=int)
+    for b in xrange(nband):
+        rows = order[edges[b]:edges[b+1]]
+        if len(rows) == 0:
+            continue
+        # Measure ra from the middle of the band so a patch can't wrap round ra=0
+        x = np.radians(ra[rows])
+        center = np.degrees(np.arctan2(np.sin(x).mean(), np.cos(x).mean()))
+        x = (ra[rows] - center + 180.) % 360.
+        rank = np.empty(len(rows), dtype=int)
+        rank[np.argsort(x, kind='mergesort')] = np.arange(len(rows))
+        patch[rows] = first[b] + rank * per_band[b] // len(rows)
+    return patch
+
+
+def row_patches(n, npatch):
+    """Patches made of consecutive blocks of rows, for catalogs without positions."""
+    npatch = max(1, min(npatch, n))
+    return np.arange(n) * npatch // max(n, 1)
+
+
+def catalog_patches(cat, npatch):
+    """The patch of each object in a catalog, worked out the first time it is needed."""
+    key = ('patch', npatch)
+    if key not in cat.derived:
+        if 'ra' in cat.colnames and 'dec' in cat.colnames:
+            cat.derived[key] = assign_patches(cat['ra'], cat['dec'], npatch)
+        else:
+            print " - No ra, dec in %s: using blocks of rows as the patches" % cat.name
+            cat.derived[key] = row_patches(len(cat), npatch)
+    return cat.derived[key]
+
+
+def _sorted_columns(chunk, order):
+    names = chunk.colnames if hasattr(chunk, 'colnames') else chunk.keys()
+    return dict((name, np.asarray(chunk[name])[order]) for name in names)
+
+
+def _column_slice(data, start, end):
+    if data is None:
+        return None
+    return dict((name, col[start:end]) for name, col in data.items())
+
+
+def iter_patch_chunks(cat1, cat2, patch):
+    """Go through a catalog (and an aligned second one, or None) once, yielding
+    (patch number, rows of cat1, rows of cat2) for each patch in each chunk."""
+    if isinstance(cat1, ChunkedCatalog):
+        pieces = ((cat1.read_chunk(start),
+                   None if cat2 is None else cat2.read_chunk(start),
+                   patch[start:start+cat1.chunk_size])
+                  for start in cat1.chunk_starts())
+    else:
+        pieces = [(cat1, cat2, patch)]
+    for chunk1, chunk2, p in pieces:
+        order = np.argsort(p, kind='mergesort')
+        numbers, starts = np.unique(p[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        data1 = _sorted_columns(chunk1, order)
+        data2 = None if chunk2 is None else _sorted_columns(chunk2, order)
+        for k, start, end in zip(numbers, starts, ends):
+            yield k, _column_slice(data1, start, end), _column_slice(data2, start, end)
+
+
+def patch_reductions(make_reduction, cat1, cat2, npatch):
+    """Compute a reduction separately for each patch of cat1.  With cat2 the
+    reduction is of the pair of catalogs, which must be aligned."""
+    patch = catalog_patches(cat1, npatch)
+    parts = {}
+    for k, chunk1, chunk2 in iter_patch_chunks(cat1, cat2, patch):
+        if k not in parts:
+            parts[k] = make_reduction()
+        parts[k].update(chunk1 if cat2 is None else (chunk1, chunk2))
+    return [parts[k] for k in sorted(parts)]
+
+
+def combine(parts, weights):
+    """The reduction for all the patches together, each weighted by weights."""
+    total = None
+    for part, w in zip(parts, weights):
+        if w == 0:
+            continue
+        r = part.scaled(w)
+        if total is None:
+            total = r
+        else:
+            total.merge(r)
+    return total
+
+
+def jackknife(statistic, parts):
+    """The jackknife error on statistic(reduction), leaving out one patch at a time."""
+    n = len(parts)
+    stats = np.array([statistic(combine(parts, np.arange(n) != k)) for k in xrange(n)])
+    mean = stats.mean(axis=0)
+    return np.sqrt((n-1.) / n * ((stats - mean)**2).sum(axis=0))
+
+
+def bootstrap(statistic, parts, nboot=100, seed=None):
+    """The bootstrap error on statistic(reduction), drawing the patches with replacement."""
+    n = len(parts)
+    rng = np.random.RandomState(seed)
+    stats = np.array([statistic(combine(parts, rng.multinomial(n, np.ones(n)/n)))
+                      for i in xrange(nboot)])
+    return np.std(stats, axis=0, ddof=1)
+
+
+def test_errors(test, cat1, cat2=None, method='jackknife', npatch=50, nboot=100):
+    """Resampled errors on a test's statistic, as a list of (catalog name, error),
+    with None as the name for pair tests.  Tests without a reduction are skipped."""
+    if method == 'jackknife':
+        resample = jackknife
+    elif method == 'bootstrap':
+        resample = lambda statistic, parts: bootstrap(statistic, parts, nboot)
+    else:
+        raise ValueError("Unknown resampling method %r" % method)
+    errors = []
+    if isinstance(test, test_base.SingleCatalogTest):
+        for cat in [cat1, cat2]:
+            if cat is None or test.reduction(cat) is None:
+                continue
+            parts = patch_reductions(lambda: test.reduction(cat), cat, None, npatch)
+            errors.append((cat.name, resample(test.statistic_from, parts)))
+    elif isinstance(test, test_base.PairCatalogTest) and cat2 is not None:
+        if test.reduction(cat1, cat2) is not None:
+            parts = patch_reductions(lambda: test.reduction(cat1, cat2), cat1, cat2, npatch)
+            errors.append((None, resample(test.statistic_from, parts)))
+    return errors
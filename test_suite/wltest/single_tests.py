@@ -1,5 +1,6 @@
 from .test_base import SingleCatalogTest
 from .binnings import BinnedTrendMethods
+from . import reductions
 import numpy as np
 from . import lazy_pylab as pylab
 
@@ -12,6 +13,15 @@ class MeanE(SingleCatalogTest):
         stat = np.array([cat['e1'].mean(), cat['e2'].mean()])
         return stat
 
+    def reduction(self, cat):
+        return reductions.MeanReduction(['e1', 'e2'])
+
+    def finish(self, reduction, cat):
+        return self.statistic_from(reduction)
+
+    def statistic_from(self, reduction):
+        return reduction.finish()
+
 class HighSNRMeanE(SingleCatalogTest):
     name = "mean_e_high_snr"
     statistic_names = ["mean_e1", "mean_e2"]    
@@ -22,6 +32,15 @@ class HighSNRMeanE(SingleCatalogTest):
         stat = np.array([cat['e1'][high].mean(), cat['e2'][high].mean()])
         return stat
 
+    def reduction(self, cat):
+        return reductions.MeanReduction(['e1', 'e2'], 'snr', 100)
+
+    def finish(self, reduction, cat):
+        return self.statistic_from(reduction)
+
+    def statistic_from(self, reduction):
+        return reduction.finish()
+
 
 class BinnedTrend(SingleCatalogTest, BinnedTrendMethods):
     x_axes = []
@@ -30,32 +49,61 @@ class BinnedTrend(SingleCatalogTest, BinnedTrendMethods):
     ylog=False
     n = 10
 
+    def derive(self, cat):
+        for x_axis in self.x_axes:
+            self.equal_count_bin_index(cat, x_axis, self.n)
+
     def run(self, cat):
-        iall=0
+        self.iall=0
         outputs = []
         for x_axis in self.x_axes:
-            for y_axis in self.y_axes:
-                filename = self.filename("%s_vs_%s"%(y_axis, x_axis))
-                self.figure(filename)
-                x = cat[x_axis]
-                y = cat[y_axis]
-                print 'self.n',self.n
-                p, x_mid, y_mean, y_std = self.binned_mean_equal_count_plot(x, y, self.n, label=cat.name)
-                pylab.xlabel(x_axis)
-                pylab.ylabel(y_axis)
-                X = [x.min(), x.max()]
-                pylab.plot(X, np.polyval(p,X),label=cat.name+" fit")
-                outputs.extend(p)
-                pylab.legend(loc='lower right')
-                iall+=1
-
-                import cPickle as pickle
-                pickle_file = open(filename+'.%d'%iall+'.data.pp2','w')
-                pickle.dump({ 'x_mid': x_mid, 'y_mean': y_mean, 'y_std': y_std,'p':p},pickle_file,protocol=2)
-                print 'saved ', filename+'.%d'%iall+'.data.pp2'
+            x = cat[x_axis]
+            print 'self.n',self.n
+            #All the y columns are binned against this x together
+            bins, bin = self.equal_count_bin_index(cat, x_axis, self.n)
+            x_mid = (bins[1:]+bins[:-1])/2.
+            ys = [cat[y_axis] for y_axis in self.y_axes]
+            count, y_means, y_stds, ps = self.binned_trends(x_mid, ys, bin, self.n)
+            X = [x.min(), x.max()]
+            outputs.extend(self.plot_trends(cat, x_axis, x_mid, y_means, y_stds, ps, X))
+        return np.array(outputs)
+
+    def reduction(self, cat):
+        return reductions.ReductionGroup([
+            reductions.BinnedTrendReduction(x_axis, self.y_axes,
+                self.equal_count_bin_index(cat, x_axis, self.n)[0])
+            for x_axis in self.x_axes])
 
+    def finish(self, reduction, cat):
+        self.iall=0
+        outputs = []
+        for x_axis, r in zip(self.x_axes, reduction.reductions):
+            x_mid, count, y_means, y_stds, ps = r.finish()
+            outputs.extend(self.plot_trends(cat, x_axis, x_mid, y_means, y_stds, ps, r.x_range))
         return np.array(outputs)
 
+    def statistic_from(self, reduction):
+        return np.concatenate([r.finish()[4].flatten() for r in reduction.reductions])
+
+    def plot_trends(self, cat, x_axis, x_mid, y_means, y_stds, ps, X):
+        outputs = []
+        for y_axis, y_mean, y_std, p in zip(self.y_axes, y_means, y_stds, ps):
+            filename = self.filename("%s_vs_%s"%(y_axis, x_axis))
+            self.figure(filename)
+            pylab.errorbar(x_mid, y_mean, y_std, fmt='.', label=cat.name)
+            pylab.xlabel(x_axis)
+            pylab.ylabel(y_axis)
+            pylab.plot(X, np.polyval(p,X),label=cat.name+" fit")
+            outputs.extend(p)
+            pylab.legend(loc='lower right')
+            self.iall+=1
+
+            import cPickle as pickle
+            pickle_file = open(filename+'.%d'%self.iall+'.data.pp2','w')
+            pickle.dump({ 'x_mid': x_mid, 'y_mean': y_mean, 'y_std': y_std,'p':p},pickle_file,protocol=2)
+            print 'saved ', filename+'.%d'%self.iall+'.data.pp2'
+        return outputs
+
 
 class EWithSNR(BinnedTrend):
     name = "e_with_snr"
@@ -67,12 +115,20 @@ class EWithSNR(BinnedTrend):
     #Make the x-axis logarithmic after plotting
     def run(self, cat):
         r = super(EWithSNR,self).run(cat)
+        self.log_x_axes()
+        return r
+
+    def finish(self, reduction, cat):
+        r = super(EWithSNR,self).finish(reduction, cat)
+        self.log_x_axes()
+        return r
+
+    def log_x_axes(self):
         for x_axis in self.x_axes:
             for y_axis in self.y_axes:
                 filename = self.filename("%s_vs_%s"%(y_axis, x_axis))
                 self.figure(filename)
                 pylab.xscale("log")
-        return r
 
     statistic_target = np.array([
         0.01, 0.01, 0.01, 0.01 ])
@@ -2,49 +2,244 @@
 from . import test_base
 from . import single_tests
 from . import pair_tests
+from . import resampling
 
 from glob import glob
-from .catalogs import Catalog
+from .catalogs import Catalog, ChunkedCatalog
 
 from . import termcolor
+import numpy as np
+import hashlib
+import inspect
+import os
 
 TICK = termcolor.colored(u"PASS" ,color='green')
 CROSS = termcolor.colored(u"FAIL" ,color='red')
 CHANGE = termcolor.colored(u"DIFFERENT" ,color='blue')
 NO_CHANGE = termcolor.colored(u"SAME" ,color='green')
 
+#The suite being run, for the worker processes to pick up when they fork
+_running = None
+
+def _execute_in_worker(i):
+	suite, cat1, cat2 = _running
+	return suite.execute_test(suite.tests[i], cat1, cat2)
+
+def _reduce_in_worker(part):
+	suite, tests, cat1, cat2, nparts = _running
+	reductions = suite.make_reductions(tests, cat1, cat2)
+	return suite.reduce_chunks(reductions, cat1, cat2, part, nparts)
+
+
+def catalog_fingerprint(cat):
+	"""A hash of what is in a catalog, for looking up cached results.
+	ChunkedCatalogs are identified by their files and the rows of them they
+	use, so their data is not read.  For Catalogs the loaded columns are hashed,
+	along with the files and rows of any columns that have not been loaded yet."""
+	if cat is None:
+		return 'None'
+	h = hashlib.sha1()
+	if isinstance(cat, ChunkedCatalog):
+		loader, rows, lazy_names = cat.loader, cat.rows, cat.colnames
+	else:
+		for name in sorted(cat.colnames):
+			h.update(str(name))
+			h.update(np.ascontiguousarray(cat[name]).tobytes())
+		loader, rows, lazy_names = cat._loader, cat._rows, getattr(cat, '_lazy_names', [])
+	if loader is not None and lazy_names:
+		h.update(loader.fingerprint())
+		h.update(repr(sorted(lazy_names)))
+		if rows is not None:
+			h.update(np.ascontiguousarray(rows).tobytes())
+	return h.hexdigest()
+
+
+def test_parameters(test):
+	"""Everything about a test that could change its result: its settings and its code."""
+	params = []
+	for klass in type(test).__mro__:
+		for key, value in sorted(vars(klass).items()):
+			if key.startswith('_') or callable(value) or isinstance(value, staticmethod):
+				continue
+			params.append((klass.__name__, key, repr(value)))
+		try:
+			params.append((klass.__name__, inspect.getsource(klass)))
+		except (IOError, TypeError):
+			pass
+	params.append(sorted((k, repr(v)) for k, v in vars(test).items()
+		if k in ['file_type', 'output_dir', 'prefix']))
+	return repr(params)
+
+
 class Suite(object):
 	classes = [
 	]
 	intersect=True
+	cache_file = 'wltest_cache.pkl'
 
-
-	def __init__(self):
+	def __init__(self, nproc=1, use_cache=False, errors=None, npatch=50, nboot=100):
 		options = {}
 		self.tests = [cls(**options) for cls in self.classes]
+		self.nproc = nproc
+		#use_cache keeps the results of each test in cache_file, and re-uses
+		#them if the test is run again on the same catalogs
+		self.use_cache = use_cache
+		#errors can be 'jackknife' or 'bootstrap' to also report resampled
+		#errors on the statistics, from npatch patches of the catalogs
+		self.errors = errors
+		self.npatch = npatch
+		self.nboot = nboot
 
 	def select(self, cat):
 		return cat
 
-	def run_single_test(self, test, cat):
+	def derive(self, cat, tests):
+		"""Work out everything the tests share (e.g. bins) once, up front."""
 		if cat is None: return
-		passed = test(cat)
-		if passed: print u" - %s  %s  %s  (%s<%s)"% (
-			cat.name, test.name, TICK, test.statistic, test.statistic_target)
-		else: print u" - %s  %s  %s  (%s>%s)"% (
-			cat.name, test.name, CROSS, test.statistic, test.statistic_target)
+		for test in tests:
+			test.derive(cat)
 
-	def run_pair_test(self, test, cat1, cat2):
-		if cat2 is None: return
-		passed = test(cat1,cat2)
-		if passed: print u" - %s %s (%s<%s)"% (
-			test.name, NO_CHANGE, test.statistic, test.statistic_target)
-		else: print u" - %s  %s  (%s>%s)"% (
-			test.name, CHANGE, test.statistic, test.statistic_target)
+	def execute_test(self, test, cat1, cat2):
+		"""Run one test on the catalog(s) and save its figures.
+		Returns the result lines to report, the final statistic, and the figure names."""
+		results = []
+		if isinstance(test, test_base.SingleCatalogTest):
+			for cat in [cat1, cat2]:
+				if cat is None: continue
+				passed = test(cat)
+				results.append(('single', cat.name, passed, test.statistic))
+		elif isinstance(test, test_base.PairCatalogTest):
+			if cat2 is not None:
+				passed = test(cat1, cat2)
+				results.append(('pair', None, passed, test.statistic))
+		filenames = list(test.figures.keys())
+		test.save_figures()
+		return results, test.statistic, filenames
 
+	def make_reductions(self, tests, cat1, cat2):
+		"""The reductions for each test, for each catalog or for the pair."""
+		reductions = []
+		for test in tests:
+			r = {}
+			if isinstance(test, test_base.SingleCatalogTest):
+				for key, cat in [('cat1', cat1), ('cat2', cat2)]:
+					if cat is None: continue
+					reduction = test.reduction(cat)
+					if reduction is not None:
+						r[key] = reduction
+			elif isinstance(test, test_base.PairCatalogTest) and cat2 is not None:
+				reduction = test.reduction(cat1, cat2)
+				if reduction is not None:
+					r['pair'] = reduction
+			reductions.append(r)
+		return reductions
 
+	def reduce_chunks(self, reductions, cat1, cat2, part=0, nparts=1):
+		"""Feed every part'th of nparts chunks of the catalogs to the reductions.
+		When the catalogs have been intersected their chunks line up, so the pair
+		tests can see matching chunks from each."""
+		paired = cat2 is not None and self.intersect
+		for start in cat1.chunk_starts()[part::nparts]:
+			chunk1 = cat1.read_chunk(start)
+			chunk2 = cat2.read_chunk(start) if paired else None
+			for r in reductions:
+				if 'cat1' in r: r['cat1'].update(chunk1)
+				if paired:
+					if 'cat2' in r: r['cat2'].update(chunk2)
+					if 'pair' in r: r['pair'].update((chunk1, chunk2))
+		if cat2 is not None and not paired:
+			for start in cat2.chunk_starts()[part::nparts]:
+				chunk2 = cat2.read_chunk(start)
+				for r in reductions:
+					if 'cat2' in r: r['cat2'].update(chunk2)
+		return reductions
+
+	def execute_chunked(self, tests, cat1, cat2):
+		"""Run some tests on ChunkedCatalogs, reading through the catalogs once for
+		all of them.  With nproc > 1 the chunks are shared out between processes
+		and their reductions merged at the end."""
+		global _running
+		if self.nproc > 1:
+			import multiprocessing
+			_running = (self, tests, cat1, cat2, self.nproc)
+			pool = multiprocessing.Pool(self.nproc)
+			try:
+				parts = pool.map(_reduce_in_worker, range(self.nproc))
+			finally:
+				pool.close()
+				pool.join()
+				_running = None
+			reductions = parts[0]
+			for part in parts[1:]:
+				for r, r2 in zip(reductions, part):
+					for key in r:
+						r[key].merge(r2[key])
+		else:
+			reductions = self.reduce_chunks(self.make_reductions(tests, cat1, cat2), cat1, cat2)
+
+		outputs = []
+		for test, r in zip(tests, reductions):
+			results = []
+			if isinstance(test, test_base.SingleCatalogTest):
+				for key, cat in [('cat1', cat1), ('cat2', cat2)]:
+					if key not in r: continue
+					passed = test.from_reduction(r[key], cat)
+					results.append(('single', cat.name, passed, test.statistic))
+			elif 'pair' in r:
+				passed = test.from_reduction(r['pair'], cat1, cat2)
+				results.append(('pair', None, passed, test.statistic))
+			if not r:
+				print " - %s cannot be run on chunked catalogs" % test.name
+			filenames = list(test.figures.keys())
+			test.save_figures()
+			outputs.append((results, test.statistic, filenames))
+		return outputs
+
+	def report(self, test, results):
+		for kind, cat_name, passed, statistic in results:
+			if kind=='single':
+				if passed: print u" - %s  %s  %s  (%s<%s)"% (
+					cat_name, test.name, TICK, statistic, test.statistic_target)
+				else: print u" - %s  %s  %s  (%s>%s)"% (
+					cat_name, test.name, CROSS, statistic, test.statistic_target)
+			else:
+				if passed: print u" - %s %s (%s<%s)"% (
+					test.name, NO_CHANGE, statistic, test.statistic_target)
+				else: print u" - %s  %s  (%s>%s)"% (
+					test.name, CHANGE, statistic, test.statistic_target)
+		print
+
+	def report_errors(self, cat1, cat2):
+		"""Print the resampled errors on each test's statistic."""
+		print "%s errors from %d patches:" % (self.errors.capitalize(), self.npatch)
+		self.derive(cat1, self.tests)
+		self.derive(cat2, self.tests)
+		for test in self.tests:
+			errors = resampling.test_errors(test, cat1, cat2, self.errors, self.npatch, self.nboot)
+			if not errors:
+				print " - %s cannot be resampled" % test.name
+			for cat_name, error in errors:
+				if cat_name is None:
+					print u" - %s  %s" % (test.name, error)
+				else:
+					print u" - %s  %s  %s" % (cat_name, test.name, error)
+		print
+
+	def load_cache(self):
+		import cPickle as pickle
+		if not self.use_cache or not os.path.exists(self.cache_file):
+			return {}
+		with open(self.cache_file) as f:
+			return pickle.load(f)
+
+	def save_cache(self, cache):
+		import cPickle as pickle
+		if not self.use_cache: return
+		with open(self.cache_file, 'w') as f:
+			pickle.dump(cache, f, protocol=2)
 
 	def run(self, cat1, cat2=None):
+		global _running
 		cat1 = self.select(cat1)
 		if cat2 is not None:
 			print "Testing %s vs %s" % (cat1.name, cat2.name)
@@ -55,15 +250,57 @@ class Suite(object):
 				cat1, cat2 = cat1.intersection(cat2)
 		else:
 			print "Testing %s alone" % cat1.name
+
+		#Look up which tests were last run on exactly these catalogs.  The cache
+		#holds (key, output) for the latest run of each test, by test name.
+		cache = self.load_cache()
+		outputs = [None for test in self.tests]
+		if self.use_cache:
+			fingerprint = catalog_fingerprint(cat1) + catalog_fingerprint(cat2)
+			keys = [hashlib.sha1(fingerprint + test_parameters(test)).hexdigest()
+				for test in self.tests]
+			for i, (test, key) in enumerate(zip(self.tests, keys)):
+				cached_key, cached = cache.get(test.name, (None, None))
+				if cached_key == key and all(os.path.exists(f) for f in cached[2]):
+					outputs[i] = cached
+		todo = [i for i in xrange(len(self.tests)) if outputs[i] is None]
+		if len(todo) < len(self.tests):
+			print " - Using cached results for %d tests" % (len(self.tests)-len(todo))
+
+		if todo:
+			self.derive(cat1, [self.tests[i] for i in todo])
+			self.derive(cat2, [self.tests[i] for i in todo])
+			if isinstance(cat1, ChunkedCatalog):
+				new_outputs = self.execute_chunked([self.tests[i] for i in todo], cat1, cat2)
+			elif self.nproc > 1 and len(todo) > 1:
+				import multiprocessing
+				#Read any columns not loaded yet now, so the workers do not
+				#each read them again
+				for cat in [cat1, cat2]:
+					if cat is not None: cat.load_all_columns()
+				_running = (self, cat1, cat2)
+				pool = multiprocessing.Pool(min(self.nproc, len(todo)))
+				try:
+					new_outputs = pool.map(_execute_in_worker, todo)
+				finally:
+					pool.close()
+					pool.join()
+					_running = None
+			else:
+				new_outputs = [self.execute_test(self.tests[i], cat1, cat2) for i in todo]
+			for i, output in zip(todo, new_outputs):
+				outputs[i] = output
+				if self.use_cache:
+					cache[self.tests[i].name] = (keys[i], output)
+			self.save_cache(cache)
+
 		filenames = []
-		for test in self.tests:
-			if isinstance(test, test_base.SingleCatalogTest):
-				self.run_single_test(test, cat1)
-				self.run_single_test(test, cat2)
-			elif isinstance(test, test_base.PairCatalogTest):
-				self.run_pair_test(test, cat1,cat2)
-			print
-			filenames.extend(test.figures.keys())
-			test.save_figures()
+		for test, (results, statistic, test_filenames) in zip(self.tests, outputs):
+			test.statistic = statistic
+			self.report(test, results)
+			filenames.extend(test_filenames)
+
+		if self.errors is not None:
+			self.report_errors(cat1, cat2)
 
 		return filenames
@@ -0,0 +1,184 @@
+"""
+Synthetic im3shape- and ngmix-like catalogs with a known shear, PSF leakage and
+selection, for timing the suite (see benchmark.py) and checking that it gets
+the right answers.
+
+Both kinds of catalog use the column names the suite reads (USEFUL_COLUMNS,
+plus coadd_objects_id, ra and dec) and describe the same objects, with the same
+intrinsic shapes, PSFs and S/N.  They differ in their measurement noise, their
+PSF leakage, which objects they flag, which objects are missing altogether,
+and (for ngmix) the order of the rows, so intersecting them does some work.
+
+Each object's ellipticity is
+
+    e_i = (1 + m) g_i + alpha_i psf_i + c_i + e_int_i + noise_i
+
+with the PSF ellipticities uniform in [-PSF_E, PSF_E], so that the suite's
+binned fits against them (at the midpoints of equal-count bins) are unbiased.
+
+"""
+import numpy as np
+import json
+import math
+import os
+
+SIGMA_INTRINSIC = 0.2
+PSF_E = 0.1
+#The true S/N is log-normal
+SNR_MEDIAN = 30.
+SNR_SIGMA_LOG = 0.8
+DEFAULT_SHEAR = [0.01, -0.005]
+
+FLAVOURS = {
+    'im3shape': dict(m=0.0, c=[0.0, 0.0], alpha=[0.05, 0.03], sigma_noise=0.2,
+                     snr_cut=12., flag_fraction=0.05, keep_fraction=1.0, shuffle=False),
+    'ngmix': dict(m=0.0, c=[0.0, 0.0], alpha=[0.02, 0.01], sigma_noise=0.15,
+                  snr_cut=10., flag_fraction=0.03, keep_fraction=0.9, shuffle=True),
+}
+
+TRUTH_FILE = 'truth.json'
+
+
+def truth_objects(rng, start, n):
+    """The properties shared by every catalog for objects start..start+n-1."""
+    return dict(
+        coadd_objects_id=np.arange(start, start+n, dtype=np.int64) + 3000000000,
+        ra=rng.uniform(0., 90., n) % 360.,
+        dec=np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(-60.)), np.sin(np.radians(-40.)), n))),
+        e1_int=rng.normal(0., SIGMA_INTRINSIC, n),
+        e2_int=rng.normal(0., SIGMA_INTRINSIC, n),
+        mean_psf_e1_sky=rng.uniform(-PSF_E, PSF_E, n),
+        mean_psf_e2_sky=rng.uniform(-PSF_E, PSF_E, n),
+        snr=np.exp(rng.normal(np.log(SNR_MEDIAN), SNR_SIGMA_LOG, n)),
+    )
+
+
+def measure(truth, flavour, shear, rng):
+    """A catalog of one flavour's measurements of some truth objects."""
+    spec = FLAVOURS[flavour]
+    n = len(truth['snr'])
+    cols = dict((name, truth[name]) for name in
+                ['coadd_objects_id', 'ra', 'dec', 'mean_psf_e1_sky', 'mean_psf_e2_sky'])
+    for i in (1, 2):
+        cols['e%d' % i] = ((1 + spec['m']) * shear[i-1]
+                           + spec['alpha'][i-1] * truth['mean_psf_e%d_sky' % i]
+                           + spec['c'][i-1] + truth['e%d_int' % i]
+                           + rng.normal(0., spec['sigma_noise'], n))
+    cols['snr'] = truth['snr'] * np.exp(rng.normal(0., 0.05, n))
+    flag = np.zeros(n, dtype=np.int32)
+    flag[cols['snr'] < spec['snr_cut']] |= 1
+    flag[rng.uniform(size=n) < spec['flag_fraction']] |= 2
+    cols['info_flag'] = flag
+    keep = np.where(rng.uniform(size=n) < spec['keep_fraction'])[0]
+    if spec['shuffle']:
+        rng.shuffle(keep)
+    return dict((name, col[keep]) for name, col in cols.items())
+
+
+def write_fits(filename, cols):
+    import astropy.io.fits
+    formats = {'i': 'K', 'f': 'D'}
+    names = ['coadd_objects_id', 'ra', 'dec', 'e1', 'e2', 'mean_psf_e1_sky',
+             'mean_psf_e2_sky', 'info_flag', 'snr']
+    columns = [astropy.io.fits.Column(name=name, array=cols[name],
+                                      format=formats[cols[name].dtype.kind])
+               for name in names]
+    hdu = astropy.io.fits.BinTableHDU.from_columns(columns)
+    hdu.writeto(filename, overwrite=True)
+
+
+def make_catalogs(dirname, n, flavours=('im3shape', 'ngmix'), shear=DEFAULT_SHEAR,
+                  rows_per_file=1000000, seed=1):
+    """Write n objects' worth of each flavour of catalog to dirname/<flavour>,
+    rows_per_file to a file, so that no more than that many rows are ever in
+    memory.  The truth is saved to dirname/truth.json.  Returns the directories."""
+    n = int(n)
+    dirnames = [os.path.join(dirname, flavour) for flavour in flavours]
+    for d in dirnames:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    for f, start in enumerate(xrange(0, n, rows_per_file)):
+        size = min(rows_per_file, n - start)
+        truth = truth_objects(np.random.RandomState([seed, f]), start, size)
+        for k, (flavour, d) in enumerate(zip(flavours, dirnames)):
+            rng = np.random.RandomState([seed, f, k+1])
+            write_fits(os.path.join(d, 'part_%04d.fits' % f), measure(truth, flavour, shear, rng))
+    truth = make_truth(n, flavours, shear, seed)
+    with open(os.path.join(dirname, TRUTH_FILE), 'w') as f:
+        json.dump(truth, f, indent=1)
+    print "Wrote %d objects to each of %s" % (n, ", ".join(dirnames))
+    return dirnames
+
+
+def make_truth(n, flavours=('im3shape', 'ngmix'), shear=DEFAULT_SHEAR, seed=1):
+    """Everything that went into a set of catalogs, as saved with them."""
+    return dict(n=int(n), seed=seed, shear=list(shear), flavours=list(flavours),
+                specs=dict((flavour, FLAVOURS[flavour]) for flavour in flavours),
+                sigma_intrinsic=SIGMA_INTRINSIC, psf_e=PSF_E,
+                snr_median=SNR_MEDIAN, snr_sigma_log=SNR_SIGMA_LOG)
+
+
+def load_truth(dirname):
+    """The truth saved by make_catalogs, or None if there are no catalogs there."""
+    filename = os.path.join(dirname, TRUTH_FILE)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def expected_statistics(truth, flavour1, flavour2=None):
+    """What each GreenSuite test's statistic should be for catalogs made by
+    make_catalogs with the given truth (without noise), along with the expected
+    noise on it for the number of objects in the catalogs (after they have been
+    selected and, for a pair, intersected, as GreenSuite does).  Returns a dict of
+    (catalog name, test name) -> (value, error), with None as the catalog name
+    for the pair tests."""
+    shear = truth['shear']
+    sigma_x = 2 * truth['psf_e'] / np.sqrt(12.)
+
+    def selected(*specs):
+        # roughly what fraction of objects are in all these catalogs and not flagged
+        z = (math.log(max(spec['snr_cut'] for spec in specs)) - math.log(truth['snr_median'])) \
+            / truth['snr_sigma_log']
+        fraction = 0.5 * math.erfc(z / math.sqrt(2.))
+        for spec in specs:
+            fraction *= spec['keep_fraction'] * (1 - spec['flag_fraction'])
+        return fraction
+
+    specs = [truth['specs'][f] for f in (flavour1, flavour2) if f is not None]
+    n = truth['n'] * selected(*specs)
+
+    def catalog_stats(flavour):
+        spec = truth['specs'][flavour]
+        mean = np.array([(1 + spec['m']) * g + c for g, c in zip(shear, spec['c'])])
+        sigma_e = np.hypot(truth['sigma_intrinsic'], spec['sigma_noise'])
+        err_mean = sigma_e / np.sqrt(n)
+        err_slope = err_mean / sigma_x
+        alpha = spec['alpha']
+        stats = {
+            'mean_e': (mean, [err_mean] * 2),
+            'e1_with_psf1': ([alpha[0], mean[0]], [err_slope, err_mean]),
+            'e1_with_psf2': ([0., mean[0]], [err_slope, err_mean]),
+            'e2_with_psf2': ([alpha[1], mean[1]], [err_slope, err_mean]),
+            'e2_with_psf1': ([0., mean[1]], [err_slope, err_mean]),
+        }
+        return dict((name, (np.array(v), np.array(e))) for name, (v, e) in stats.items())
+
+    expected = {}
+    stats1 = catalog_stats(flavour1)
+    for name, value in stats1.items():
+        expected[(flavour1, name)] = value
+    if flavour2 is not None:
+        stats2 = catalog_stats(flavour2)
+        for name, value in stats2.items():
+            expected[(flavour2, name)] = value
+        spec1, spec2 = specs
+        # The intrinsic shapes are the same in both, so only the noise is left in the differences
+        err_diff = np.hypot(spec1['sigma_noise'], spec2['sigma_noise']) / np.sqrt(n)
+        mean1, mean2 = stats1['mean_e'][0], stats2['mean_e'][0]
+        expected[(None, 'e_difference')] = (mean1 - mean2, np.array([err_diff] * 2))
+        expected[(None, 'psf_m_difference_11')] = (
+            np.array([spec2['alpha'][0] - spec1['alpha'][0], mean2[0] - mean1[0]]),
+            np.array([err_diff / sigma_x, err_diff]))
+    return expected
@@ -17,6 +17,11 @@ class BaseCatalogTest(object):
         if self.prefix: self.prefix=self.prefix + "_"
         self.figures = {}
 
+    def derive(self, cat):
+        # compute anything that other tests might share (cf. BinnedTrendMethods)
+        # before the test is run
+        pass
+
     def passed(self):
         return np.all(abs(self.statistic) < self.target)
 
@@ -54,6 +59,26 @@ class SingleCatalogTest(BaseCatalogTest):
         # compute and return statistic
         return np.nan
 
+    # For catalogs that don't fit in memory (catalogs.ChunkedCatalog) tests
+    # need to say how to compute their statistic a chunk at a time instead:
+    # reduction returns one of the objects in reductions.py (or None if this
+    # test can't be done that way), and finish turns the reduction, once it
+    # has seen all the chunks, into the statistic (and maybe plots).
+    def reduction(self, cat):
+        return None
+
+    def finish(self, reduction, cat):
+        return np.nan
+
+    # Just the statistic from a reduction, without any plots or printing.
+    # This is what resampling.py uses to get errors on the statistic.
+    def statistic_from(self, reduction):
+        return np.nan
+
+    def from_reduction(self, reduction, cat):
+        self.statistic = self.finish(reduction, cat)
+        return self.passed()
+
 
 class PairCatalogTest(BaseCatalogTest):
     def __call__(self, cat1, cat2):
@@ -64,3 +89,17 @@ class PairCatalogTest(BaseCatalogTest):
         # maybe make a plot - use self.filename and self.figure
         # compute and return statistic
         return np.nan
+
+    # As for SingleCatalogTest; the reduction is given pairs of aligned chunks.
+    def reduction(self, cat1, cat2):
+        return None
+
+    def finish(self, reduction, cat1, cat2):
+        return np.nan
+
+    def statistic_from(self, reduction):
+        return np.nan
+
+    def from_reduction(self, reduction, cat1, cat2):
+        self.statistic = self.finish(reduction, cat1, cat2)
+        return self.passed()
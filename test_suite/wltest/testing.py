@@ -1,23 +1,57 @@
-from . catalogs import table_from_fits, intersection
-from glob import glob
+from .catalogs import Catalog
+from . import synthetic
+from .suite import GreenSuite
+import numpy as np
+import tempfile
+import shutil
+import os
 
-def xtest_read():
-	filenames = glob("/Users/jaz/working/wl-tests/v7-testbed/*.fits")
-	table = table_from_fits(filenames)
-	assert len(table)>0
+#Small synthetic catalogs (see synthetic.py), made once for all the tests
+N = 20000
+_dirname = None
 
-def xtest_intersect():
-	filenames = glob("/Users/jaz/working/wl-tests/v7-testbed/*.fits")
-	table = table_from_fits(filenames)
+def setup_module():
+	global _dirname
+	_dirname = tempfile.mkdtemp()
+	synthetic.make_catalogs(_dirname, N, rows_per_file=8000)
+
+def teardown_module():
+	shutil.rmtree(_dirname)
+
+def load(flavour):
+	return Catalog.from_directory(os.path.join(_dirname, flavour))
+
+def test_read():
+	table = load('im3shape')
+	assert len(table)==N
+	assert len(np.unique(table['coadd_objects_id']))==N
+
+def test_intersect():
+	table = load('ngmix')
 	n = len(table)
-	t1, t2 = intersection(table,table)
+	t1, t2 = table.intersection(table)
 	assert len(t1) == n
 	assert len(t2) == n
 
-	t1, t2 = intersection(table[0:200], table[100:300])
+	t1, t2 = table[0:200].intersection(table[100:300])
 	assert len(t1)==100
 	assert len(t2)==100
-	assert t1['coadd_objects_id'][0] == table['coadd_objects_id'][100]
-
-
+	assert np.all(t1['coadd_objects_id'] == table['coadd_objects_id'][100:200])
+	assert np.all(t2['coadd_objects_id'] == t1['coadd_objects_id'])
 
+def test_recover_truth():
+	cat1 = load('im3shape')
+	cat2 = load('ngmix')
+	suite = GreenSuite(use_cache=False)
+	cwd = os.getcwd()
+	os.chdir(_dirname)
+	try:
+		suite.run(cat1, cat2)
+	finally:
+		os.chdir(cwd)
+	truth = synthetic.load_truth(_dirname)
+	expected = synthetic.expected_statistics(truth, 'im3shape', 'ngmix')
+	for test in suite.tests:
+		if test.name not in ['e_difference', 'psf_m_difference_11']: continue
+		value, error = expected[(None, test.name)]
+		assert np.all(abs(test.statistic - value) < 5*error)
@@ -425,60 +425,85 @@ class xi_2pt_shear_test_methods(object):
 
 class split_systematics(object):
 
+  sys_dir='/share/des/sv/systematics_maps/'
+  sys_cache_dir='sysmap_cache'
+
+  # (name, file, nested, nside, full healpix map) for each systematics map, with the bands of
+  # the per-band maps filled in as g,r,i,z.
+  sys_maps=[('ebv','Planck_EBV_2048r_Q.fits',False,2048,True)]
+  for name,label in [('exptime','EXPTIME__total'),('maglimit','maglimit__'),('skysigma','SKYSIGMA_coaddweights_mean'),('skybrite','SKYBRITE_coaddweights_mean'),('airmass','AIRMASS_coaddweights_mean'),('fwhm','FWHM_coaddweights_mean')]:
+    for band in ['g','r','i','z']:
+      sys_maps.append((name,'SVA1_IMAGE_SRC_band_'+band+'_nside4096_oversamp4_'+label+'.fits.gz',False,4096,False))
+  del name,label,band
+
   @staticmethod
   def init_systematics_maps(ra,dec):
-
-    dir='/share/des/sv/systematics_maps/'
-
-    exptime=np.zeros((4,len(ra)))
-    maglimit=np.zeros((4,len(ra)))
-    skysigma=np.zeros((4,len(ra)))
-    skybrite=np.zeros((4,len(ra)))
-    airmass=np.zeros((4,len(ra)))
-    fwhm=np.zeros((4,len(ra)))
-
-    ebv=split_systematics.load_sys_map_to_array(ra,dec,dir+'Planck_EBV_2048r_Q.fits',False,2048,True)
-    exptime[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_EXPTIME__total.fits.gz',False,4096,False)
-    exptime[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_EXPTIME__total.fits.gz',False,4096,False)
-    exptime[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_EXPTIME__total.fits.gz',False,4096,False)
-    exptime[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_EXPTIME__total.fits.gz',False,4096,False)
-    maglimit[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_maglimit__.fits.gz',False,4096,False)
-    maglimit[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_maglimit__.fits.gz',False,4096,False)
-    maglimit[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_maglimit__.fits.gz',False,4096,False)
-    maglimit[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_maglimit__.fits.gz',False,4096,False)
-    skysigma[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_SKYSIGMA_coaddweights_mean.fits.gz',False,4096,False)
-    skysigma[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_SKYSIGMA_coaddweights_mean.fits.gz',False,4096,False)
-    skysigma[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_SKYSIGMA_coaddweights_mean.fits.gz',False,4096,False)
-    skysigma[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_SKYSIGMA_coaddweights_mean.fits.gz',False,4096,False)
-    skybrite[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_SKYBRITE_coaddweights_mean.fits.gz',False,4096,False)
-    skybrite[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_SKYBRITE_coaddweights_mean.fits.gz',False,4096,False)
-    skybrite[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_SKYBRITE_coaddweights_mean.fits.gz',False,4096,False)
-    skybrite[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_SKYBRITE_coaddweights_mean.fits.gz',False,4096,False)
-    airmass[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_AIRMASS_coaddweights_mean.fits.gz',False,4096,False)
-    airmass[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_AIRMASS_coaddweights_mean.fits.gz',False,4096,False)
-    airmass[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_AIRMASS_coaddweights_mean.fits.gz',False,4096,False)
-    airmass[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_AIRMASS_coaddweights_mean.fits.gz',False,4096,False)
-    fwhm[0,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_g_nside4096_oversamp4_FWHM_coaddweights_mean.fits.gz',False,4096,False)
-    fwhm[1,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_r_nside4096_oversamp4_FWHM_coaddweights_mean.fits.gz',False,4096,False)
-    fwhm[2,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_i_nside4096_oversamp4_FWHM_coaddweights_mean.fits.gz',False,4096,False)
-    fwhm[3,:]=split_systematics.load_sys_map_to_array(ra,dec,dir+'SVA1_IMAGE_SRC_band_z_nside4096_oversamp4_FWHM_coaddweights_mean.fits.gz',False,4096,False)
+    # Each map is only read if the values for these objects aren't already in the sidecar file,
+    # and the healpix pixel of each object is only found once for each (nside, nested).
+
+    import os
+    import hashlib
+
+    files=[split_systematics.sys_dir+f for name,f,nested,nside,map in split_systematics.sys_maps]
+    key=hashlib.sha1()
+    key.update(np.ascontiguousarray(ra,dtype=float).tostring())
+    key.update(np.ascontiguousarray(dec,dtype=float).tostring())
+    for f in files:
+      key.update(f)
+      if os.path.exists(f):
+        key.update(str(os.path.getmtime(f)))
+    sidecar=os.path.join(split_systematics.sys_cache_dir,'sysmaps_'+key.hexdigest()+'.npz')
+
+    if os.path.exists(sidecar):
+      print 'loading systematics values from '+sidecar
+      vals=np.load(sidecar)['vals']
+    else:
+      pix={}
+      vals=np.zeros((len(files),len(ra)))
+      for i,(name,f,nested,nside,map) in enumerate(split_systematics.sys_maps):
+        if (nside,nested) not in pix:
+          pix[(nside,nested)]=hp.ang2pix(nside, np.pi/2.-np.radians(dec),np.radians(ra), nest=nested)
+        vals[i,:]=split_systematics.load_sys_map_to_array(ra,dec,files[i],nested,nside,map,pix=pix[(nside,nested)])
+      if not os.path.exists(split_systematics.sys_cache_dir):
+        os.makedirs(split_systematics.sys_cache_dir)
+      np.savez(sidecar,vals=vals)
+
+    ebv=vals[0,:]
+    exptime=vals[1:5,:]
+    maglimit=vals[5:9,:]
+    skysigma=vals[9:13,:]
+    skybrite=vals[13:17,:]
+    airmass=vals[17:21,:]
+    fwhm=vals[21:25,:]
 
     return ebv,exptime,maglimit,skysigma,skybrite,airmass,fwhm
 
-
   @staticmethod
-  def load_sys_map_to_array(ra,dec,sys_file,nested,nside,map):
+  def load_sys_map_to_array(ra,dec,sys_file,nested,nside,map,pix=None):
 
     print sys_file
+    if pix is None:
+      pix=hp.ang2pix(nside, np.pi/2.-np.radians(dec),np.radians(ra), nest=nested)
     if map:
       sys = hp.read_map(sys_file)
-      array = sys[hp.ang2pix(nside, np.pi/2.-np.radians(dec),np.radians(ra), nest=nested)]
+      array = sys[pix]
     else:
-      sys=py.open(sys_file)
-      sys=sys[1].data
-      sysmap = np.zeros(12*4096**2)
-      sysmap[sys['pixel']] = sys['signal']
-      array = sysmap[hp.ang2pix(nside, np.pi/2.-np.radians(dec),np.radians(ra), nest=nested)]
+      # Only the pixels in the file are kept, sorted, and looked up with a binary search, rather
+      # than filling in a full 12*nside**2 map.  Pixels not in the file are 0, and if a pixel is
+      # in the file more than once the last value is used, as before.
+      sys=fio.read(sys_file,ext=1,columns=['pixel','signal'])
+      spix=sys['pixel'].astype(np.int64)
+      signal=sys['signal'].astype(float)
+      if np.any(spix[1:]<spix[:-1]):
+        s=np.argsort(spix,kind='mergesort')
+        spix=spix[s]
+        signal=signal[s]
+      array=np.zeros(len(pix))
+      if len(spix)>0:
+        k=np.searchsorted(spix,pix,side='right')-1
+        found=k>=0
+        found[found]=spix[k[found]]==pix[found]
+        array[found]=signal[k[found]]
 
     return array
 